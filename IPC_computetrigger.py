@@ -1,5 +1,19 @@
 import pandas as pd
-from utils import parse_args, parse_yaml, config_logger
+from schema import population_columns
+from align_sources import aligned_panel
+from results_store import save_results, trigger_rows
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    results_db_arguments,
+    parse_yaml,
+    config_logger,
+    timed,
+    timed_stage,
+    frame_counts,
+    run_report,
+    profile_run,
+)
 from pathlib import Path
 import logging
 import numpy as np
@@ -7,12 +21,20 @@ import os
 
 logger = logging.getLogger(__name__)
 
+# standard deviation of the log of the multiplicative noise on the population per admin, year and IPC phase in the
+# uncertainty mode. Can be set per country with population_noise in the config
+POPULATION_NOISE = 0.1
+# maximum memory in MB of the perturbed populations of one chunk of draws in the uncertainty mode
+UNCERTAINTY_CHUNK_MB = 256
+
 # TODO: check that all cols, so CS ML1 ML2 1 to 5 and pop cols are present in input data
 # TODO: quality check that perc cols add up to 100
 
 
 def add_columns(df, source):
     df["date"] = pd.to_datetime(df["date"])
+    # the processed populations can be stored as float32, compute the percentages and triggers in float64
+    df = df.astype({c: "float64" for c in population_columns(df)})
     df["year"] = df["date"].dt.year
     df["month"] = df["date"].dt.month
 
@@ -93,6 +115,7 @@ def get_trigger_increase(row, period, level, perc):
         return 0
 
 
+@timed("trigger")
 def compute_trigger(df):
     # TODO: would be great if we can define in config or so which triggers to compute. Not sure how..
 
@@ -117,7 +140,112 @@ def compute_trigger(df):
     return df
 
 
-def main(country_iso3, admin_level, suffix, config_file="config.yml"):
+def _draw_triggers(perc, factors):
+    """
+    Evaluate the triggers of compute_trigger on perturbed percentages for a chunk of draws at once
+    Args:
+        perc: (rows x periods x 5) array with the percentage of the population per period (CS, ML1, ML2) and IPC phase
+        factors: (draws x rows x 5) array with the multiplicative noise per draw, row and IPC phase
+
+    Returns:
+        triggers: (draws x rows x 2) boolean array with trigger_ML1 and trigger_ML2 per draw and row
+    """
+    perturbed = perc[None, :, :, :] * factors[:, :, None, :]
+    # the populations per phase are perturbed, and the percentages renormalized to the analysed share of the population
+    total = perc.sum(axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        perturbed *= (total / perturbed.sum(axis=3))[..., None]
+    perc_3p = perturbed[..., 2:].sum(axis=3)
+    perc_4p = perturbed[..., 3:].sum(axis=3)
+    triggers = []
+    for p in [1, 2]:
+        # the same thresholds as get_trigger and get_trigger_increase, nan percentages never meet a threshold
+        threshold_4_20 = np.round(perc_4p[..., p]) >= 20
+        threshold_3_30 = np.round(perc_3p[..., p]) >= 30
+        threshold_3_5i = (perc_3p[..., p] != 0) & (
+            np.round(perc_3p[..., p] - perc_3p[..., 0]) >= 5
+        )
+        triggers.append(threshold_4_20 | (threshold_3_30 & threshold_3_5i))
+    return np.stack(triggers, axis=2)
+
+
+@timed("uncertainty")
+def trigger_probabilities(
+    df,
+    adm_cols,
+    n_draws,
+    noise=POPULATION_NOISE,
+    seed=0,
+    chunk_mb=UNCERTAINTY_CHUNK_MB,
+):
+    """
+    Return the probability that trigger_ML1 and trigger_ML2 activate when the population estimates are uncertain
+    Per draw, the population of every admin, year and IPC phase is multiplied by lognormal noise, which represents the
+    uncertainty of the census shares, the scaling to the yearly totals and the assignment of the phases. The same noise
+    applies to all periods and dates of that admin and year. All triggers of a chunk of draws are evaluated in one batched
+    computation, and the chunks are sized such that their perturbed populations fit in chunk_mb
+    Args:
+        df: DataFrame with the perc_ columns of add_columns, e.g. the output of compute_trigger
+        adm_cols: admin columns of df
+        n_draws: number of draws
+        noise: standard deviation of the log of the noise
+        seed: seed of the random generator, the same seed gives the same probabilities
+        chunk_mb: maximum memory in MB of the perturbed populations of one chunk
+
+    Returns:
+        df_prob: DataFrame with per row of df the date, source, admins, the trigger without noise and the share of the
+            draws in which trigger_ML1 and trigger_ML2 activated
+    """
+    perc = np.stack(
+        [
+            df[[f"perc_{period}_{i}" for i in range(1, 6)]].to_numpy(float)
+            for period in ["CS", "ML1", "ML2"]
+        ],
+        axis=1,
+    )
+    admin_year = (
+        pd.concat([df[adm_cols], pd.to_datetime(df["date"]).dt.year], axis=1)
+        .groupby(adm_cols + ["date"], sort=False)
+        .ngroup()
+        .to_numpy()
+    )
+    n_admin_year = admin_year.max() + 1
+    # with the population of a period in a single phase, e.g. most admin2s of FewsNet, the renormalized percentages do not
+    # change, so only the other rows are drawn
+    drawn = ((np.nan_to_num(perc) > 0).sum(axis=2) > 1).any(axis=1)
+    perc_drawn = perc[drawn]
+    # the factors, and the perturbed percentages and their sums per draw, which take the most memory
+    bytes_per_draw = (
+        n_admin_year * 5 + drawn.sum() * 5 + perc_drawn.size * 2
+    ) * perc.itemsize
+    chunk = max(1, min(n_draws, int(chunk_mb * 1024**2 // bytes_per_draw)))
+    rng = np.random.default_rng(seed)
+    counts = np.zeros((drawn.sum(), 2))
+    for start in range(0, n_draws, chunk):
+        n = min(chunk, n_draws - start)
+        factors = rng.lognormal(0, noise, size=(n, n_admin_year, 5))
+        counts += _draw_triggers(perc_drawn, factors[:, admin_year[drawn], :]).sum(
+            axis=0
+        )
+    df_prob = df[["date", "Source"] + adm_cols + ["trigger_ML1", "trigger_ML2"]].copy()
+    for i, c in enumerate(["trigger_ML1", "trigger_ML2"]):
+        prob = df_prob[c].fillna(False).to_numpy(float)
+        prob[drawn] = counts[:, i] / n_draws
+        df_prob[f"prob_{c}"] = prob
+    df_prob["n_draws"] = n_draws
+    return df_prob
+
+
+def main(
+    country_iso3,
+    admin_level,
+    suffix,
+    config_file="config.yml",
+    df_fews=None,
+    df_gipc=None,
+    results_db=None,
+    uncertainty=None,
+):
     """
     Compute all functions to return one dataframe with processed columns and if trigger is met for each data-source combination
     Args:
@@ -126,6 +254,17 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
         admin_level: integer indicating which admin level to aggregate to
         suffix: string that is attached to the input file names and will be attached to the output file names
         config_file: path to config file
+        df_fews: processed FewsNet DataFrame (output of process_fewsnet.py) to use instead of reading it from csv
+        df_gipc: processed GlobalIPC DataFrame (output of process_globalipc.py) to use instead of reading it from csv
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+        uncertainty: if given, the number of draws with perturbed populations from which the probability of every trigger
+            is computed, see trigger_probabilities
+
+    When both FewsNet and GlobalIPC data is present, their analyses are also aligned on a monthly timeline, see
+    align_sources.aligned_panel, and saved side by side
+
+    Returns:
+        df_comb_trig: DataFrame with the processed columns and triggers, as saved to csv
     """
     parameters = parse_yaml(config_file)[country_iso3]
     country = parameters["country_name"]
@@ -136,7 +275,7 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
         f"{FEWS_PROCESSED_FOLDER}{country}_fewsnet_admin{admin_level}{suffix}.csv"
     )
     processed_globalipc_path = (
-        f"{GIPC_PROCESSED_FOLDER}{country}_globalipc_ADMIN{admin_level}{suffix}.csv"
+        f"{GIPC_PROCESSED_FOLDER}{country}_globalipc_admin{admin_level}{suffix}.csv"
     )
 
     RESULT_FOLDER = f"{country}/Data/IPC_trigger/"
@@ -163,22 +302,29 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
     df_fewss = None
     df_gipcs = None
 
-    if os.path.exists(processed_fews_path):
-        df_fews = pd.read_csv(processed_fews_path, index_col=0)
+    if df_fews is None and os.path.exists(processed_fews_path):
+        with timed_stage("read", source="FewsNet") as stage:
+            df_fews = pd.read_csv(processed_fews_path, index_col=0)
+            stage.update(frame_counts(df_fews))
+    if df_fews is not None:
         # TODO: adjust column names in process_fewsnet.py instead
         df_fews = df_fews.rename(
             columns={
                 parameters["shp_adm1c"]: "ADMIN1",
                 parameters["shp_adm2c"]: "ADMIN2",
+                parameters.get("shp_adm3c", "ADMIN3"): "ADMIN3",
                 "adjusted_population": f"pop_ADMIN{admin_level}",
             }
         )
         df_fews = add_columns(df_fews, "FewsNet")
         df_fewss = df_fews[["date", "Source"] + adm_cols + pop_cols + ipc_cols]
 
-    if os.path.exists(processed_globalipc_path):
-        df_gipc = pd.read_csv(processed_globalipc_path, index_col=0)
-        df_gipc = add_columns(df_gipc, "GlobalIPC")
+    if df_gipc is None and os.path.exists(processed_globalipc_path):
+        with timed_stage("read", source="GlobalIPC") as stage:
+            df_gipc = pd.read_csv(processed_globalipc_path, index_col=0)
+            stage.update(frame_counts(df_gipc))
+    if df_gipc is not None:
+        df_gipc = add_columns(df_gipc.copy(), "GlobalIPC")
         df_gipcs = df_gipc[["date", "Source"] + adm_cols + pop_cols + ipc_cols]
 
     if df_fewss is not None and df_gipcs is not None:
@@ -199,12 +345,69 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
         df_comb_trig = pd.DataFrame()
         logger.warning("No data found")
 
-    df_comb_trig.to_csv(
-        f"{RESULT_FOLDER}trigger_results_admin{admin_level}{suffix}.csv", index=False
+    with timed_stage("write", admin_level=admin_level):
+        df_comb_trig.to_csv(
+            f"{RESULT_FOLDER}trigger_results_admin{admin_level}{suffix}.csv",
+            index=False,
+        )
+    if df_fewss is not None and df_gipcs is not None:
+        df_panel = aligned_panel(
+            df_comb_trig, adm_cols, parameters.get("validity_months")
+        )
+        with timed_stage("write", admin_level=admin_level, mode="aligned"):
+            df_panel.to_csv(
+                f"{RESULT_FOLDER}aligned_panel_admin{admin_level}{suffix}.csv",
+                index=False,
+            )
+    if uncertainty and not df_comb_trig.empty:
+        df_prob = trigger_probabilities(
+            df_comb_trig,
+            adm_cols,
+            uncertainty,
+            noise=parameters.get("population_noise", POPULATION_NOISE),
+        )
+        with timed_stage("write", admin_level=admin_level, mode="uncertainty"):
+            df_prob.to_csv(
+                f"{RESULT_FOLDER}trigger_probabilities_admin{admin_level}{suffix}.csv",
+                index=False,
+            )
+    if results_db and not df_comb_trig.empty:
+        with timed_stage("write", store="sqlite"):
+            save_results(
+                "IPC_computetrigger",
+                country_iso3,
+                suffix,
+                {"admin_level": admin_level},
+                triggers=trigger_rows(df_comb_trig, admin_level),
+                db_path=results_db,
+            )
+    return df_comb_trig
+
+
+def trigger_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    results_db_arguments(parser)
+    admin_level_arguments(parser)
+    parser.add_argument(
+        "--uncertainty",
+        default=None,
+        type=int,
+        help="Number of draws with perturbed populations from which the probability of every trigger is computed",
     )
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    args = parse_args(trigger_arguments)
     config_logger(level="warning")
-    main(args.country_iso3.upper(), args.admin_level, args.suffix)
+    with run_report(
+        f"IPC_computetrigger_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("IPC_computetrigger", args.country_iso3.upper(), args.profile):
+        main(
+            args.country_iso3.upper(),
+            args.admin_level,
+            args.suffix,
+            results_db=args.results_db,
+            uncertainty=args.uncertainty,
+        )
@@ -0,0 +1,207 @@
+"""
+Access to the processed data of the pipeline, for notebooks and other tools that should not rerun the processing scripts
+The paths are resolved from config.yml relative to this repository, such that it does not matter from which directory it is used.
+Parsed files are kept in memory (the CACHE_SIZE most recently used) and saved as pickle in DATA_CACHE_DIR, which loads much faster
+than the csv and keeps the dtypes. Both caches are keyed on the modification time of the file, so rerunning a script is picked up.
+
+Example:
+    import aafi
+    df = aafi.load_fewsnet("ETH", level=2)
+    df_trig = aafi.load_triggers("ETH", level=1)
+    gdf = aafi.load_boundaries("ETH", level=1)
+"""
+import pandas as pd
+import functools
+import hashlib
+import os
+from geometries import load_layer, GEOMETRY_CACHE_DIR
+from schema import apply_schema, population_columns
+from utils import parse_yaml
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# directory of this repository, to which all paths in config.yml are relative
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# directory where the parsed files are saved as pickle
+DATA_CACHE_DIR = f"{REPO_DIR}/Data/DataCache/"
+# number of parsed files that are kept in memory
+CACHE_SIZE = 32
+# sources of the processed IPC data, see processed_path
+FEWSNET_SOURCES = ["fewsnet", "worldpop", "globalipc"]
+
+
+@functools.lru_cache(maxsize=None)
+def _config(config_file):
+    return parse_yaml(config_file)
+
+
+def country_parameters(country_iso3, config_file=None):
+    """
+    Return the parameters of country_iso3 in the config file, by default config.yml of this repository
+    """
+    config_file = os.path.abspath(config_file or f"{REPO_DIR}/config.yml")
+    config = _config(config_file)
+    if country_iso3.upper() not in config:
+        raise KeyError(f"{country_iso3} is not one of the countries in {config_file}")
+    return config[country_iso3.upper()]
+
+
+def processed_path(country_iso3, level, source="fewsnet", suffix="", config_file=None):
+    """
+    Return the path to the csv that the processing script of source writes for country_iso3 and admin level
+    Args:
+        country_iso3: string with iso3 code
+        level: admin level, 1, 2 or 3
+        source: "fewsnet" (process_fewsnet.py), "worldpop" (process_fewsnet_worldpop.py), "globalipc" (process_globalipc.py)
+            or "triggers" (IPC_computetrigger.py)
+        suffix: suffix of the output files of the run
+        config_file: path to config file
+    """
+    country = country_parameters(country_iso3, config_file)["country_name"]
+    folder = f"{REPO_DIR}/{country}/Data"
+    paths = {
+        "fewsnet": f"{folder}/FewsNetProcessed/{country}_fewsnet_admin{level}{suffix}.csv",
+        "worldpop": f"{folder}/FewsNetWorldPop/{country_iso3.lower()}_admin{level}_fewsnet_worldpop{suffix}.csv",
+        "globalipc": f"{folder}/GlobalIPCProcessed/{country}_globalipc_admin{level}{suffix}.csv",
+        "triggers": f"{folder}/IPC_trigger/trigger_results_admin{level}{suffix}.csv",
+    }
+    if source not in paths:
+        raise ValueError(f"Unknown source {source}, expected one of {', '.join(paths)}")
+    return paths[source]
+
+
+def _read_table(path):
+    """
+    Read a processed csv with the compact dtypes of the processing scripts, see schema.apply_schema
+    """
+    df = pd.read_csv(path)
+    # the csvs that are saved with their index have an unnamed first column
+    df = df.drop(columns=[c for c in df.columns if c.startswith("Unnamed: ")])
+    admin_cols = [c for c in df.columns if c.startswith("ADMIN") or c.startswith("ADM")]
+    return apply_schema(
+        df,
+        admin_cols=[c for c in admin_cols if df[c].dtype == object],
+        phase_cols=["CS", "ML1", "ML2"],
+        pop_cols=population_columns(df),
+    )
+
+
+def _read_boundaries(path, dissolve_cols=None):
+    """
+    Read the boundaries with repaired geometries, dissolved to dissolve_cols if given (e.g. admin1 from the admin2 file)
+    """
+    gdf = load_layer(path, cache_dir=f"{REPO_DIR}/{GEOMETRY_CACHE_DIR}")
+    if dissolve_cols:
+        gdf = gdf.dissolve(by=list(dissolve_cols), as_index=False)[
+            list(dissolve_cols) + ["geometry"]
+        ]
+    return gdf
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _load(path, mtime_ns, size, reader, args):
+    """
+    Return the parsed file, from the pickle in DATA_CACHE_DIR if that exists and otherwise with reader(path, *args)
+    The modification time and size are part of the key, such that a changed file is parsed again
+    """
+    key = hashlib.sha1(
+        f"{path}|{mtime_ns}|{size}|{reader.__name__}|{args}".encode()
+    ).hexdigest()[:12]
+    cache_path = f"{DATA_CACHE_DIR}{Path(path).stem}_{key}.pkl"
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+    df = reader(path, *args)
+    Path(DATA_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, such that another process never reads a partly written pickle
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return df
+
+
+def _cached(path, reader, *args):
+    """
+    Return a copy of the parsed file in path, such that changes by the caller do not end up in the cache
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} does not exist, run the script that computes it first"
+        )
+    stat = os.stat(path)
+    return _load(
+        os.path.abspath(path), stat.st_mtime_ns, stat.st_size, reader, args
+    ).copy()
+
+
+def load_fewsnet(country_iso3, level=2, source="fewsnet", suffix="", config_file=None):
+    """
+    Return the processed IPC data of country_iso3 on admin level
+    Args:
+        country_iso3: string with iso3 code
+        level: admin level, 1, 2 or 3
+        source: "fewsnet" for the IPC phase per admin2 of process_fewsnet.py, "worldpop" for the population per phase of
+            process_fewsnet_worldpop.py, or "globalipc" for the output of process_globalipc.py
+        suffix: suffix of the output files of the run
+        config_file: path to config file, by default config.yml of this repository
+
+    Returns:
+        df: DataFrame as saved by the processing script, with categorical admin names and dates at the start of the month
+    """
+    if source not in FEWSNET_SOURCES:
+        raise ValueError(
+            f"Unknown source {source}, expected one of {', '.join(FEWSNET_SOURCES)}"
+        )
+    return _cached(
+        processed_path(country_iso3, level, source, suffix, config_file), _read_table
+    )
+
+
+def load_triggers(country_iso3, level=1, suffix="", config_file=None):
+    """
+    Return the output of IPC_computetrigger.py for country_iso3 on admin level, with per date, source and admin the thresholds and triggers
+    """
+    return _cached(
+        processed_path(country_iso3, level, "triggers", suffix, config_file),
+        _read_table,
+    )
+
+
+def load_boundaries(country_iso3, level=2, config_file=None):
+    """
+    Return the admin boundaries of country_iso3 in config.yml, with repaired geometries
+    Admin1 boundaries are dissolved from the admin2 file, such that both levels match exactly
+    Args:
+        country_iso3: string with iso3 code
+        level: admin level, 1, 2 or 3. Admin3 requires path_admin3_shp in the config
+        config_file: path to config file, by default config.yml of this repository
+
+    Returns:
+        gdf: GeoDataFrame with the boundaries and the admin names of the levels up to level
+    """
+    parameters = country_parameters(country_iso3, config_file)
+    path = (
+        f"{REPO_DIR}/{parameters['country_name']}/Data/{parameters['path_admin2_shp']}"
+    )
+    if int(level) == 3:
+        return _cached(
+            f"{REPO_DIR}/{parameters['country_name']}/Data/{parameters['path_admin3_shp']}",
+            _read_boundaries,
+        )
+    if int(level) == 2:
+        return _cached(path, _read_boundaries)
+    if int(level) == 1:
+        return _cached(
+            path,
+            _read_boundaries,
+            (parameters["shp_adm0c"], parameters["shp_adm1c"]),
+        )
+    raise ValueError(f"Admin level {level} is not supported, expected 1, 2 or 3")
+
+
+def clear_cache():
+    """
+    Empty the in-memory cache, e.g. to free memory in a long running notebook. The pickles in DATA_CACHE_DIR are kept
+    """
+    _load.cache_clear()
@@ -0,0 +1,163 @@
+import pandas as pd
+import numpy as np
+from schema import month_start
+from utils import timed
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+# months after the analysis date from which until which (exclusive) the values of a period apply. The CS describes the
+# months around the analysis, ML1 the ~4 months after it and ML2 the ~4 months after that. Can be set per country and
+# source with validity_months in the config, e.g. {"GlobalIPC": {"CS": [0, 3], "ML1": [3, 7], "ML2": [7, 11]}}
+VALIDITY_MONTHS = {"CS": (0, 4), "ML1": (0, 4), "ML2": (4, 8)}
+# order in which the sources are used to fuse their values, the first source that has a value for a month is used
+SOURCE_PRIORITY = ["GlobalIPC", "FewsNet"]
+
+
+def _add_months(dates, months):
+    return (dates.dt.to_period("M") + months).dt.to_timestamp()
+
+
+def period_columns(df, period):
+    """
+    Return the columns of df that belong to period, e.g. CS_3, perc_CS_3p, pop_CS and threshold_CS_3_30
+    """
+    return [
+        c
+        for c in df.columns
+        if c.startswith((f"{period}_", f"perc_{period}_", f"pop_{period}"))
+        or c.startswith((f"threshold_{period}_", f"trigger_{period}"))
+        or c == f"perc_inc_{period}_3p"
+    ]
+
+
+def monthly_timeline(df, adm_cols, months_after):
+    """
+    Return a DataFrame with a row for every admin in df and every month from the first analysis until months_after months
+    after the last analysis, sorted by date as required by the as-of joins
+    """
+    dates = month_start(df["date"])
+    months = pd.date_range(
+        dates.min(),
+        _add_months(pd.Series([dates.max()]), months_after - 1)[0],
+        freq="MS",
+    )
+    admins = df[adm_cols].drop_duplicates().sort_values(adm_cols)
+    panel = admins.iloc[np.tile(np.arange(len(admins)), len(months))].reset_index(
+        drop=True
+    )
+    panel["date"] = np.repeat(months.values, len(admins))
+    return panel
+
+
+def align_period(panel, df, adm_cols, period, start, end):
+    """
+    Add the values of period of the analysis that applies in every month of panel
+    The analysis that applies in a month is the last one of which the validity window started on or before that month, found
+    with a sorted as-of join over all admins at once. If its window ended before the month, e.g. because no newer analysis
+    was done, the values are left empty
+    Args:
+        panel: DataFrame with per admin and month a row, sorted by date, see monthly_timeline
+        df: DataFrame of one source with per admin and analysis date the values
+        adm_cols: list with the admin columns
+        period: CS, ML1 or ML2
+        start: months after the analysis date from which the values apply
+        end: months after the analysis date until which (exclusive) the values apply
+
+    Returns:
+        panel with the columns of period and the date of the analysis they come from as {period}_analysis_date
+    """
+    cols = period_columns(df, period)
+    analysis_col = f"{period}_analysis_date"
+    df_period = df[adm_cols + cols].copy()
+    df_period[analysis_col] = month_start(df["date"])
+    df_period["valid_from"] = _add_months(df_period[analysis_col], start)
+    df_period["valid_until"] = _add_months(df_period[analysis_col], end)
+    # when a source published twice in a month, the last row is used
+    df_period = df_period.drop_duplicates(adm_cols + ["valid_from"], keep="last")
+    panel = pd.merge_asof(
+        panel,
+        df_period.sort_values("valid_from"),
+        left_on="date",
+        right_on="valid_from",
+        by=adm_cols,
+        direction="backward",
+    )
+    valid = panel["date"] < panel["valid_until"]
+    for c in cols + [analysis_col]:
+        panel[c] = panel[c].where(valid)
+    return panel.drop(columns=["valid_from", "valid_until"])
+
+
+@timed("align")
+def aligned_panel(df, adm_cols, validity=None):
+    """
+    Align the analyses of all sources in df on a common monthly timeline
+    FewsNet publishes on fixed months and GlobalIPC at irregular moments, so their analysis dates rarely coincide. Instead
+    every source and period is joined to the months in which it applies, see align_period, which results in a dense panel
+    with the sources side by side
+    Args:
+        df: DataFrame with per source, admin and analysis date the values, e.g. the output of IPC_computetrigger.main
+        adm_cols: list with the admin columns
+        validity: dict with per source a dict with per period the (start, end) months of the validity window. Sources
+            and periods that are not in validity get VALIDITY_MONTHS
+
+    Returns:
+        df_panel: DataFrame with per admin and month the columns of every period, prefixed by the source, e.g.
+            FewsNet_perc_ML1_3p and GlobalIPC_ML1_analysis_date
+    """
+    validity = validity or {}
+    df = df[df["date"].notnull()]
+    sources = list(df["Source"].unique())
+    source_validity = {
+        source: {**VALIDITY_MONTHS, **validity.get(source, {})} for source in sources
+    }
+    months_after = max(end for v in source_validity.values() for _, end in v.values())
+    panel = monthly_timeline(df, adm_cols, months_after)
+    source_panels = [panel]
+    for source in sources:
+        df_source = df[df["Source"] == source]
+        df_aligned = panel
+        for period in PERIOD_LIST:
+            start, end = source_validity[source][period]
+            df_aligned = align_period(
+                df_aligned, df_source, adm_cols, period, start, end
+            )
+        value_cols = [c for c in df_aligned.columns if c not in panel.columns]
+        source_panels.append(
+            df_aligned[value_cols].rename(columns=lambda c: f"{source}_{c}")
+        )
+    df_panel = pd.concat(source_panels, axis=1)
+    return df_panel.sort_values(adm_cols + ["date"]).reset_index(drop=True)
+
+
+def fuse_sources(df_panel, adm_cols, cols, priority=SOURCE_PRIORITY):
+    """
+    Return per admin and month the value of every column in cols from the first source in priority that has a value, and
+    the source it came from as {col}_source
+    Args:
+        df_panel: output of aligned_panel
+        adm_cols: list with the admin columns
+        cols: columns to fuse without the source prefix, e.g. ["perc_CS_3p", "trigger_ML1"]
+        priority: list with the sources in order of preference
+
+    Returns:
+        df_fused: DataFrame with the admin columns, date and per column in cols the fused value and its source
+    """
+    df_fused = df_panel[adm_cols + ["date"]].copy()
+    for c in cols:
+        sources = [s for s in priority if f"{s}_{c}" in df_panel.columns]
+        values = df_panel[[f"{s}_{c}" for s in sources]].to_numpy(object)
+        available = pd.notnull(values)
+        # position of the first source with a value, argmax returns 0 as well if none has one
+        first = available.argmax(axis=1)
+        rows = np.arange(len(df_panel))
+        has_value = available[rows, first]
+        df_fused[c] = pd.Series(
+            np.where(has_value, values[rows, first], None), index=df_panel.index
+        ).infer_objects()
+        df_fused[f"{c}_source"] = np.where(
+            has_value, np.array(sources, dtype=object)[first], None
+        )
+    return df_fused
@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, quote
+import numpy as np
+import logging
+
+# the pipeline scripts are top-level modules of the repository
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from utils import config_logger  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+IPC_LEVELS = ["1", "2", "3", "4", "5", "3p", "2m"]
+
+
+async def request(reader, writer, host, target, etag=None):
+    """
+    Send one GET request over an open keep-alive connection, and return the status, ETag and body of the response
+    """
+    head = [f"GET {target} HTTP/1.1", f"Host: {host}"]
+    if etag:
+        head.append(f"If-None-Match: {etag}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers.get("etag"), body
+
+
+def query_mix(status, n, seed=0):
+    """
+    Return n request targets over the endpoints of serve_results.py, with random admins, dates, periods and IPC levels
+    """
+    rng = random.Random(seed)
+    countries = {
+        c: entry for c, entry in status["countries"].items() if entry["admin2"]
+    } or status["countries"]
+    years = [str(y) for y in range(2009, 2021)]
+    targets = []
+    for _ in range(n):
+        country = rng.choice(list(countries))
+        kind = rng.random()
+        if kind < 0.5 and countries[country]["admin2"]:
+            admin2 = quote(rng.choice(countries[country]["admin2"]))
+            targets.append(
+                f"/phase?country={country}&admin2={admin2}&from={rng.choice(years)}-01"
+            )
+        elif kind < 0.75:
+            targets.append(
+                f"/triggers?country={country}&date={rng.choice(years)}-{rng.randint(1, 12):02d}"
+            )
+        else:
+            targets.append(
+                f"/population?country={country}&period={rng.choice(PERIOD_LIST)}&level={rng.choice(IPC_LEVELS)}"
+                f"&from={rng.choice(years)}"
+            )
+    return targets
+
+
+async def client(url, targets, latencies, use_etags):
+    """
+    Send the requests of one client one after the other over one connection, and append the latency per endpoint
+    """
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    etags = {}
+    try:
+        for target in targets:
+            start = time.perf_counter()
+            status, etag, _ = await request(
+                reader,
+                writer,
+                parts.netloc,
+                target,
+                etags.get(target) if use_etags else None,
+            )
+            latencies.setdefault(target.split("?")[0], []).append(
+                time.perf_counter() - start
+            )
+            if etag:
+                etags[target] = etag
+            if status not in (200, 304, 404):
+                logger.warning(f"{target} returned {status}")
+    finally:
+        writer.close()
+
+
+async def load_test(url, n_clients, n_requests, use_etags=False, seed=0):
+    """
+    Run n_clients concurrent clients that together send n_requests requests to the service at url
+    Returns:
+        latencies: dict with per endpoint the list of latencies in seconds
+        wall: wall time of the test in seconds
+    """
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    _, _, body = await request(reader, writer, parts.netloc, "/")
+    writer.close()
+    targets = query_mix(json.loads(body), n_requests, seed)
+    latencies = {}
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            client(url, targets[i::n_clients], latencies, use_etags)
+            for i in range(n_clients)
+        ]
+    )
+    return latencies, time.perf_counter() - start
+
+
+def print_latencies(latencies, wall):
+    """
+    Print the number of requests and the p50, p90, p99 and maximum latency per endpoint and over all requests
+    """
+    rows = list(latencies.items()) + [
+        ("all", [t for times in latencies.values() for t in times])
+    ]
+    n_total = len(rows[-1][1])
+    print(f"{n_total} requests in {wall:.2f}s, {n_total / wall:.0f} requests/s")
+    print(
+        f"{'endpoint':<14}{'n':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for endpoint, times in rows:
+        ms = np.array(times) * 1000
+        print(
+            f"{endpoint:<14}{len(ms):>8}{np.percentile(ms, 50):>10.2f}{np.percentile(ms, 90):>10.2f}"
+            f"{np.percentile(ms, 99):>10.2f}{ms.max():>10.2f}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the latency of serve_results.py under concurrent clients"
+    )
+    parser.add_argument(
+        "--url", default="http://127.0.0.1:8000", help="Address of the service"
+    )
+    parser.add_argument(
+        "-c", "--clients", type=int, default=50, help="Number of concurrent clients"
+    )
+    parser.add_argument(
+        "-n", "--requests", type=int, default=5000, help="Total number of requests"
+    )
+    parser.add_argument(
+        "--etags",
+        action="store_true",
+        help="Send the ETag of an earlier response to the same query in If-None-Match, as a polling dashboard does",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config_logger(level="info")
+    latencies, wall = asyncio.run(
+        load_test(args.url, args.clients, args.requests, args.etags)
+    )
+    print_latencies(latencies, wall)
@@ -0,0 +1,491 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import logging
+
+# the pipeline scripts are top-level modules of the repository
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from utils import config_logger  # noqa: E402
+import process_fewsnet  # noqa: E402
+import process_fewsnet_worldpop  # noqa: E402
+import IPC_computetrigger  # noqa: E402
+import spatial_lookup  # noqa: E402
+import synthetic  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PATH = Path(__file__).resolve().parent / "history.json"
+# number of random points of the spatial_lookup scenario
+N_LOOKUP_POINTS = 1000000
+# number of lowest level admins and FewsNet dates per size tier, and the lowest admin level if not admin2
+TIERS = {
+    "small": {"n_admin": 100, "n_dates": 10},
+    "medium": {"n_admin": 1000, "n_dates": 50},
+    "large": {"n_admin": 10000, "n_dates": 200},
+    # about the 1,080 woredas of Ethiopia and the 43 FewsNet dates in config.yml
+    "admin3": {"n_admin": 1100, "n_dates": 43, "levels": 3},
+}
+
+
+def setup_fewsnet(ds, period="CS"):
+    return process_fewsnet.shapefiles_to_df(
+        ds["fewsnet_path"],
+        period,
+        ds["fewsnet_dates"],
+        ds["region"],
+        ds["regioncode"],
+        ds["iso2_code"],
+    )
+
+
+def setup_overlap(ds, period="CS"):
+    overlap = process_fewsnet.merge_admin2(
+        setup_fewsnet(ds, period),
+        ds["admin_paths"][2],
+        period,
+        ds["shp_adm0c"],
+        ds["shp_adm1c"],
+        ds["shp_adm2c"],
+    )
+    overlap.loc[overlap[period] >= 5, period] = 0
+    return overlap
+
+
+def run_shapefiles_to_df(ds, _):
+    return setup_fewsnet(ds)
+
+
+def run_merge_admin2(ds, df):
+    return process_fewsnet.merge_admin2(
+        df,
+        ds["admin_paths"][2],
+        "CS",
+        ds["shp_adm0c"],
+        ds["shp_adm1c"],
+        ds["shp_adm2c"],
+    )
+
+
+def run_return_max_cs(ds, overlap):
+    # same loop as gen_csml1m2 does without the crosswalk
+    adm1c, adm2c = ds["shp_adm1c"], ds["shp_adm2c"]
+    rows = []
+    df_adm12c = overlap[[adm1c, adm2c]].drop_duplicates()
+    for d in overlap["date"].unique():
+        for _, a in df_adm12c.iterrows():
+            rows.append(
+                process_fewsnet.return_max_cs(
+                    d, overlap, a, "CS", ds["shp_adm0c"], adm1c, adm2c
+                )
+            )
+    return rows
+
+
+def run_crosswalk_max_cs(ds, df):
+    return process_fewsnet.crosswalk_max_cs(
+        df,
+        ds["admin_paths"][2],
+        "CS",
+        ds["shp_adm0c"],
+        ds["shp_adm1c"],
+        ds["shp_adm2c"],
+    )
+
+
+def run_population_max_cs(ds, df):
+    return process_fewsnet.population_max_cs(
+        df,
+        ds["admin_paths"][2],
+        "CS",
+        ds["shp_adm0c"],
+        ds["shp_adm1c"],
+        ds["shp_adm2c"],
+        ds["pop_paths"],
+    )
+
+
+def fewsnet_population_args(ds):
+    d = ds["fewsnet_dates"][0]
+    return (
+        f"{ds['fewsnet_path']}{ds['region']}{d}/{ds['regioncode']}_{d}_CS.shp",
+        ds["admin_paths"][2],
+        ds["pop_paths"][int(d[:4])],
+        d,
+        "CS",
+        ds["shp_adm1c"],
+        ds["shp_adm2c"],
+    )
+
+
+def run_zonal_stats(ds, _):
+    # population per phase of one date, with the overlay and zonal_stats per fragment
+    return process_fewsnet_worldpop.merge_fewsnet_population(
+        *fewsnet_population_args(ds)
+    )
+
+
+def run_crosswalk_population(ds, _):
+    return process_fewsnet_worldpop.merge_fewsnet_population(
+        *fewsnet_population_args(ds), use_crosswalk=True
+    )
+
+
+def run_compute_trigger(ds, df):
+    return IPC_computetrigger.compute_trigger(
+        IPC_computetrigger.add_columns(df.copy(), "FewsNet")
+    )
+
+
+def setup_country(ds):
+    """
+    Link the country folder, the FewsNet files and the national population of the dataset into the working directory,
+    where process_fewsnet.main expects them
+    """
+    Path("Data").mkdir(exist_ok=True)
+    for target in [
+        ds["country_name"],
+        "Data/FewsNetRaw",
+        "Data/Worldbank_TotalPopulation.csv",
+    ]:
+        os.symlink(Path(ds["folder"]) / target, target)
+
+
+def run_process_fewsnet_admin3(ds, _):
+    # the full FewsNet processing per admin3, including the population and the aggregation to admin2 and admin1
+    return process_fewsnet.main(
+        synthetic.ISO3_CODE, "", config_file=ds["config_path"], admin_level=3
+    )[0]
+
+
+def setup_spatial_index(ds):
+    return spatial_lookup.build_index(
+        ds["admin_paths"][2],
+        [ds["shp_adm0c"], ds["shp_adm1c"], ds["shp_adm2c"]],
+        spatial_lookup.fewsnet_layer_paths(
+            ds["fewsnet_path"],
+            ds["fewsnet_dates"],
+            ds["region"],
+            ds["regioncode"],
+            ds["iso2_code"],
+        ),
+    )
+
+
+def run_spatial_lookup(ds, index):
+    # random points over the synthetic country, each at a random FewsNet date
+    rng = np.random.default_rng(0)
+    minx, miny, maxx, maxy = synthetic.BOUNDS
+    return spatial_lookup.lookup_points(
+        index,
+        rng.uniform(minx, maxx, N_LOOKUP_POINTS),
+        rng.uniform(miny, maxy, N_LOOKUP_POINTS),
+        rng.choice(ds["fewsnet_dates"], N_LOOKUP_POINTS),
+    )
+
+
+# per scenario the function to time, the untimed setup that prepares its input, and the largest tier the scenario is
+# run for (n_admin x n_dates), since the slowest implementations would take hours on the large tier. Scenarios with
+# levels only run for tiers with admin boundaries down to that level
+SCENARIOS = {
+    "shapefiles_to_df": {"run": run_shapefiles_to_df, "setup": None, "max_size": None},
+    "merge_admin2": {"run": run_merge_admin2, "setup": setup_fewsnet, "max_size": None},
+    "return_max_cs": {
+        "run": run_return_max_cs,
+        "setup": setup_overlap,
+        "max_size": 1000,
+    },
+    "crosswalk_max_cs": {
+        "run": run_crosswalk_max_cs,
+        "setup": setup_fewsnet,
+        "max_size": None,
+    },
+    "population_max_cs": {
+        "run": run_population_max_cs,
+        "setup": setup_fewsnet,
+        "max_size": None,
+    },
+    "zonal_stats": {"run": run_zonal_stats, "setup": None, "max_size": None},
+    "crosswalk_population": {
+        "run": run_crosswalk_population,
+        "setup": None,
+        "max_size": None,
+    },
+    "compute_trigger": {
+        "run": run_compute_trigger,
+        "setup": lambda ds: synthetic.trigger_input(
+            ds["n_admin"] // 10, ds["fewsnet_dates"]
+        ),
+        "max_size": None,
+    },
+    "spatial_lookup": {
+        "run": run_spatial_lookup,
+        "setup": setup_spatial_index,
+        "max_size": None,
+    },
+    "process_fewsnet_admin3": {
+        "run": run_process_fewsnet_admin3,
+        "setup": setup_country,
+        "max_size": None,
+        "levels": 3,
+    },
+}
+
+
+def result_size(result):
+    """
+    Return the number of rows of the output of a scenario
+    """
+    if result is None:
+        return 0
+    return len(result)
+
+
+def time_scenario(name, ds, workdir, repeats):
+    """
+    Time one scenario on the dataset ds
+    Every repeat runs in a new working directory, such that the caches the pipeline writes to Data/ are empty and each
+    repeat measures a cold run
+    Args:
+        name: name of the scenario in SCENARIOS
+        ds: dict with the paths and parameters of the synthetic dataset
+        workdir: directory in which the working directories of the repeats are created
+        repeats: number of times the scenario is run
+
+    Returns:
+        dict with the minimum and median wall time in seconds, all timings and the number of output rows
+    """
+    scenario = SCENARIOS[name]
+    cwd = os.getcwd()
+    timings = []
+    try:
+        for i in range(repeats):
+            run_dir = Path(workdir) / f"{name}_{i}"
+            run_dir.mkdir(parents=True, exist_ok=True)
+            os.chdir(run_dir)
+            data = scenario["setup"](ds) if scenario["setup"] else None
+            start = time.perf_counter()
+            result = scenario["run"](ds, data)
+            timings.append(time.perf_counter() - start)
+    finally:
+        os.chdir(cwd)
+    return {
+        "min": min(timings),
+        "median": float(np.median(timings)),
+        "timings": timings,
+        "rows": result_size(result),
+    }
+
+
+def git_commit():
+    """
+    Return the current commit of the repository and whether there are uncommitted changes
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=REPO_DIR,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def load_history(history_path=HISTORY_PATH):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, "r") as f:
+        return json.load(f)
+
+
+def run_benchmarks(
+    tiers, scenarios, repeats=3, data_dir=None, history_path=HISTORY_PATH
+):
+    """
+    Run the scenarios for every tier on a synthetic dataset, and append the results to the history
+    Args:
+        tiers: names of the tiers in TIERS
+        scenarios: names of the scenarios in SCENARIOS
+        repeats: number of times each scenario is timed
+        data_dir: directory in which the synthetic datasets are written and kept. If None a temporary directory is used
+        history_path: path to the json file with the results of previous runs
+
+    Returns:
+        run: dict with the metadata and results of this run
+    """
+    commit, dirty = git_commit()
+    run = {
+        "run_id": datetime.now().strftime("%Y%m%dT%H%M%S"),
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": repeats,
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for tier in tiers:
+            size = TIERS[tier]
+            tier_dir = Path(data_dir or tmp_dir) / tier
+            if (tier_dir / "dataset.json").exists():
+                with open(tier_dir / "dataset.json", "r") as f:
+                    ds = json.load(f)
+                ds["pop_paths"] = {int(y): p for y, p in ds["pop_paths"].items()}
+                ds["admin_paths"] = {int(l): p for l, p in ds["admin_paths"].items()}
+            else:
+                ds = synthetic.write_dataset(tier_dir.resolve(), **size)
+                ds["n_admin"] = size["n_admin"]
+                with open(tier_dir / "dataset.json", "w") as f:
+                    json.dump(ds, f, indent=2)
+            for name in scenarios:
+                max_size = SCENARIOS[name]["max_size"]
+                if (
+                    max_size is not None
+                    and size["n_admin"] * size["n_dates"] > max_size
+                ) or SCENARIOS[name].get("levels", 2) > size.get("levels", 2):
+                    logger.info(f"Skipping {name} for the {tier} tier")
+                    continue
+                logger.info(f"Timing {name} for the {tier} tier")
+                result = time_scenario(name, ds, Path(tmp_dir) / "runs" / tier, repeats)
+                result.update(scenario=name, tier=tier, **size)
+                run["results"][f"{name}|{tier}"] = result
+                logger.info(f"{name} {tier}: {result['median']:.2f}s")
+
+    history = load_history(history_path)
+    history.append(run)
+    with open(history_path, "w") as f:
+        json.dump(history, f, indent=2)
+    return run
+
+
+def find_run(history, ref):
+    """
+    Return the most recent run in history of which the run id or commit starts with ref
+    """
+    for run in reversed(history):
+        if run["run_id"].startswith(ref) or (run["commit"] or "").startswith(ref):
+            return run
+    raise ValueError(f"No benchmark run found for {ref}")
+
+
+def compare_runs(base, new, threshold=0.1):
+    """
+    Print the median timings of two runs side by side, and flag the scenarios that are more than threshold slower in new
+    Args:
+        base: run to compare to
+        new: run to compare
+        threshold: relative slowdown from which a scenario is flagged as regression
+
+    Returns:
+        regressions: list with the keys (scenario|tier) of the scenarios that became slower
+    """
+    print(
+        f"{'scenario':<22}{'tier':<8}{base['commit'] or base['run_id']:>12}"
+        f"{new['commit'] or new['run_id']:>12}{'ratio':>8}"
+    )
+    regressions = []
+    for key in sorted(set(base["results"]) & set(new["results"])):
+        scenario, tier = key.split("|")
+        t_base = base["results"][key]["median"]
+        t_new = new["results"][key]["median"]
+        ratio = t_new / t_base if t_base > 0 else float("nan")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(
+            f"{scenario:<22}{tier:<8}{t_base:>11.2f}s{t_new:>11.2f}s{ratio:>8.2f}{flag}"
+        )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline stages on synthetic data, or compare earlier benchmark runs"
+    )
+    parser.add_argument(
+        "-t",
+        "--tiers",
+        default="small",
+        help=f"Comma separated size tiers to run, out of {','.join(TIERS)}",
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help="Comma separated scenarios to run, by default all",
+    )
+    parser.add_argument(
+        "-r", "--repeats", type=int, default=3, help="Number of timed runs per scenario"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="Directory to keep the synthetic datasets in, such that they are not generated again in the next run",
+    )
+    parser.add_argument(
+        "--history",
+        default=str(HISTORY_PATH),
+        help="Path to the json history of the runs",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="*",
+        metavar="REF",
+        help="Compare two runs, given by commit or run id, instead of running the benchmarks. "
+        "Without references the last two runs are compared, with one reference the last run is compared to it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown from which a scenario is reported as regression",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config_logger(level="info")
+    if args.compare is not None:
+        history = load_history(args.history)
+        if len(args.compare) == 2:
+            base, new = [find_run(history, ref) for ref in args.compare]
+        elif len(args.compare) == 1:
+            base, new = find_run(history, args.compare[0]), history[-1]
+        else:
+            if len(history) < 2:
+                raise ValueError(
+                    "At least two benchmark runs are needed for a comparison"
+                )
+            base, new = history[-2], history[-1]
+        regressions = compare_runs(base, new, args.threshold)
+        sys.exit(1 if regressions else 0)
+    run_benchmarks(
+        args.tiers.split(","),
+        args.scenarios.split(","),
+        args.repeats,
+        args.data_dir,
+        args.history,
+    )
@@ -0,0 +1,326 @@
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import os
+import shutil
+import rasterio
+import yaml
+from rasterio.transform import from_origin
+from scipy.spatial import Voronoi
+from shapely.geometry import Polygon, box
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# extent of the synthetic country in degrees (minx, miny, maxx, maxy), roughly the size of Ethiopia
+BOUNDS = (33.0, 3.0, 48.0, 15.0)
+# resolution of the synthetic WorldPop rasters, same as the 1km WorldPop products
+POP_RESOLUTION = 1 / 120
+# column names of the synthetic admin layers, same as the HDX shapefiles in config.yml
+ADMIN_COLUMNS = ["ADM0_EN", "ADM1_EN", "ADM2_EN", "ADM3_EN"]
+# synthetic FewsNet region, with the same folder layout as the files published by FewsNet
+REGION = "synthetic-africa"
+REGIONCODE = "SY"
+ISO2_CODE = "SY"
+ISO3_CODE = "SYN"
+COUNTRY_NAME = "synthetica"
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+
+
+def voronoi_polygons(n, bounds=BOUNDS, seed=0):
+    """
+    Return n Voronoi polygons that tile the rectangle bounds without gaps or overlaps
+    The seed points are mirrored over the four edges of the rectangle, such that all cells of the original points are finite
+    and the edges of the rectangle are edges of the cells
+    Args:
+        n: number of polygons
+        bounds: (minx, miny, maxx, maxy) of the rectangle
+        seed: seed of the random generator, the same seed gives the same polygons
+
+    Returns:
+        polygons: list of shapely Polygons
+        points: (n x 2) array with the seed point of each polygon
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    points = np.column_stack([rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)])
+    mirrored = [
+        points,
+        np.column_stack([2 * minx - points[:, 0], points[:, 1]]),
+        np.column_stack([2 * maxx - points[:, 0], points[:, 1]]),
+        np.column_stack([points[:, 0], 2 * miny - points[:, 1]]),
+        np.column_stack([points[:, 0], 2 * maxy - points[:, 1]]),
+    ]
+    vor = Voronoi(np.concatenate(mirrored))
+    extent = box(*bounds)
+    polygons = []
+    for i in range(n):
+        region = vor.regions[vor.point_region[i]]
+        # intersection only removes floating point noise at the edges of the rectangle
+        polygons.append(Polygon(vor.vertices[region]).intersection(extent))
+    return polygons, points
+
+
+def admin_layers(n_admin, levels=2, bounds=BOUNDS, seed=0):
+    """
+    Generate nested admin layers, where the lowest level has n_admin Voronoi polygons
+    Every higher level has about ten times fewer polygons. Its seed points are a sample of the seed points of the level below,
+    and each polygon of the level below is merged into the closest of them, such that the levels are nested as in real admin boundaries
+    Args:
+        n_admin: number of polygons of the lowest admin level
+        levels: lowest admin level, 1, 2 or 3
+        bounds: (minx, miny, maxx, maxy) of the country
+        seed: seed of the random generator
+
+    Returns:
+        layers: dict with per admin level a GeoDataFrame in EPSG:4326, with the names of the admin0 up to that level
+    """
+    polygons, points = voronoi_polygons(n_admin, bounds, seed)
+    df = gpd.GeoDataFrame(geometry=polygons, crs="EPSG:4326")
+    df[ADMIN_COLUMNS[0]] = "Synthetica"
+    df[ADMIN_COLUMNS[levels]] = [f"Adm{levels}_{i:05d}" for i in range(n_admin)]
+    rng = np.random.default_rng(seed + 1)
+    # label of the lowest level polygons at the current level, and the seed points of the current level
+    label = np.arange(n_admin)
+    seeds = points
+    for level in range(levels - 1, 0, -1):
+        upper = seeds[rng.choice(len(seeds), max(2, len(seeds) // 10), replace=False)]
+        dist = ((seeds[:, None, :] - upper[None, :, :]) ** 2).sum(axis=2)
+        label = dist.argmin(axis=1)[label]
+        seeds = upper
+        df[ADMIN_COLUMNS[level]] = [f"Adm{level}_{i:05d}" for i in label]
+    layers = {levels: df}
+    for level in range(levels - 1, 0, -1):
+        layers[level] = df.dissolve(by=ADMIN_COLUMNS[: level + 1], as_index=False)[
+            ADMIN_COLUMNS[: level + 1] + ["geometry"]
+        ]
+    return layers
+
+
+def fewsnet_layers(n_polygons, dates, bounds=BOUNDS, seed=0, new_geometry_every=4):
+    """
+    Generate FewsNet-like layers with an IPC phase per polygon for every date and period
+    The polygons cover a slightly larger area than the country, as the regional FewsNet files do. As the livelihood zones FewsNet
+    uses, the geometries stay the same over several dates, while the phases follow a random walk over time.
+    About 2% of the polygons get the values 88 and 99, which FewsNet uses for parks and lakes and missing data.
+    Args:
+        n_polygons: number of polygons per layer
+        dates: list of dates in the format YYYYMM
+        bounds: (minx, miny, maxx, maxy) of the country
+        seed: seed of the random generator
+        new_geometry_every: number of dates after which new geometries are generated
+
+    Returns:
+        layers: dict with per (date, period) a GeoDataFrame in EPSG:4326 with the phase in the column named after the period
+    """
+    minx, miny, maxx, maxy = bounds
+    margin = 0.05 * max(maxx - minx, maxy - miny)
+    fews_bounds = (minx - margin, miny - margin, maxx + margin, maxy + margin)
+    rng = np.random.default_rng(seed + 2)
+    layers = {}
+    polygons = None
+    phases = None
+    for i, d in enumerate(dates):
+        if i % new_geometry_every == 0:
+            polygons, _ = voronoi_polygons(n_polygons, fews_bounds, seed + 3 + i)
+            phases = rng.integers(1, 5, n_polygons)
+        phases = np.clip(phases + rng.integers(-1, 2, n_polygons), 1, 4)
+        for period in PERIOD_LIST:
+            values = np.clip(phases + rng.integers(0, 2, n_polygons), 1, 5)
+            missing = rng.random(n_polygons) < 0.02
+            values[missing] = rng.choice([88, 99], missing.sum())
+            layers[(d, period)] = gpd.GeoDataFrame(
+                {period: values.astype(float)}, geometry=polygons, crs="EPSG:4326"
+            )
+    return layers
+
+
+def population_raster(path, bounds=BOUNDS, resolution=POP_RESOLUTION, seed=0):
+    """
+    Write a WorldPop-like GeoTIFF to path, with a lognormal population per cell, a few dense cities and nodata cells for lakes
+    Args:
+        path: path of the GeoTIFF
+        bounds: (minx, miny, maxx, maxy) of the raster
+        resolution: size of a cell in degrees
+        seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed + 4)
+    minx, miny, maxx, maxy = bounds
+    width = int(round((maxx - minx) / resolution))
+    height = int(round((maxy - miny) / resolution))
+    pop = rng.lognormal(mean=2, sigma=1.5, size=(height, width)).astype("float32")
+    for _ in range(20):
+        row, col = rng.integers(0, height), rng.integers(0, width)
+        pop[max(0, row - 10) : row + 10, max(0, col - 10) : col + 10] *= 50
+    # WorldPop uses -99999 as nodata
+    pop[rng.random((height, width)) < 0.01] = -99999
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(minx, maxy, resolution, resolution),
+        nodata=-99999,
+        compress="lzw",
+    ) as dst:
+        dst.write(pop, 1)
+
+
+def admin_population(df_admin, seed=0):
+    """
+    Return a DataFrame with a random population per admin of df_admin, in the format of the HDX population csvs
+    """
+    rng = np.random.default_rng(seed + 6)
+    df_pop = pd.DataFrame(df_admin.drop(columns="geometry"))
+    df_pop["Total"] = rng.integers(10_000, 1_000_000, len(df_pop))
+    return df_pop
+
+
+def national_population(years, total, seed=0):
+    """
+    Return the lines of a csv in the format of Data/Worldbank_TotalPopulation.csv, with the national population of the
+    synthetic country growing about 2.5% per year from total in the first year
+    """
+    rng = np.random.default_rng(seed + 7)
+    growth = np.cumprod(np.r_[1, rng.uniform(1.02, 1.03, len(years) - 1)])
+    header = ["Country Name", "Country Code", "Indicator Name", "Indicator Code"]
+    row = [COUNTRY_NAME.capitalize(), ISO3_CODE, "Population, total", "SP.POP.TOTL"]
+    return [
+        '"Data Source","Synthetic",',
+        "",
+        '"Last Updated Date","2020-07-01",',
+        "",
+        ",".join(f'"{c}"' for c in header + [str(y) for y in years]) + ",",
+        ",".join(f'"{c}"' for c in row + [str(int(total * g)) for g in growth]) + ",",
+    ]
+
+
+def trigger_input(n_admin, dates, seed=0):
+    """
+    Generate a DataFrame with the columns that IPC_computetrigger.add_columns expects, for n_admin admins and every date
+    """
+    rng = np.random.default_rng(seed + 5)
+    n = n_admin * len(dates)
+    df = pd.DataFrame(
+        {
+            "date": np.repeat(pd.to_datetime(dates, format="%Y%m"), n_admin),
+            "ADMIN1": np.tile([f"Adm1_{i:05d}" for i in range(n_admin)], len(dates)),
+        }
+    )
+    for period in PERIOD_LIST:
+        share = rng.dirichlet(np.ones(5), n)
+        pop = rng.integers(10_000, 2_000_000, n)
+        for i in range(1, 6):
+            df[f"{period}_{i}"] = share[:, i - 1] * pop
+        df[f"pop_{period}"] = pop
+    return df
+
+
+def write_dataset(folder, n_admin, n_dates, levels=2, n_fewsnet=None, seed=0):
+    """
+    Write a complete synthetic dataset to folder, with the same layout as the real data
+    Args:
+        folder: directory to write to, e.g. a temporary directory
+        n_admin: number of polygons of the lowest admin level
+        n_dates: number of FewsNet dates, spaced by four months starting in 2009
+        levels: lowest admin level, 1, 2 or 3
+        n_fewsnet: number of polygons per FewsNet layer, by default a fifth of n_admin with a minimum of 10
+        seed: seed of the random generator
+
+    Returns:
+        dataset: dict with the paths and parameters of the dataset, with the keys of a country in config.yml where those apply
+    """
+    folder = Path(folder)
+    n_fewsnet = n_fewsnet or max(10, n_admin // 5)
+    months = pd.date_range("2009-07-01", periods=n_dates, freq="4MS")
+    dates = [m.strftime("%Y%m") for m in months]
+
+    admin_folder = folder / COUNTRY_NAME / "Data" / "admin"
+    admin_folder.mkdir(parents=True, exist_ok=True)
+    admin_paths = {}
+    layers = admin_layers(n_admin, levels, seed=seed)
+    for level, df in layers.items():
+        admin_paths[level] = str(admin_folder / f"syn_admbnda_adm{level}.shp")
+        df.to_file(admin_paths[level])
+
+    fewsnet_folder = folder / "Data" / "FewsNetRaw"
+    for (d, period), df in fewsnet_layers(n_fewsnet, dates, seed=seed).items():
+        date_folder = fewsnet_folder / f"{REGION}{d}"
+        date_folder.mkdir(parents=True, exist_ok=True)
+        df.to_file(date_folder / f"{REGIONCODE}_{d}_{period}.shp")
+
+    pop_folder = folder / COUNTRY_NAME / "Data" / "WorldPop"
+    pop_folder.mkdir(parents=True, exist_ok=True)
+    pop_paths = {}
+    for year in sorted({int(d[:4]) for d in dates}):
+        pop_paths[year] = str(
+            pop_folder / f"{ISO3_CODE.lower()}_ppp_{year}_1km_Aggregated_UNadj.tif"
+        )
+        if len(pop_paths) == 1:
+            population_raster(pop_paths[year], seed=seed)
+            first_path = pop_paths[year]
+        else:
+            # WorldPop rasters of different years are very similar, so all years share the raster of the first year
+            # which saves disk space for the tiers with many dates
+            try:
+                os.link(first_path, pop_paths[year])
+            except OSError:
+                shutil.copyfile(first_path, pop_paths[year])
+
+    # the population is published per admin2 (or admin1), as in the config of the real countries
+    pop_path = folder / COUNTRY_NAME / "Data" / f"syn_admpop_adm{min(levels, 2)}.csv"
+    df_pop = admin_population(layers[min(levels, 2)], seed)
+    df_pop.to_csv(pop_path, index=False)
+    years = list(range(int(dates[0][:4]), int(dates[-1][:4]) + 1))
+    with open(folder / "Data" / "Worldbank_TotalPopulation.csv", "w") as f:
+        f.write("\n".join(national_population(years, df_pop["Total"].sum(), seed)))
+    config = {
+        ISO3_CODE: {
+            "country_name": COUNTRY_NAME,
+            "iso2_code": ISO2_CODE,
+            "region": REGION,
+            "regioncode": REGIONCODE,
+            **{
+                f"path_admin{level}_shp": os.path.relpath(
+                    path, folder / COUNTRY_NAME / "Data"
+                )
+                for level, path in admin_paths.items()
+            },
+            "fewsnet_dates": dates,
+            **{f"shp_adm{i}c": c for i, c in enumerate(ADMIN_COLUMNS)},
+            "pop_filename": pop_path.name,
+            "pop_col": "Total",
+            "adm1c_pop": ADMIN_COLUMNS[1],
+            "adm2c_pop": ADMIN_COLUMNS[2],
+            "admin1_mapping": {},
+            "admin2_mapping": {},
+        }
+    }
+    with open(folder / "config.yml", "w") as f:
+        yaml.safe_dump(config, f)
+
+    logger.info(
+        f"Wrote synthetic dataset with {n_admin} admin{levels}s, {n_fewsnet} FewsNet polygons and {n_dates} dates to {folder}"
+    )
+    return {
+        "folder": str(folder),
+        "config_path": str(folder / "config.yml"),
+        "country_name": COUNTRY_NAME,
+        "fewsnet_path": f"{fewsnet_folder}/",
+        "admin_paths": admin_paths,
+        "pop_paths": pop_paths,
+        "fewsnet_dates": dates,
+        "region": REGION,
+        "regioncode": REGIONCODE,
+        "iso2_code": ISO2_CODE,
+        "shp_adm0c": ADMIN_COLUMNS[0],
+        "shp_adm1c": ADMIN_COLUMNS[1],
+        "shp_adm2c": ADMIN_COLUMNS[2],
+        "shp_adm3c": ADMIN_COLUMNS[3],
+        "levels": levels,
+    }
@@ -0,0 +1,156 @@
+import geopandas as gpd
+import numpy as np
+import os
+from scipy import sparse
+from geometries import geometry_key, raster_key
+from raster_utils import parallel_zonal_sums
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# directory where the admin x FewsNet crosswalks are saved
+CROSSWALK_CACHE_DIR = "Data/Crosswalk/"
+# crs in meters, same as used for the areas in process_fewsnet.merge_admin2
+AREA_CRS = "EPSG:3395"
+
+
+def build_fragments(df_adm, df_fews):
+    """
+    Overlay the admin and FewsNet layer, where each resulting fragment is one admin - FewsNet polygon combination
+    Args:
+        df_adm: GeoDataFrame with the admin boundaries
+        df_fews: GeoDataFrame with the FewsNet polygons
+
+    Returns:
+        df_frag: GeoDataFrame with per fragment the position of the admin (adm_id) and FewsNet polygon (fews_id) and the area in m2
+    """
+    adm = gpd.GeoDataFrame(
+        {"adm_id": np.arange(len(df_adm))},
+        geometry=df_adm.geometry.values,
+        crs=df_adm.crs,
+    )
+    fews = gpd.GeoDataFrame(
+        {"fews_id": np.arange(len(df_fews))},
+        geometry=df_fews.geometry.values,
+        crs=df_fews.crs,
+    )
+    df_frag = gpd.overlay(adm, fews, how="intersection")
+    df_frag["area"] = df_frag["geometry"].to_crs(AREA_CRS).area
+    return df_frag
+
+
+def fragments_to_matrix(df_frag, values, n_adm, n_fews):
+    """
+    Return a sparse (admin x FewsNet polygon) matrix with the given values of the fragments
+    """
+    return sparse.csr_matrix(
+        (
+            np.nan_to_num(np.asarray(values, dtype=float)),
+            (df_frag["adm_id"].to_numpy(), df_frag["fews_id"].to_numpy()),
+        ),
+        shape=(n_adm, n_fews),
+    )
+
+
+def load_crosswalk(df_adm, df_fews, pop_path=None, cache_dir=CROSSWALK_CACHE_DIR):
+    """
+    Return the crosswalk between the admin and FewsNet layer, which is computed once per distinct set of geometries
+    The crosswalk holds sparse (admin x FewsNet polygon) matrices with the intersection area and, if pop_path is given,
+    the population of the intersection. The rows follow the order of df_adm and the columns the order of df_fews.
+    The overlay is only done when the combination of geometries has not been seen before, the population matrix
+    only when it was not computed before for the raster in pop_path.
+    Args:
+        df_adm: GeoDataFrame with the admin boundaries
+        df_fews: GeoDataFrame with the FewsNet polygons
+        pop_path: path to the raster file with population data
+        cache_dir: directory where the crosswalks are saved
+
+    Returns:
+        crosswalk: dict with the "area" and "pop" matrices. "pop" is None if no pop_path is given
+    """
+    key = f"{geometry_key(df_adm)}_{geometry_key(df_fews)}"
+    area_path = f"{cache_dir}{key}_area.npz"
+    frag_path = f"{cache_dir}{key}_fragments.gpkg"
+    shape = (len(df_adm), len(df_fews))
+    df_frag = None
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    if os.path.exists(area_path):
+        area = sparse.load_npz(area_path).tocsr()
+    else:
+        df_frag = build_fragments(df_adm, df_fews)
+        area = fragments_to_matrix(df_frag, df_frag["area"], *shape)
+        # fragments are saved such that population of later rasters can be added without redoing the overlay
+        df_frag.to_file(frag_path, driver="GPKG")
+        sparse.save_npz(area_path, area)
+
+    pop = None
+    if pop_path is not None:
+        pop_cache_path = f"{cache_dir}{key}_pop_{raster_key(pop_path)}.npz"
+        if os.path.exists(pop_cache_path):
+            pop = sparse.load_npz(pop_cache_path).tocsr()
+        else:
+            if df_frag is None:
+                df_frag = gpd.read_file(frag_path)
+            # same rasterization strategy as in process_fewsnet_worldpop, a cell belongs to a fragment if its center is inside
+            frag_pop = parallel_zonal_sums(df_frag["geometry"], pop_path)
+            pop = fragments_to_matrix(df_frag, frag_pop, *shape)
+            sparse.save_npz(pop_cache_path, pop)
+    return {"area": area, "pop": pop}
+
+
+def phase_onehot(phases):
+    """
+    Return the sorted unique phase values and a sparse one-hot (FewsNet polygon x phase value) matrix
+    """
+    values, inverse = np.unique(np.asarray(phases, dtype=int), return_inverse=True)
+    onehot = sparse.csr_matrix(
+        (np.ones(len(inverse)), (np.arange(len(inverse)), inverse)),
+        shape=(len(inverse), len(values)),
+    )
+    return values, onehot
+
+
+def phase_totals(matrix, phases):
+    """
+    Sum the values of matrix (e.g. population) per admin and phase
+    Args:
+        matrix: sparse (admin x FewsNet polygon) matrix from the crosswalk
+        phases: phase value of each FewsNet polygon
+
+    Returns:
+        values: phase values, corresponding to the columns of totals
+        totals: (admin x phase value) array
+    """
+    values, onehot = phase_onehot(phases)
+    return values, (matrix @ onehot).toarray()
+
+
+def dominant_phase(area, phases, valid_phases=(1, 2, 3, 4)):
+    """
+    Return per admin the phase of the FewsNet polygon that covers the largest area of the admin, as in process_fewsnet.return_max_cs
+    Polygons with a phase in valid_phases are preferred over polygons with other values, even if those cover a larger area.
+    Args:
+        area: sparse (admin x FewsNet polygon) matrix with intersection areas
+        phases: phase value of each FewsNet polygon
+        valid_phases: phase values that are preferred
+
+    Returns:
+        phase: per admin the phase, 0 if only polygons with other values intersect, nan if the admin has no intersection
+    """
+    area = area.tocsr()
+    area.eliminate_zeros()
+    phases = np.asarray(phases, dtype=float)
+    rows = np.repeat(np.arange(area.shape[0]), np.diff(area.indptr))
+    entry_phase = phases[area.indices]
+    valid = np.isin(entry_phase, valid_phases)
+    # valid phases always score above any other value
+    score = area.data + valid * (area.data.max(initial=0) + 1)
+    # sort on row, and within a row on descending score, the first entry per row is then the largest
+    order = np.lexsort((-score, rows))
+    adm_ids, first = np.unique(rows[order], return_index=True)
+    best = order[first]
+    phase = np.full(area.shape[0], np.nan)
+    phase[adm_ids] = np.where(valid[best], entry_phase[best], 0)
+    return phase
@@ -0,0 +1,286 @@
+import pandas as pd
+import numpy as np
+from schema import month_start
+from utils import (
+    parse_args,
+    parse_yaml,
+    config_logger,
+    timed,
+    timed_stage,
+    frame_counts,
+    run_report,
+    profile_run,
+)
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# months after the FewsNet analysis at which the projection period ends. ML1 covers the first ~4 months after the
+# analysis and ML2 the ~4 months after that, so they are compared with the CS at the end of their projection period
+HORIZON_MONTHS = {"ML1": 4, "ML2": 8}
+IPC_PHASES = [1, 2, 3, 4, 5]
+
+
+def valid_phase(values):
+    """
+    Return the IPC phases as float, with values that are not a phase between 1 and 5 (e.g. 0 or 99) as nan
+    """
+    values = pd.to_numeric(values, errors="coerce").astype("float64")
+    return values.where(values.isin(IPC_PHASES))
+
+
+def _add_months(dates, months):
+    return (dates.dt.to_period("M") + months).dt.to_timestamp()
+
+
+@timed("align")
+def align_projections(
+    df, adm1c, adm2c, horizons=HORIZON_MONTHS, pop_col="adjusted_population"
+):
+    """
+    Align every ML1 and ML2 projection with the CS that was observed at the end of its projection period
+    The projection of an admin2 at date d is compared with the CS of the last analysis of that admin2 after d and on or before
+    d + horizon, found with a sorted as-of join over the dates of all admins and periods at once.
+    Projections of which the projection period ends after the last analysis are left out, since it is not known yet what materialized
+    Args:
+        df: DataFrame with per admin2 and date the CS, ML1 and ML2 phase, e.g. the admin2 output of process_fewsnet.py
+        adm1c: column name of the admin1 level name
+        adm2c: column name of the admin2 level name
+        horizons: dict with per projection period the months after the analysis at which the projection period ends
+        pop_col: column with the population of the admin2, used as weight. If not in df, all admins get the same weight
+
+    Returns:
+        df_aligned: DataFrame with per admin2, date and period the projected phase, the date and phase of the CS it is compared
+            with, the lead time in months, the error (projected - observed) and the population
+    """
+    keys = [adm1c, adm2c]
+    df = df[df["date"].notnull()].copy()
+    df["date"] = month_start(df["date"])
+    for c in keys:
+        df[c] = df[c].astype(object)
+    population = (
+        df[pop_col].astype("float64")
+        if pop_col in df.columns
+        else pd.Series(1.0, df.index)
+    )
+    df_proj = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    adm1c: df[adm1c],
+                    adm2c: df[adm2c],
+                    "date": df["date"],
+                    "period": period,
+                    "projected": valid_phase(df[period]),
+                    "population": population,
+                    "target_date": _add_months(df["date"], months),
+                }
+            )
+            for period, months in horizons.items()
+            if period in df.columns
+        ],
+        ignore_index=True,
+    )
+    df_cs = df[keys + ["date"]].assign(observed=valid_phase(df["CS"]))
+    df_cs = df_cs[df_cs["observed"].notnull()].rename(columns={"date": "cs_date"})
+    df_aligned = pd.merge_asof(
+        df_proj.sort_values("target_date"),
+        df_cs.sort_values("cs_date"),
+        left_on="target_date",
+        right_on="cs_date",
+        by=keys,
+        direction="backward",
+    )
+    df_aligned = df_aligned[
+        (df_aligned["cs_date"] > df_aligned["date"])
+        & (df_aligned["target_date"] <= df_cs["cs_date"].max())
+        & df_aligned["projected"].notnull()
+    ]
+    df_aligned = df_aligned.assign(
+        lead_months=(df_aligned["cs_date"].dt.year - df_aligned["date"].dt.year) * 12
+        + df_aligned["cs_date"].dt.month
+        - df_aligned["date"].dt.month,
+        error=df_aligned["projected"] - df_aligned["observed"],
+    )
+    return df_aligned.sort_values(["period", "date"] + keys).reset_index(drop=True)[
+        keys
+        + [
+            "date",
+            "period",
+            "projected",
+            "cs_date",
+            "observed",
+            "lead_months",
+            "error",
+            "population",
+        ]
+    ]
+
+
+def confusion_matrices(df_aligned, by=("period",)):
+    """
+    Return the confusion matrix of projected (rows) and observed (columns) IPC phases per group of by
+    The counts of all groups are computed with a single bincount over the combined group, projected and observed phase
+    """
+    by = list(by)
+    groups = df_aligned.groupby(by, sort=True).ngroup().to_numpy()
+    n_groups = groups.max() + 1 if len(groups) else 0
+    n_phases = len(IPC_PHASES)
+    cell = (
+        groups * n_phases**2
+        + (df_aligned["projected"].to_numpy().astype(int) - 1) * n_phases
+        + df_aligned["observed"].to_numpy().astype(int)
+        - 1
+    )
+    counts = np.bincount(cell, minlength=n_groups * n_phases**2).reshape(
+        n_groups * n_phases, n_phases
+    )
+    group_keys = df_aligned[by].drop_duplicates().sort_values(by)
+    index = pd.MultiIndex.from_tuples(
+        [
+            tuple(k) + (p,)
+            for k in group_keys.itertuples(index=False)
+            for p in IPC_PHASES
+        ],
+        names=by + ["projected"],
+    )
+    return pd.DataFrame(
+        counts, index=index, columns=pd.Index(IPC_PHASES, name="observed")
+    )
+
+
+def accuracy_scores(df_aligned, by=("period",), threshold=3):
+    """
+    Return the accuracy of the projections per group of by
+    The hit and false alarm rates are those of the projection that an admin2 will be in IPC phase threshold or higher
+    Args:
+        df_aligned: output of align_projections
+        by: columns to group by, e.g. ("period",) or ("period", "date")
+        threshold: IPC phase from which an admin2 counts as in crisis, 3 for IPC 3+
+
+    Returns:
+        df_scores: DataFrame with per group the number of projections, the share that was exactly right or at most one
+            phase off, the hit rate (observed crises that were projected), the false alarm rate (admins without crisis for which a
+            crisis was projected), the false alarm ratio (projected crises that did not materialize), the mean absolute error,
+            and the population-weighted absolute error and bias in phases
+    """
+    projected_crisis = df_aligned["projected"] >= threshold
+    observed_crisis = df_aligned["observed"] >= threshold
+    abs_error = df_aligned["error"].abs()
+    df = pd.DataFrame(
+        {
+            **{c: df_aligned[c] for c in by},
+            "exact": (abs_error == 0).astype(float),
+            "within_one": (abs_error <= 1).astype(float),
+            "hits": (projected_crisis & observed_crisis).astype(int),
+            "misses": (~projected_crisis & observed_crisis).astype(int),
+            "false_alarms": (projected_crisis & ~observed_crisis).astype(int),
+            "correct_negatives": (~projected_crisis & ~observed_crisis).astype(int),
+            "abs_error": abs_error,
+            "population": df_aligned["population"],
+            "pop_abs_error": abs_error * df_aligned["population"],
+            "pop_error": df_aligned["error"] * df_aligned["population"],
+        }
+    )
+    df_scores = df.groupby(list(by)).agg(
+        n=("exact", "size"),
+        exact=("exact", "mean"),
+        within_one=("within_one", "mean"),
+        hits=("hits", "sum"),
+        misses=("misses", "sum"),
+        false_alarms=("false_alarms", "sum"),
+        correct_negatives=("correct_negatives", "sum"),
+        mean_abs_error=("abs_error", "mean"),
+        population=("population", "sum"),
+        pop_abs_error=("pop_abs_error", "sum"),
+        pop_error=("pop_error", "sum"),
+    )
+
+    def ratio(numerator, denominator):
+        return numerator / denominator.where(denominator > 0)
+
+    df_scores["hit_rate"] = ratio(
+        df_scores["hits"], df_scores["hits"] + df_scores["misses"]
+    )
+    df_scores["false_alarm_rate"] = ratio(
+        df_scores["false_alarms"],
+        df_scores["false_alarms"] + df_scores["correct_negatives"],
+    )
+    df_scores["false_alarm_ratio"] = ratio(
+        df_scores["false_alarms"], df_scores["hits"] + df_scores["false_alarms"]
+    )
+    df_scores["pop_weighted_abs_error"] = ratio(
+        df_scores["pop_abs_error"], df_scores["population"]
+    )
+    df_scores["pop_weighted_bias"] = ratio(
+        df_scores["pop_error"], df_scores["population"]
+    )
+    return df_scores.drop(columns=["pop_abs_error", "pop_error"]).reset_index()
+
+
+def main(country_iso3, suffix="", config_file="config.yml", threshold=3):
+    """
+    Compute the accuracy of the FewsNet projections of country_iso3 from the admin2 output of process_fewsnet.py
+    Saves the aligned projections, the scores per period and per period and date, and the confusion matrices per period
+    to country_name/Data/ForecastAccuracy/
+    Args:
+        country_iso3: string with iso3 code
+        suffix: string that is attached to the input file name and will be attached to the output file names
+        config_file: path to config file
+        threshold: IPC phase from which an admin2 counts as in crisis for the hit and false alarm rates
+
+    Returns:
+        df_aligned: the projections aligned with the observed CS, see align_projections
+        df_scores: the scores per period, see accuracy_scores
+    """
+    parameters = parse_yaml(config_file)[country_iso3]
+    country = parameters["country_name"]
+    adm1c = parameters["shp_adm1c"]
+    adm2c = parameters["shp_adm2c"]
+    processed_path = (
+        f"{country}/Data/FewsNetProcessed/{country}_fewsnet_admin2{suffix}.csv"
+    )
+    RESULT_FOLDER = f"{country}/Data/ForecastAccuracy/"
+    Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
+
+    with timed_stage("read", source="FewsNet") as stage:
+        df = pd.read_csv(processed_path, index_col=0)
+        stage.update(frame_counts(df))
+    df_aligned = align_projections(df, adm1c, adm2c)
+    with timed_stage("accuracy") as stage:
+        df_scores = accuracy_scores(df_aligned, ["period"], threshold)
+        df_scores_date = accuracy_scores(df_aligned, ["period", "date"], threshold)
+        df_confusion = confusion_matrices(df_aligned, ["period"])
+        stage.update(frame_counts(df_scores_date))
+    with timed_stage("write"):
+        df_aligned.to_csv(
+            f"{RESULT_FOLDER}{country}_forecast_accuracy_aligned{suffix}.csv",
+            index=False,
+        )
+        df_scores.to_csv(
+            f"{RESULT_FOLDER}{country}_forecast_accuracy_scores{suffix}.csv",
+            index=False,
+        )
+        df_scores_date.to_csv(
+            f"{RESULT_FOLDER}{country}_forecast_accuracy_scores_date{suffix}.csv",
+            index=False,
+        )
+        df_confusion.to_csv(
+            f"{RESULT_FOLDER}{country}_forecast_accuracy_confusion{suffix}.csv"
+        )
+    for row in df_scores.itertuples(index=False):
+        logger.info(
+            f"{country_iso3} {row.period}: {row.n} projections, {row.exact:.0%} exact, hit rate {row.hit_rate:.2f}, "
+            f"false alarm rate {row.false_alarm_rate:.2f}, population-weighted error {row.pop_weighted_abs_error:.2f} phases"
+        )
+    return df_aligned, df_scores
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config_logger(level="info")
+    with run_report(
+        f"forecast_accuracy_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("forecast_accuracy", args.country_iso3.upper(), args.profile):
+        main(args.country_iso3.upper(), args.suffix)
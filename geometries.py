@@ -0,0 +1,254 @@
+import geopandas as gpd
+import hashlib
+import json
+import os
+from shapely.ops import linemerge, polygonize, unary_union
+from shapely.validation import explain_validity
+from pathlib import Path
+import logging
+
+try:
+    from shapely.validation import make_valid
+except ImportError:
+    # make_valid is only available from shapely 1.8, before that buffer(0) is used for all repairs
+    make_valid = None
+
+logger = logging.getLogger(__name__)
+
+# directory where preprocessed versions of the input shapefiles are saved
+GEOMETRY_CACHE_DIR = "Data/GeometryCache/"
+# crs in meters, also used to compute the areas in process_fewsnet.py
+METRIC_CRS = "EPSG:3395"
+
+
+def layer_cache_path(path, stage, cache_dir=GEOMETRY_CACHE_DIR, **params):
+    """
+    Return the path to which the preprocessed version of the layer in path is cached
+    The name contains a hash of the path, the last modification of the file and the parameters of the stage,
+    such that a changed input file or parameter automatically results in a new cache file
+    Args:
+        path: path to the input shapefile
+        stage: name of the preprocessing stage, e.g. "simplified"
+        cache_dir: directory where the cached layers are saved
+        **params: parameters of the preprocessing stage
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{sorted(params.items())}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return f"{cache_dir}{Path(path).stem}_{stage}_{digest}.gpkg"
+
+
+def geometry_key(gdf):
+    """
+    Return a hash of the geometries (not the attributes) in gdf
+    FewsNet layers with the same polygons, but other IPC phases, therefore share the same key
+    """
+    h = hashlib.sha1(str(gdf.crs).encode())
+    for geom in gdf.geometry:
+        h.update(geom.wkb if geom is not None else b"")
+    return h.hexdigest()[:16]
+
+
+def raster_key(path):
+    """
+    Return a key that changes if the raster file in path changes
+    """
+    stat = os.stat(path)
+    return hashlib.sha1(
+        f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}".encode()
+    ).hexdigest()[:12]
+
+
+def _polygonal(geom):
+    """
+    Return only the (multi)polygon parts of geom, since make_valid can turn a self-touching ring into a collection with lines or points
+    """
+    if geom.geom_type in ["Polygon", "MultiPolygon"]:
+        return geom
+    return unary_union(
+        [
+            g
+            for g in getattr(geom, "geoms", [])
+            if g.geom_type in ["Polygon", "MultiPolygon"]
+        ]
+    )
+
+
+def repair_geometry(geom):
+    """
+    Repair an invalid (multi)polygon with make_valid, or buffer(0) if make_valid is not available or did not succeed
+    """
+    if make_valid is not None:
+        repaired = _polygonal(make_valid(geom))
+        if repaired.is_valid:
+            return repaired
+    return geom.buffer(0)
+
+
+def repair_geometries(gdf, path=""):
+    """
+    Repair all invalid geometries in gdf and remove the features that are empty or have no geometry
+    Args:
+        gdf: GeoDataFrame with (multi)polygons
+        path: path of the file gdf is read from, only used in the report
+
+    Returns:
+        gdf_valid: copy of gdf with valid geometries, with a new index
+        report: dict with the number of features, invalid, repaired and dropped features, and the reason per invalid feature
+    """
+    report = {
+        "path": path,
+        "n_features": len(gdf),
+        "n_invalid": 0,
+        "n_repaired": 0,
+        "n_dropped": 0,
+        "invalid": [],
+    }
+    geoms = gdf.geometry.copy()
+    missing = geoms.isnull() | geoms.is_empty
+    invalid = ~missing & ~geoms.is_valid
+    for i in geoms.index[invalid]:
+        repaired = repair_geometry(geoms[i])
+        report["invalid"].append(
+            {"index": int(i), "reason": explain_validity(geoms[i])}
+        )
+        if repaired.is_empty:
+            missing[i] = True
+        else:
+            geoms[i] = repaired
+            report["n_repaired"] += 1
+    gdf_valid = gdf.set_geometry(geoms)
+    report["n_invalid"] = int(invalid.sum())
+    report["n_dropped"] = int(missing.sum())
+    # the cached layer is read back with a new index, so reset it here too such that cold and warm runs are the same
+    return gdf_valid[~missing].reset_index(drop=True), report
+
+
+def load_valid_layer(path, cache_dir=GEOMETRY_CACHE_DIR):
+    """
+    Read a shapefile with repaired geometries
+    The validity check and repair is done once per file, after which the report (and if anything had to be repaired the
+    repaired layer) is cached in cache_dir. Later reads of the same file only read the report and the layer.
+    Args:
+        path: path to the shapefile
+        cache_dir: directory where the validity reports and repaired layers are saved
+
+    Returns:
+        gdf: GeoDataFrame with only valid geometries
+    """
+    cache_path = layer_cache_path(path, "repaired", cache_dir=cache_dir)
+    report_path = cache_path.replace(".gpkg", "_validity.json")
+    if os.path.exists(report_path):
+        with open(report_path, "r") as f:
+            report = json.load(f)
+        if report["n_invalid"] == 0 and report["n_dropped"] == 0:
+            return gpd.read_file(path)
+        if os.path.exists(cache_path):
+            return gpd.read_file(cache_path)
+
+    gdf, report = repair_geometries(gpd.read_file(path), path)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    if report["n_invalid"] or report["n_dropped"]:
+        logger.warning(
+            f"{path} contains {report['n_invalid']} invalid geometries, of which {report['n_repaired']} are repaired. "
+            f"{report['n_dropped']} empty features are removed"
+        )
+        gdf.to_file(cache_path, driver="GPKG")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return gdf
+
+
+def simplify_topology(gdf, tolerance, crs=METRIC_CRS):
+    """
+    Simplify the geometries in gdf while keeping shared edges between neighbouring polygons identical
+    Simplifying every polygon on its own moves the two copies of a shared edge differently, which creates slivers and gaps.
+    Instead the boundaries are noded into arcs between junctions, each arc is simplified once, and the faces of the
+    simplified linework are assigned back to the polygon they overlap most.
+    Args:
+        gdf: GeoDataFrame with (multi)polygons
+        tolerance: maximum distance in meters between the original and the simplified arcs
+        crs: crs in meters in which the simplification is done
+
+    Returns:
+        gdf_simp: copy of gdf with simplified geometries, in the crs of gdf
+    """
+    gdf_m = gdf.to_crs(crs)
+    geoms = gdf_m.geometry.reset_index(drop=True)
+    # unary_union nodes the boundaries, such that a shared edge is a single line
+    # linemerge joins these lines up to the junctions where three or more polygons meet, which stay fixed
+    arcs = linemerge(unary_union([g.boundary for g in geoms if g is not None]))
+    arcs = getattr(arcs, "geoms", [arcs])
+    simplified = unary_union(
+        [a.simplify(tolerance, preserve_topology=True) for a in arcs]
+    )
+    faces = gpd.GeoSeries(list(polygonize(simplified)), crs=crs)
+
+    sindex = gpd.GeoSeries(geoms, crs=crs).sindex
+    face_owner = []
+    for face in faces:
+        candidates = list(sindex.intersection(face.bounds))
+        overlap = [face.intersection(geoms[c]).area for c in candidates]
+        if overlap and max(overlap) > 0:
+            face_owner.append(candidates[overlap.index(max(overlap))])
+        else:
+            # face that falls in a hole or outside the layer
+            face_owner.append(-1)
+    faces = gpd.GeoDataFrame({"owner": face_owner}, geometry=faces, crs=crs)
+    faces = faces[faces["owner"] >= 0]
+    new_geoms = faces.dissolve(by="owner").geometry
+
+    simp_geoms = []
+    for i, g in enumerate(geoms):
+        if i in new_geoms.index:
+            simp_geoms.append(new_geoms[i])
+        else:
+            # polygon smaller than the tolerance, keep it rather than lose the admin/FewsNet area
+            logger.debug(
+                f"Polygon {i} collapsed during simplification, keeping original"
+            )
+            simp_geoms.append(g)
+    gdf_simp = gdf_m.copy()
+    gdf_simp.geometry = gpd.GeoSeries(simp_geoms, index=gdf_m.index, crs=crs)
+    return gdf_simp.to_crs(gdf.crs)
+
+
+def load_layer(path, simplify_tolerance=None, cache_dir=GEOMETRY_CACHE_DIR):
+    """
+    Read a shapefile with repaired geometries, and if simplify_tolerance is given return its topology-preserving simplification
+    The repaired and simplified layers are cached in cache_dir, such that they are only computed once per file and tolerance
+    Args:
+        path: path to the shapefile
+        simplify_tolerance: tolerance in meters for the simplification. If None, the layer is returned as is
+        cache_dir: directory where the simplified layers are saved
+
+    Returns:
+        gdf: GeoDataFrame with the (simplified) layer
+    """
+    if not simplify_tolerance:
+        return load_valid_layer(path, cache_dir=cache_dir)
+    cache_path = layer_cache_path(
+        path, "simplified", cache_dir=cache_dir, tolerance=simplify_tolerance
+    )
+    if os.path.exists(cache_path):
+        return gpd.read_file(cache_path)
+    gdf_orig = load_valid_layer(path, cache_dir=cache_dir)
+    gdf = simplify_topology(gdf_orig, simplify_tolerance)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    gdf.to_file(cache_path, driver="GPKG")
+    n_before = sum(len(g.exterior.coords) for g in explode_polygons(gdf_orig))
+    n_after = sum(len(g.exterior.coords) for g in explode_polygons(gdf))
+    logger.info(
+        f"Simplified {path} with a tolerance of {simplify_tolerance}m from {n_before} to {n_after} exterior vertices"
+    )
+    return gdf
+
+
+def explode_polygons(gdf):
+    """
+    Return a list of all single polygons in gdf
+    """
+    polygons = []
+    for g in gdf.geometry.dropna():
+        polygons.extend(getattr(g, "geoms", [g]))
+    return polygons
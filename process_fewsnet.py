@@ -2,14 +2,71 @@ import geopandas as gpd
 import pandas as pd
 import os
 import numpy as np
-from utils import parse_args, parse_yaml, config_logger
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    results_db_arguments,
+    tile_size_arguments,
+    crosswalk_arguments,
+    simplify_arguments,
+    multi_country_arguments,
+    parse_yaml,
+    config_logger,
+    timed,
+    timed_stage,
+    frame_counts,
+    collect_stages,
+    add_stage_records,
+    run_report,
+    profile_run,
+)
+from geometries import load_layer
+from crosswalk import load_crosswalk, dominant_phase
+from results_store import save_results, phase_rows, population_rows
+from schema import apply_schema, month_start, population_columns, to_admin_dtype
+from raster_utils import (
+    read_population,
+    admin_label_raster,
+    rasterize_labels,
+    label_phase_population,
+    tiled_population,
+    worldpop_filename,
+    WORLDPOP_FILENAMES,
+    DEFAULT_RESOLUTION,
+    DEFAULT_TILE_SIZE,
+)
+import glob
+import re
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
 
+# FewsNet layers that are already read, by path. Filled by process_countries such that regional files are only read once
+_fewsnet_layers = {}
 
-def shapefiles_to_df(path, period, dates, region, regionabb, iso2_code):
+
+def set_fewsnet_layers(layers):
+    """
+    Set the FewsNet layers, by path, that shapefiles_to_df uses instead of reading the file
+    """
+    global _fewsnet_layers
+    _fewsnet_layers = layers
+
+
+def read_fewsnet_layer(path, simplify_tolerance=None):
+    """
+    Return the FewsNet layer in path, from the layers set with set_fewsnet_layers if present and else read from disk
+    """
+    if (path, simplify_tolerance) in _fewsnet_layers:
+        return _fewsnet_layers[(path, simplify_tolerance)].copy()
+    return load_layer(path, simplify_tolerance)
+
+
+def shapefiles_to_df(
+    path, period, dates, region, regionabb, iso2_code, simplify_tolerance=None
+):
     """
     Compile the shapefiles to a dataframe
     Args:
@@ -19,6 +76,7 @@ def shapefiles_to_df(path, period, dates, region, regionabb, iso2_code):
         region: region that the fewsnet data covers, e.g. "east-africa"
         regionabb: abbreviation of the region that the fewsnet data covers, e.g. "EA"
         iso2_code: iso2 code of the country of interest
+        simplify_tolerance: if given, tolerance in meters with which the FewsNet shapes are simplified
 
     Returns:
         df: DataFrame that contains all the shapefiles of Fewsnet for the given dates, period and regions
@@ -30,17 +88,28 @@ def shapefiles_to_df(path, period, dates, region, regionabb, iso2_code):
         shape_region = f"{path}{region}{d}/{regionabb}_{d}_{period}.shp"
         shape_country = f"{path}{iso2_code}_{d}/{iso2_code}_{d}_{period}.shp"
         if os.path.exists(shape_region):
-            gdf = gpd.read_file(shape_region)
-            gdf["date"] = pd.to_datetime(d, format="%Y%m")
-            df = df.append(gdf, ignore_index=True)
+            shape_path = shape_region
         elif os.path.exists(shape_country):
-            gdf = gpd.read_file(shape_country)
-            gdf["date"] = pd.to_datetime(d, format="%Y%m")
-            df = df.append(gdf, ignore_index=True)
+            shape_path = shape_country
+        else:
+            continue
+        with timed_stage("read", date=d, period=period) as stage:
+            gdf = read_fewsnet_layer(shape_path, simplify_tolerance)
+            stage.update(frame_counts(gdf))
+        gdf["date"] = pd.to_datetime(d, format="%Y%m")
+        df = df.append(gdf, ignore_index=True)
     return df
 
 
-def merge_admin2(df, path_admin, period, adm0c, adm1c, adm2c):
+def admin_columns(adm0c, adm1c, adm2c, adm3c=None):
+    """
+    Return the list with the admin column names, down to admin3 if adm3c is given
+    """
+    return [adm0c, adm1c, adm2c] + ([adm3c] if adm3c else [])
+
+
+@timed("overlay", unit=("period",))
+def merge_admin2(df, path_admin, period, adm0c, adm1c, adm2c, simplify_tolerance=None):
     """
     Merge the geographic boundary information shapefile with the FewsNet dataframe.
     Args:
@@ -50,11 +119,12 @@ def merge_admin2(df, path_admin, period, adm0c, adm1c, adm2c):
         adm0c: column name of the admin0 level name, in path_admin data
         adm1c: column name of the admin1 level name, in path_admin data
         adm2c: column name of the admin2 level name, in path_admin data
+        simplify_tolerance: if given, tolerance in meters with which the admin boundaries are simplified
 
     Returns:
         overlap: dataframe with the regions per admin2 for each IPC level
     """
-    admin2 = gpd.read_file(path_admin)
+    admin2 = load_layer(path_admin, simplify_tolerance)
     admin2 = admin2[[adm0c, adm1c, adm2c, "geometry"]]
     overlap = gpd.overlay(admin2, df, how="intersection")
     overlap = overlap.drop_duplicates()
@@ -95,9 +165,186 @@ def return_max_cs(date, df, dfadcol, period, adm0c, adm1c, adm2c):
     return row
 
 
-def add_missing_values(df, period, dates, path_admin, adm0c, adm1c, adm2c):
+def crosswalk_max_cs(
+    df, path_admin, period, adm0c, adm1c, adm2c, simplify_tolerance=None, adm3c=None
+):
+    """
+    Return the IPC value that is assigned to the largest area for every admin2 and date, with the same result as
+    merge_admin2 followed by return_max_cs, but computed from the admin x FewsNet crosswalk.
+    The crosswalk is cached per distinct FewsNet geometry set, such that only new geometries require an overlay.
+    Args:
+        df: DataFrame with the Fewsnet data and geometries
+        path_admin: path to file with admin(2) boundaries
+        period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term)
+        adm0c: column name of the admin0 level name, in path_admin data
+        adm1c: column name of the admin1 level name, in path_admin data
+        adm2c: column name of the admin2 level name, in path_admin data
+        simplify_tolerance: if given, tolerance in meters with which the admin boundaries are simplified
+        adm3c: column name of the admin3 level name, in path_admin data. If given, the IPC value is returned per admin3
+
+    Returns:
+        df_max: DataFrame with one row per admin2-date combination that intersects with the FewsNet data
+    """
+    admin_cols = admin_columns(adm0c, adm1c, adm2c, adm3c)
+    admin2 = load_layer(path_admin, simplify_tolerance)
+    admin2 = admin2[admin_cols + ["geometry"]].reset_index(drop=True)
+    df_max_list = []
+    for d, df_date in df.groupby("date"):
+        df_date = df_date.reset_index(drop=True)
+        with timed_stage("overlay", date=d, period=period) as stage:
+            crosswalk = load_crosswalk(admin2, df_date)
+            stage["fragments"] = crosswalk["area"].nnz
+        # replace other values than 1-5 by 0, as in gen_csml1m2
+        phases = df_date[period].where(df_date[period] < 5, 0)
+        df_d = admin2[admin_cols].copy()
+        df_d["date"] = d
+        df_d[period] = dominant_phase(crosswalk["area"], phases)
+        df_max_list.append(df_d[df_d[period].notnull()])
+    df_max = pd.concat(df_max_list, ignore_index=True).drop_duplicates(
+        ["date"] + admin_cols[1:]
+    )
+    return df_max[["date"] + admin_cols + [period]]
+
+
+def population_max_cs(
+    df,
+    path_admin,
+    period,
+    adm0c,
+    adm1c,
+    adm2c,
+    pop_paths,
+    simplify_tolerance=None,
+    tile_size=None,
+    adm3c=None,
+):
+    """
+    Return the IPC value that holds the largest population for every admin2 and date, based on the WorldPop rasters
+    The admin boundaries are rasterized once to a cached pixel-label raster on the WorldPop grid. Per date only the FewsNet
+    phases are rasterized, after which one bincount gives the population per admin2 and phase.
+    As in return_max_cs, phases 1-4 are preferred over the other values, which are returned as nan.
+    If an admin2 has no population in phases 1-4 but it is covered by them, the phase covering most cells is returned.
+    With tile_size, the rasters are not read as a whole but streamed in tiles, see raster_utils.tiled_population
+    Args:
+        df: DataFrame with the Fewsnet data and geometries
+        path_admin: path to file with admin(2) boundaries
+        period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term)
+        adm0c: column name of the admin0 level name, in path_admin data
+        adm1c: column name of the admin1 level name, in path_admin data
+        adm2c: column name of the admin2 level name, in path_admin data
+        pop_paths: dict with per year the path to the WorldPop raster. If a year is missing, the closest year is used
+        simplify_tolerance: if given, tolerance in meters with which the admin boundaries are simplified
+        tile_size: if given, number of rows and columns of the tiles in which the rasters are processed
+        adm3c: column name of the admin3 level name, in path_admin data. If given, the IPC value is returned per admin3
+
+    Returns:
+        df_max: DataFrame with one row per admin2-date combination that is covered by the FewsNet data
+    """
+    admin_cols = admin_columns(adm0c, adm1c, adm2c, adm3c)
+    admin2 = load_layer(path_admin, simplify_tolerance)
+    admin2 = admin2[admin_cols + ["geometry"]].reset_index(drop=True)
+    # phase code 5 collects all other values (0, 5, 66, 88, 99), 0 means not covered by FewsNet
+    n_phases = 6
+    pop_year = None
+    df_max_list = []
+    for d, df_date in df.groupby("date"):
+        year = min(pop_paths.keys(), key=lambda y: abs(y - d.year))
+        if year != pop_year and not tile_size:
+            # only keep the raster of one year in memory
+            pop_year = year
+            pop, transform, crs = read_population(pop_paths[year])
+            labels = admin_label_raster(admin2, pop_paths[year])
+        codes = df_date[period].where(df_date[period].isin([1, 2, 3, 4]), 5)
+        with timed_stage("zonal", date=d, period=period) as stage:
+            if tile_size:
+                pop_phase, cells = tiled_population(
+                    pop_paths[year],
+                    admin2,
+                    df_date,
+                    codes.astype(int),
+                    n_phases,
+                    tile_size,
+                )
+            else:
+                phases = rasterize_labels(
+                    df_date.to_crs(crs),
+                    codes.astype(int),
+                    pop.shape,
+                    transform,
+                    "uint8",
+                )
+                pop_phase, cells = label_phase_population(
+                    labels, phases, pop, len(admin2), n_phases
+                )
+            stage.update(frame_counts(df_date))
+        valid_pop = pop_phase[:, 1:5]
+        valid_cells = cells[:, 1:5]
+        df_d = admin2[admin_cols].copy()
+        df_d["date"] = d
+        df_d[period] = np.where(
+            valid_pop.max(axis=1) > 0,
+            valid_pop.argmax(axis=1) + 1,
+            np.where(valid_cells.max(axis=1) > 0, valid_cells.argmax(axis=1) + 1, 0),
+        )
+        df_max_list.append(df_d[cells[:, 1:].sum(axis=1) > 0])
+    df_max = pd.concat(df_max_list, ignore_index=True).drop_duplicates(
+        ["date"] + admin_cols[1:]
+    )
+    return df_max[["date"] + admin_cols + [period]]
+
+
+def find_pop_paths(folder_pop, country_iso3, resolution=DEFAULT_RESOLUTION):
+    """
+    Return a dict with per year the path to the WorldPop raster of the given resolution ("1km" or "100m") in folder_pop
+    """
+    pop_paths = {}
+    for path in glob.glob(
+        f"{folder_pop}/{WORLDPOP_FILENAMES[resolution].format(iso3=country_iso3.lower(), year='*')}"
+    ):
+        year = re.search(r"_ppp_(\d{4})_", os.path.basename(path))
+        # the pattern of the 100m rasters also matches the 1km rasters
+        if year and os.path.basename(path) == worldpop_filename(
+            country_iso3, year.group(1), resolution
+        ):
+            pop_paths[int(year.group(1))] = path
+    return pop_paths
+
+
+def admin_date_index(dates, path_admin, adm0c, adm1c, adm2c, adm3c=None):
+    """
+    Return the canonical (date x admin) index, with every date in dates for every admin2 in the boundary file
+    Args:
+        dates: list of dates in the format YYYYMM
+        path_admin: path to file with admin(2) boundaries
+        adm0c: column name of the admin0 level name, in path_admin data
+        adm1c: column name of the admin1 level name, in path_admin data
+        adm2c: column name of the admin2 level name, in path_admin data
+        adm3c: column name of the admin3 level name, in path_admin data, if the index is per admin3
+
+    Returns:
+        MultiIndex with the levels date, adm0c, adm1c, adm2c and adm3c (if given), where the admin levels are categorical
+    """
+    admin_cols = admin_columns(adm0c, adm1c, adm2c, adm3c)
+    df_admnames = (
+        gpd.read_file(path_admin)[admin_cols].drop_duplicates().reset_index(drop=True)
+    )
+    dates_dt = pd.to_datetime(sorted(set(dates)), format="%Y%m")
+    return pd.MultiIndex.from_arrays(
+        [np.repeat(dates_dt, len(df_admnames))]
+        + [
+            pd.Categorical(np.tile(df_admnames[c].to_numpy(), len(dates_dt)))
+            for c in admin_cols
+        ],
+        names=["date"] + admin_cols,
+    )
+
+
+def add_missing_values(
+    df, period, dates, path_admin, adm0c, adm1c, adm2c, index=None, adm3c=None
+):
     """
-    Add dates which are in dates but not in current dataframe (i.e. not in raw FewsNet data) to dataframe and set period values to nan
+    Reindex df onto the canonical (date x admin) index, such that dates which are in dates but not in df (i.e. not in raw FewsNet data),
+    and admins that are not covered by the FewsNet data on a date, are included with nan as period value
     Args:
         df: DataFrame with the max IPC for period per adm1-adm2 combination for all dates that are in the FewsNet data
         period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term)
@@ -106,29 +353,30 @@ def add_missing_values(df, period, dates, path_admin, adm0c, adm1c, adm2c):
         adm0c: column name of the admin0 level name, in path_admin data
         adm1c: column name of the admin1 level name, in path_admin data
         adm2c: column name of the admin2 level name, in path_admin data
+        index: the output of admin_date_index, which is computed if not given
+        adm3c: column name of the admin3 level name, in path_admin data, if df is per admin3
 
     Returns:
-        DataFrame which includes the dates in "dates" that were not in the input df
+        DataFrame with one row per date in "dates" and admin2
     """
-    dates_dt = pd.to_datetime(dates, format="%Y%m")
-    # check if
+    if index is None:
+        index = admin_date_index(dates, path_admin, adm0c, adm1c, adm2c, adm3c)
+    keys = ["date"] + admin_columns(adm0c, adm1c, adm2c, adm3c)
     if df.empty:
-        diff_dates = set(dates_dt)
-    else:
-        # get dates that are in config list but not in df
-        diff_dates = set(dates_dt) - set(df.date)
+        df = pd.DataFrame(columns=keys + [period])
 
+    # get dates that are in config list but not in df
+    diff_dates = set(index.levels[0]) - set(pd.to_datetime(df["date"]))
     if diff_dates:
-        diff_dates_string = ",".join([n.strftime("%d-%m-%Y") for n in diff_dates])
+        diff_dates_string = ",".join(
+            [n.strftime("%d-%m-%Y") for n in sorted(diff_dates)]
+        )
         logger.warning(f"No FewsNet data found for {period} on {diff_dates_string}")
-        df_adm2 = gpd.read_file(path_admin)
-        df_admnames = df_adm2[[adm0c, adm1c, adm2c]]
-        for d in diff_dates:
-            df_date = df_admnames.copy()
-            df_date["date"] = d
-            df_date[period] = np.nan
-            df = df.append(df_date)
-    return df
+
+    df = df.assign(date=pd.to_datetime(df["date"]))
+    # an admin2 with two polygons of the same size can appear twice, keep one row per admin2 such that the index is unique
+    df = df.drop_duplicates(keys).set_index(keys)[[period]]
+    return df.reindex(index).reset_index()
 
 
 def gen_csml1m2(
@@ -142,10 +390,17 @@ def gen_csml1m2(
     region,
     regionabb,
     iso2_code,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    weighting="area",
+    pop_paths=None,
+    index=None,
+    tile_size=None,
+    adm3c=None,
 ):
     """
-    Generate a DataFrame with the IPC level per Admin 2 Level, defined by the level that covers the largest area
-    The DataFrame includes all the dates given as input, and covers one type of classification given by period
+    Generate a DataFrame with the IPC level per Admin 2 Level, defined by the level that covers the largest area or population
+    The DataFrame includes all the dates given as input for all admin2s, and covers one type of classification given by period
     Args:
         ipc_path: path to the directory with the fewsnet data
         bound_path: path to the file with the admin2 boundaries
@@ -157,34 +412,81 @@ def gen_csml1m2(
         region: region that the fewsnet data covers, e.g. "east-africa"
         regionabb: abbreviation of the region that the fewsnet data covers, e.g. "EA"
         iso2_code: iso2 code of the country of interest
+        simplify_tolerance: if given, tolerance in meters with which the FewsNet and admin shapes are simplified before the overlay
+        use_crosswalk: if True, compute the IPC levels from the cached admin x FewsNet crosswalk instead of one overlay of all dates
+        weighting: "area" to select the IPC level with the largest area, "population" for the one with the largest WorldPop population
+        pop_paths: dict with per year the path to the WorldPop raster, required if weighting is "population"
+        index: the (date x admin) index of the output, see admin_date_index. It is computed from dates and bound_path if not given
+        tile_size: if given, the WorldPop rasters are streamed in tiles of tile_size x tile_size cells for the population weighting
+        adm3c: column name of the admin3 level name, in path_admin data. If given, the IPC level is computed per admin3, which
+            requires the crosswalk or population weighting since the per-admin loop of return_max_cs does not scale to admin3
 
     Returns:
         new_df: DataFrame that contains one row per Admin2-date combination, which indicates the IPC level
     """
-    df_ipc = shapefiles_to_df(ipc_path, period, dates, region, regionabb, iso2_code)
-    try:
-        overlap = merge_admin2(df_ipc, bound_path, period, adm0c, adm1c, adm2c)
+    admin_cols = admin_columns(adm0c, adm1c, adm2c, adm3c)
+    if adm3c and weighting == "area" and not use_crosswalk:
+        raise ValueError(
+            "The IPC level per admin3 can only be computed with the crosswalk or population weighting"
+        )
+    df_ipc = shapefiles_to_df(
+        ipc_path, period, dates, region, regionabb, iso2_code, simplify_tolerance
+    )
+    if df_ipc.empty:
+        logger.error(f"No FewsNet data for {period} for the given dates was found")
+        return apply_schema(
+            add_missing_values(
+                df_ipc, period, dates, bound_path, adm0c, adm1c, adm2c, index, adm3c
+            ),
+            admin_cols=admin_cols,
+            phase_cols=[period],
+        )
+
+    if weighting == "population":
+        new_df = population_max_cs(
+            df_ipc,
+            bound_path,
+            period,
+            adm0c,
+            adm1c,
+            adm2c,
+            pop_paths,
+            simplify_tolerance,
+            tile_size,
+            adm3c,
+        )
+    elif use_crosswalk:
+        new_df = crosswalk_max_cs(
+            df_ipc,
+            bound_path,
+            period,
+            adm0c,
+            adm1c,
+            adm2c,
+            simplify_tolerance,
+            adm3c,
+        )
+    else:
+        overlap = merge_admin2(
+            df_ipc, bound_path, period, adm0c, adm1c, adm2c, simplify_tolerance
+        )
         # replace other values than 1-5 by 0 (these are 99,88,66 and indicate missing values, nature areas or lakes)
         overlap.loc[overlap[period] >= 5, period] = 0
         new_df = pd.DataFrame(columns=["date", period, adm0c, adm1c, adm2c])
 
         for d in overlap["date"].unique():
-            # all unique combinations of admin1 and admin2 regions (sometimes an admin2 region can be in two admin1 regions)
-            df_adm12c = overlap[[adm1c, adm2c]].drop_duplicates()
-            for index, a in df_adm12c.iterrows():
-                row = return_max_cs(d, overlap, a, period, adm0c, adm1c, adm2c)
-                new_df = new_df.append(row)
-        new_df.replace(0, np.nan, inplace=True)
-        df_alldates = add_missing_values(
-            new_df, period, dates, bound_path, adm0c, adm1c, adm2c
-        )
-
-    except AttributeError:
-        logger.error(f"No FewsNet data for {period} for the given dates was found")
-        df_alldates = add_missing_values(
-            df_ipc, period, dates, bound_path, adm0c, adm1c, adm2c
-        )
-    return df_alldates
+            with timed_stage("aggregate", date=d, period=period) as stage:
+                # all unique combinations of admin1 and admin2 regions (sometimes an admin2 region can be in two admin1 regions)
+                df_adm12c = overlap[[adm1c, adm2c]].drop_duplicates()
+                for _, a in df_adm12c.iterrows():
+                    row = return_max_cs(d, overlap, a, period, adm0c, adm1c, adm2c)
+                    new_df = new_df.append(row)
+                stage["rows"] = len(df_adm12c)
+    new_df.replace(0, np.nan, inplace=True)
+    df_alldates = add_missing_values(
+        new_df, period, dates, bound_path, adm0c, adm1c, adm2c, index, adm3c
+    )
+    return apply_schema(df_alldates, admin_cols=admin_cols, phase_cols=[period])
 
 
 def get_new_name(name, n_dict):
@@ -203,28 +505,30 @@ def get_new_name(name, n_dict):
         return name
 
 
-def merge_ipcperiod(inputdf_dict, adm0c, adm1c, adm2c):
+@timed("aggregate")
+def merge_ipcperiod(inputdf_dict, adm0c, adm1c, adm2c, index=None, adm3c=None):
     """
     Merge the three types of IPC projections (CS, ML1, ML2) to one dataframe
+    Every period is reindexed onto the same (date x admin) index, after which the periods are concatenated column-wise at once
     Args:
         inputdf_dict: dict with df for each period (CS, ML1, ML2)
         adm1c: column name of the admin1 level name, in fewsnet data
         adm2c: column name of the admin2 level name, in fewsnet data
+        index: the (date x admin) index of the output, see admin_date_index. If None, the rows of the first period are used
+        adm3c: column name of the admin3 level name, in fewsnet data, if the data is per admin3
 
     Returns:
         df_ipc: dataframe with the cs, ml1 and ml2 data combined
     """
-
-    df = pd.DataFrame()
-    for k in inputdf_dict.keys():
-        if df.empty:
-            df = inputdf_dict[k]
-        else:
-            df = df.merge(inputdf_dict[k], on=[adm0c, adm1c, adm2c, "date"], how="left")
-
-    df["date"] = pd.to_datetime(df["date"])
-    df["date"] = df["date"].dt.date
-    return df
+    keys = ["date"] + admin_columns(adm0c, adm1c, adm2c, adm3c)
+    frames = [
+        df.assign(date=month_start(df["date"])).drop_duplicates(keys).set_index(keys)
+        for df in inputdf_dict.values()
+    ]
+    if index is None:
+        index = frames[0].index
+    df = pd.concat([df_period.reindex(index) for df_period in frames], axis=1)
+    return df.reset_index()
 
 
 def check_missingadmins(
@@ -294,6 +598,7 @@ def check_missingadmins(
         )
 
 
+@timed("read")
 def load_popdata(
     pop_path, pop_adm1c, pop_adm2c, pop_col, admin2_mapping=None, admin1_mapping=None
 ):
@@ -332,6 +637,48 @@ def load_popdata(
     return df_pop
 
 
+@timed("aggregate")
+def distribute_population(
+    df_pop, path_admin, pop_adm1c, pop_adm2c, shp_adm1c, shp_adm2c, shp_adm3c
+):
+    """
+    Distribute the population per admin2 over its admin3s, in proportion to their area
+    Population figures are often only published down to admin2, the admin3s then get the share of the admin2 population
+    that corresponds with their share of the admin2 area
+    Args:
+        df_pop: DataFrame with population per admin2, output of load_popdata
+        path_admin: path to file with admin3 boundaries, which also has the admin1 and admin2 names
+        pop_adm1c: column name of the admin1 level name, in df_pop
+        pop_adm2c: column name of the admin2 level name, in df_pop
+        shp_adm1c: column name of the admin1 level name, in path_admin data
+        shp_adm2c: column name of the admin2 level name, in path_admin data
+        shp_adm3c: column name of the admin3 level name, in path_admin data
+
+    Returns:
+        df_pop3: DataFrame with the population per admin3 as Total, with the admin1 and admin2 names in the columns of df_pop
+    """
+    admin3 = load_layer(path_admin)
+    df_area = pd.DataFrame(
+        {
+            pop_adm1c: admin3[shp_adm1c].to_numpy(),
+            pop_adm2c: admin3[shp_adm2c].to_numpy(),
+            shp_adm3c: admin3[shp_adm3c].to_numpy(),
+            "area": admin3.geometry.to_crs("EPSG:3395").area.to_numpy(),
+        }
+    )
+    df_area = df_area.groupby(
+        [pop_adm1c, pop_adm2c, shp_adm3c], as_index=False, sort=False
+    )["area"].sum()
+    share = df_area["area"] / df_area.groupby([pop_adm1c, pop_adm2c])["area"].transform(
+        "sum"
+    )
+    df_pop3 = df_area.assign(share=share).merge(
+        df_pop[[pop_adm1c, pop_adm2c, "Total"]], on=[pop_adm1c, pop_adm2c], how="left"
+    )
+    df_pop3["Total"] = df_pop3["Total"] * df_pop3["share"]
+    return df_pop3[[pop_adm1c, pop_adm2c, shp_adm3c, "Total"]]
+
+
 def create_histpopdict(
     df_data, country, histpop_path="Data/Worldbank_TotalPopulation.csv"
 ):
@@ -372,19 +719,10 @@ def create_histpopdict(
     return df_histpopc_data.to_dict()
 
 
-def get_adjusted(row, perc_dict):
-    """
-    Compute the subnational population, adjusted to the country's national population of that year
-    """
-    year = str(row["date"].year)
-    adjustment = perc_dict[year]
-    if pd.isna(row["Total"]):
-        return row["Total"]
-    else:
-        return int(row["Total"] * adjustment)
-
-
-def merge_ipcpop(df_ipc, df_pop, country, pop_adm1c, pop_adm2c, shp_adm1c, shp_adm2c):
+@timed("aggregate")
+def merge_ipcpop(
+    df_ipc, df_pop, country, pop_adm1c, pop_adm2c, shp_adm1c, shp_adm2c, shp_adm3c=None
+):
     """
 
     Args:
@@ -395,15 +733,24 @@ def merge_ipcpop(df_ipc, df_pop, country, pop_adm1c, pop_adm2c, shp_adm1c, shp_a
         pop_adm2c: column name of the admin1 level name, in df_pop
         shp_adm1c:  column name of the admin1 level name, in df_ipc
         shp_adm2c:  column name of the admin2 level name, in df_ipc
+        shp_adm3c: column name of the admin3 level name, in df_ipc and df_pop, if the data is per admin3 (see distribute_population)
 
     Returns:
         df_ipcp: DataFrame with IPC level and population per admin2 region, where the population is adjusted to historical national averages
     """
+    # give the admin names of the population data the categories of the IPC data, such that the merge is done on the codes
+    # names that are not in the IPC data become missing, and are removed since they would otherwise match missing names
+    pop_keys = [pop_adm1c, pop_adm2c] + ([shp_adm3c] if shp_adm3c else [])
+    shp_keys = [shp_adm1c, shp_adm2c] + ([shp_adm3c] if shp_adm3c else [])
+    df_popkeys = df_pop[pop_keys + ["Total"]].copy()
+    for pop_c, shp_c in zip(pop_keys, shp_keys):
+        df_popkeys[pop_c] = to_admin_dtype(df_popkeys[pop_c], df_ipc[shp_c].dtype)
+    df_popkeys = df_popkeys.dropna(subset=pop_keys)
     df_ipcp = df_ipc.merge(
-        df_pop[[pop_adm1c, pop_adm2c, "Total"]],
+        df_popkeys,
         how="left",
-        left_on=[shp_adm1c, shp_adm2c],
-        right_on=[pop_adm1c, pop_adm2c],
+        left_on=shp_keys,
+        right_on=pop_keys,
     )
 
     # dict to indicate relative increase in population over the years
@@ -412,22 +759,27 @@ def merge_ipcpop(df_ipc, df_pop, country, pop_adm1c, pop_adm2c, shp_adm1c, shp_a
     pop_tot_subn = df_ipcp[df_ipcp.date == df_ipcp.date.unique()[0]]["Total"].sum()
     perc_dict = {k: v / pop_tot_subn for k, v in pop_dict.items()}
 
-    df_ipcp["adjusted_population"] = df_ipcp.apply(
-        lambda x: get_adjusted(x, perc_dict), axis=1
+    # subnational population adjusted to the national population of the year, truncated to whole people
+    df_ipcp["adjusted_population"] = np.trunc(
+        df_ipcp["Total"] * df_ipcp["date"].dt.year.astype(str).map(perc_dict)
     )
-    if df_ipcp[df_ipcp.date == df_ipcp.date.max()].Total.sum() != df_pop.Total.sum():
+    if not np.isclose(
+        df_ipcp[df_ipcp.date == df_ipcp.date.max()].Total.sum(), df_pop.Total.sum()
+    ):
         logger.warning(
             f"Population data merged with IPC doesn't match the original population numbers. Original:{df_pop.Total.sum()}, Merged:{df_ipcp[df_ipcp.date == df_ipcp.date.max()].Total.sum()}"
         )
 
     # add columns with population in each IPC level for CS, ML1 and ML2
     for period in ["CS", "ML1", "ML2"]:
+        # the nullable int phases as float, with nan for missing phases
+        phase = df_ipcp[period].astype("float64")
         for level in [1, 2, 3, 4, 5]:
             ipc_id = "{}_{}".format(period, level)
             df_ipcp[ipc_id] = np.where(
-                df_ipcp[period] == level,
+                phase == level,
                 df_ipcp["adjusted_population"],
-                (np.where(np.isnan(df_ipcp[period]), np.nan, 0)),
+                (np.where(np.isnan(phase), np.nan, 0)),
             )
         df_ipcp[f"pop_{period}"] = df_ipcp[[f"{period}_{i}" for i in range(1, 6)]].sum(
             axis=1, min_count=1
@@ -437,7 +789,7 @@ def merge_ipcpop(df_ipc, df_pop, country, pop_adm1c, pop_adm2c, shp_adm1c, shp_a
     # TODO: sort values and test
     # df_ipcp=df_ipcp.sort_values(by=["date",shp_adm1c,shp_adm2c])
 
-    return df_ipcp
+    return apply_schema(df_ipcp, pop_cols=population_columns(df_ipcp))
 
 
 def aggr_admin1(df, adm1c):
@@ -450,27 +802,77 @@ def aggr_admin1(df, adm1c):
     Returns:
         df_adm: dataframe with number of people in each IPC class per Admin1 region
     """
+    return aggr_admin(df, [adm1c])
+
+
+@timed("aggregate")
+def aggr_admin(df, adm_cols, add_phases=False):
+    """
+    Aggregate dataframe to the admin level of the last column in adm_cols, e.g. admin3 results to admin2
+    Args:
+        df: DataFrame of interest
+        adm_cols: column names of the admin level names in df to group by, e.g. [adm0c, adm1c, adm2c] for admin2
+        add_phases: if True, also add per period the IPC level that holds the largest part of the population as CS, ML1 and
+            ML2, such that the output has the same columns as a run on that admin level with population weighting
+
+    Returns:
+        df_adm: dataframe with number of people in each IPC class per admin
+    """
     cols_ipc = [f"{s}_{l}" for s in ["CS", "ML1", "ML2"] for l in range(1, 6)]
+    cols_pop = ["Total", "adjusted_population"] + cols_ipc
+    # sum in float64, since the totals can be too large for float32. min_count=1 keeps all-missing groups missing
     df_adm = (
-        df[["date", "Total", "adjusted_population", adm1c] + cols_ipc]
-        .groupby(["date", adm1c])
-        .agg(lambda x: np.nan if x.isnull().all() else x.sum())
+        df[["date"] + adm_cols + cols_pop]
+        .astype({c: "float64" for c in cols_pop})
+        .groupby(["date"] + adm_cols, observed=True)
+        .sum(min_count=1)
         .reset_index()
     )
     for period in ["CS", "ML1", "ML2"]:
-        df_adm[f"pop_{period}"] = df_adm[[f"{period}_{i}" for i in range(1, 6)]].sum(
-            axis=1, min_count=1
-        )
+        pop_phases = df_adm[[f"{period}_{i}" for i in range(1, 6)]]
+        df_adm[f"pop_{period}"] = pop_phases.sum(axis=1, min_count=1)
+        if add_phases:
+            df_adm[period] = np.where(
+                pop_phases.fillna(0).to_numpy().max(axis=1) > 0,
+                pop_phases.fillna(0).to_numpy().argmax(axis=1) + 1,
+                np.nan,
+            )
 
-    return df_adm
+    if add_phases:
+        # the phases directly after the admin names, as in the output of main
+        phases = ["CS", "ML1", "ML2"]
+        df_adm = df_adm[
+            ["date"] + adm_cols + phases + cols_pop + [f"pop_{p}" for p in phases]
+        ]
+    return apply_schema(
+        df_adm,
+        admin_cols=adm_cols,
+        phase_cols=["CS", "ML1", "ML2"],
+        pop_cols=population_columns(df_adm),
+    )
 
 
-def main(country_iso3, suffix, config_file="config.yml"):
+def main(
+    country_iso3,
+    suffix,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    weighting="area",
+    tile_size=None,
+    config_file="config.yml",
+    results_db=None,
+    admin_level=2,
+    dates=None,
+):
     """
     This script takes the FEWSNET IPC shapefiles provided by on fews.net and overlays them with an admin2 shapefile, in order
     to provide an IPC value for each admin2 district. In the case where there are multiple values per district, the IPC value
     with the maximum area is selected.
 
+    With admin_level 3 the IPC value is computed per admin3 (e.g. woreda), using path_admin3_shp and shp_adm3c in the config.
+    The admin2 population is then distributed over the admin3s by area, and the admin3 results are aggregated to admin2 and admin1.
+    The per-admin loop of return_max_cs does not scale to admin3, so the crosswalk is used if weighting is "area".
+
     In FEWSNET IPC, there are 3 possible categories of maps - 'CS' (Current State), 'ML1' (3 months projection), 'ML2' (6 months projection).
     Any one of these is compatible with the script.
 
@@ -480,18 +882,37 @@ def main(country_iso3, suffix, config_file="config.yml"):
     Args:
         country_iso3: string with iso3 code
         suffix: string to attach to the output files name
+        simplify_tolerance: if given, tolerance in meters with which the shapes are simplified before the overlay
+        use_crosswalk: if True, compute the IPC levels from the cached admin x FewsNet crosswalk
+        weighting: "area" or "population", whether the IPC level per admin2 is the one with the largest area or WorldPop population
+        tile_size: if given, stream the WorldPop rasters in tiles of tile_size x tile_size cells for the population weighting.
+            The 100m rasters are always processed in tiles, by default of DEFAULT_TILE_SIZE cells
         config_file: path to config file
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+        admin_level: 2 or 3, the admin level on which the IPC level is computed
+        dates: list of FewsNet dates to process, by default fewsnet_dates in the config
+
+    Returns:
+        df_ipcpop: DataFrame with the IPC level and population per admin2 (or admin3), as saved to the admin2 (or admin3) csv
+        df_adm1: DataFrame with the population per IPC level per admin1, as saved to the admin1 csv
+        df_adm2: only for admin_level 3, DataFrame with the population per IPC level per admin2, as saved to the admin2 csv
     """
+    if int(admin_level) not in (2, 3):
+        raise ValueError(
+            f"Admin level {admin_level} is not supported, expected 2 or 3. The admin1 results are aggregated from admin2"
+        )
     parameters = parse_yaml(config_file)[country_iso3]
 
     country = parameters["country_name"]
     iso2_code = parameters["iso2_code"]
     region = parameters["region"]
     regioncode = parameters["regioncode"]
-    admin2_shp = parameters["path_admin2_shp"]
+    admin_level = int(admin_level)
+    admin_shp = parameters[f"path_admin{admin_level}_shp"]
     shp_adm0c = parameters["shp_adm0c"]
     shp_adm1c = parameters["shp_adm1c"]
     shp_adm2c = parameters["shp_adm2c"]
+    shp_adm3c = parameters["shp_adm3c"] if admin_level == 3 else None
 
     pop_file = parameters["pop_filename"]
     POP_PATH = f"{country}/Data/{pop_file}"
@@ -500,20 +921,39 @@ def main(country_iso3, suffix, config_file="config.yml"):
     pop_col = parameters["pop_col"]
     admin1_mapping = parameters["admin1_mapping"]
     admin2_mapping = parameters["admin2_mapping"]
-    fewsnet_dates = parameters["fewsnet_dates"]
+    fewsnet_dates = dates or parameters["fewsnet_dates"]
 
     PATH_FEWSNET = "Data/FewsNetRaw/"
-    ADMIN2_PATH = f"{country}/Data/{admin2_shp}"
+    ADMIN_PATH = f"{country}/Data/{admin_shp}"
     PERIOD_LIST = ["CS", "ML1", "ML2"]
     RESULT_FOLDER = f"{country}/Data/FewsNetProcessed/"
     # create output dir if it doesn't exist yet
     Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
 
+    pop_paths = None
+    if weighting == "population":
+        resolution = parameters.get("worldpop_resolution", DEFAULT_RESOLUTION)
+        pop_paths = find_pop_paths(f"{country}/Data/WorldPop", country_iso3, resolution)
+        if tile_size is None and resolution != DEFAULT_RESOLUTION:
+            # the high resolution rasters do not fit in memory as a whole
+            tile_size = DEFAULT_TILE_SIZE
+        if not pop_paths:
+            raise FileNotFoundError(
+                f"No WorldPop rasters found in {country}/Data/WorldPop, which are needed for population weighting"
+            )
+
+    if shp_adm3c and weighting == "area" and not use_crosswalk:
+        logger.info("Using the crosswalk to compute the IPC level per admin3")
+        use_crosswalk = True
+
+    index = admin_date_index(
+        fewsnet_dates, ADMIN_PATH, shp_adm0c, shp_adm1c, shp_adm2c, shp_adm3c
+    )
     perioddf_dict = {}
     for period in PERIOD_LIST:
         perioddf_dict[period] = gen_csml1m2(
             PATH_FEWSNET,
-            ADMIN2_PATH,
+            ADMIN_PATH,
             period,
             fewsnet_dates,
             shp_adm0c,
@@ -522,12 +962,21 @@ def main(country_iso3, suffix, config_file="config.yml"):
             region,
             regioncode,
             iso2_code,
+            simplify_tolerance,
+            use_crosswalk,
+            weighting,
+            pop_paths,
+            index,
+            tile_size,
+            shp_adm3c,
         )
 
-    df_allipc = merge_ipcperiod(perioddf_dict, shp_adm0c, shp_adm1c, shp_adm2c)
+    df_allipc = merge_ipcperiod(
+        perioddf_dict, shp_adm0c, shp_adm1c, shp_adm2c, index, shp_adm3c
+    )
     # check whether names of adm regions in boundary and population files don't correspond
     check_missingadmins(
-        ADMIN2_PATH,
+        ADMIN_PATH,
         POP_PATH,
         shp_adm1c,
         shp_adm2c,
@@ -545,6 +994,10 @@ def main(country_iso3, suffix, config_file="config.yml"):
         admin2_mapping=admin2_mapping,
         admin1_mapping=admin1_mapping,
     )
+    if shp_adm3c:
+        df_pop = distribute_population(
+            df_pop, ADMIN_PATH, pop_adm1c, pop_adm2c, shp_adm1c, shp_adm2c, shp_adm3c
+        )
 
     df_ipcpop = merge_ipcpop(
         df_allipc,
@@ -554,15 +1007,205 @@ def main(country_iso3, suffix, config_file="config.yml"):
         pop_adm2c,
         shp_adm1c,
         shp_adm2c,
+        shp_adm3c,
     )
 
-    df_ipcpop.to_csv(f"{RESULT_FOLDER}{country}_fewsnet_admin2{suffix}.csv")
+    with timed_stage("write", admin_level=admin_level):
+        df_ipcpop.to_csv(
+            f"{RESULT_FOLDER}{country}_fewsnet_admin{admin_level}{suffix}.csv"
+        )
+
+    df_adm2 = df_ipcpop
+    if shp_adm3c:
+        df_adm2 = aggr_admin(
+            df_ipcpop, [shp_adm0c, shp_adm1c, shp_adm2c], add_phases=True
+        )
+        with timed_stage("write", admin_level=2):
+            df_adm2.to_csv(f"{RESULT_FOLDER}{country}_fewsnet_admin2{suffix}.csv")
 
     df_adm1 = aggr_admin1(df_ipcpop, shp_adm1c)
-    df_adm1.to_csv(f"{RESULT_FOLDER}{country}_fewsnet_admin1{suffix}.csv")
+    with timed_stage("write", admin_level=1):
+        df_adm1.to_csv(f"{RESULT_FOLDER}{country}_fewsnet_admin1{suffix}.csv")
+    if results_db:
+        phases = [phase_rows(df_adm2, "FewsNet", 2, shp_adm1c, shp_adm2c)]
+        populations = [
+            population_rows(df_adm2, "FewsNet", 2, shp_adm1c, shp_adm2c),
+            population_rows(df_adm1, "FewsNet", 1, shp_adm1c),
+        ]
+        # admin3 runs save the admin3 results next to their admin2 and admin1 aggregates
+        if shp_adm3c:
+            phases.append(
+                phase_rows(df_ipcpop, "FewsNet", 3, shp_adm1c, shp_adm2c, shp_adm3c)
+            )
+            populations.append(
+                population_rows(
+                    df_ipcpop, "FewsNet", 3, shp_adm1c, shp_adm2c, shp_adm3c
+                )
+            )
+        with timed_stage("write", store="sqlite"):
+            save_results(
+                "process_fewsnet",
+                country_iso3,
+                suffix,
+                {
+                    "simplify_tolerance": simplify_tolerance,
+                    "use_crosswalk": use_crosswalk,
+                    "weighting": weighting,
+                    "admin_level": admin_level,
+                },
+                phases=pd.concat(phases, ignore_index=True),
+                populations=pd.concat(populations, ignore_index=True),
+                db_path=results_db,
+            )
+    if shp_adm3c:
+        return df_ipcpop, df_adm1, df_adm2
+    return df_ipcpop, df_adm1
+
+
+def process_countries(
+    countries,
+    suffix,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    weighting="area",
+    tile_size=None,
+    config_file="config.yml",
+    processes=None,
+    results_db=None,
+    admin_level=2,
+):
+    """
+    Run main for multiple countries, where the regional FewsNet files are only read once per region
+    The countries are grouped by their FewsNet region. Per region all regional files for the dates of the countries are read once,
+    after which the countries are processed in parallel by a pool of workers that all receive these layers.
+    The outputs per country are the same as when running main for that country alone.
+    Args:
+        countries: list of iso3 codes
+        suffix: string to attach to the output files name
+        simplify_tolerance: if given, tolerance in meters with which the shapes are simplified before the overlay
+        use_crosswalk: if True, compute the IPC levels from the cached admin x FewsNet crosswalk
+        weighting: "area" or "population", whether the IPC level per admin2 is the one with the largest area or WorldPop population
+        tile_size: if given, stream the WorldPop rasters in tiles of tile_size x tile_size cells for the population weighting.
+            The 100m rasters are always processed in tiles, by default of DEFAULT_TILE_SIZE cells
+        config_file: path to config file
+        processes: maximum number of worker processes, defaults to the number of cpus
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+        admin_level: 2 or 3, the admin level on which the IPC level is computed
+    """
+    if int(admin_level) not in (2, 3):
+        raise ValueError(
+            f"Admin level {admin_level} is not supported, expected 2 or 3. The admin1 results are aggregated from admin2"
+        )
+    config = parse_yaml(config_file)
+    PATH_FEWSNET = "Data/FewsNetRaw/"
+    PERIOD_LIST = ["CS", "ML1", "ML2"]
+
+    regions = {}
+    for country_iso3 in countries:
+        parameters = config[country_iso3]
+        regions.setdefault((parameters["region"], parameters["regioncode"]), []).append(
+            country_iso3
+        )
+
+    for (region, regioncode), region_countries in regions.items():
+        dates = sorted(
+            {d for c in region_countries for d in config[c]["fewsnet_dates"]}
+        )
+        layers = {}
+        for d in dates:
+            for period in PERIOD_LIST:
+                shape_region = (
+                    f"{PATH_FEWSNET}{region}{d}/{regioncode}_{d}_{period}.shp"
+                )
+                if os.path.exists(shape_region):
+                    with timed_stage("read", date=d, period=period, region=region):
+                        layers[(shape_region, simplify_tolerance)] = load_layer(
+                            shape_region, simplify_tolerance
+                        )
+        logger.info(
+            f"Read {len(layers)} {region} FewsNet files for {', '.join(region_countries)}"
+        )
+        with ProcessPoolExecutor(
+            max_workers=min(processes or os.cpu_count(), len(region_countries)),
+            initializer=set_fewsnet_layers,
+            initargs=(layers,),
+        ) as executor:
+            futures = {
+                c: executor.submit(
+                    collect_stages,
+                    main,
+                    c,
+                    suffix,
+                    simplify_tolerance,
+                    use_crosswalk,
+                    weighting,
+                    tile_size,
+                    config_file,
+                    results_db,
+                    admin_level,
+                )
+                for c in region_countries
+            }
+            for c, future in futures.items():
+                # raise the exception of a country, if any
+                _, records = future.result()
+                for r in records:
+                    r["unit"]["country"] = c
+                add_stage_records(records)
+                logger.info(f"Finished processing {c}")
+
+
+def fewsnet_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    multi_country_arguments(parser)
+    # the IPC level is computed on admin2 or admin3, the admin1 results are aggregated from admin2
+    admin_level_arguments(parser, levels=(2, 3), default=2)
+    simplify_arguments(parser)
+    crosswalk_arguments(parser)
+    tile_size_arguments(parser)
+    results_db_arguments(parser)
+    parser.add_argument(
+        "--weighting",
+        default="area",
+        choices=["area", "population"],
+        help="Select the IPC phase per admin by the largest area or the largest WorldPop population",
+    )
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    args = parse_args(fewsnet_arguments)
     config_logger(level="warning")
-    main(args.country_iso3.upper(), args.suffix)
+    if args.all_countries or "," in args.country_iso3:
+        if args.all_countries:
+            countries = list(parse_yaml("config.yml").keys())
+        else:
+            countries = [c.strip().upper() for c in args.country_iso3.split(",")]
+        with run_report("process_fewsnet_multi", args.trace_memory), profile_run(
+            "process_fewsnet", "multi", args.profile
+        ):
+            process_countries(
+                countries,
+                args.suffix,
+                args.simplify_tolerance,
+                args.crosswalk,
+                args.weighting,
+                args.tile_size,
+                results_db=args.results_db,
+                admin_level=args.admin_level,
+            )
+    else:
+        with run_report(
+            f"process_fewsnet_{args.country_iso3.upper()}", args.trace_memory
+        ), profile_run("process_fewsnet", args.country_iso3.upper(), args.profile):
+            main(
+                args.country_iso3.upper(),
+                args.suffix,
+                args.simplify_tolerance,
+                args.crosswalk,
+                args.weighting,
+                args.tile_size,
+                results_db=args.results_db,
+                admin_level=args.admin_level,
+            )
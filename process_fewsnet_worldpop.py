@@ -1,17 +1,57 @@
 import pandas as pd
 import os
+import glob
 import geopandas as gpd
-from rasterstats import zonal_stats
 import numpy as np
-from utils import parse_args, parse_yaml, config_logger
+import hashlib
+import json
+from utils import (
+    parse_args,
+    results_db_arguments,
+    resume_arguments,
+    tile_size_arguments,
+    crosswalk_arguments,
+    simplify_arguments,
+    parse_yaml,
+    config_logger,
+    timed_stage,
+    frame_counts,
+    run_report,
+    profile_run,
+)
+from geometries import load_layer
+from crosswalk import load_crosswalk, phase_totals
+from raster_utils import (
+    parallel_zonal_sums,
+    tiled_population,
+    worldpop_filename,
+    DEFAULT_RESOLUTION,
+    DEFAULT_TILE_SIZE,
+)
+from results_store import save_results, population_rows
+from schema import apply_schema, population_columns
 from pathlib import Path
 import logging
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
+# name of the checkpoint with the total population per admin of a date, next to the checkpoints of the periods
+TOTAL_UNIT = "total"
 
-def merge_fewsnet_population(fews_path, adm_path, pop_path, date, period, adm1c, adm2c):
+
+def merge_fewsnet_population(
+    fews_path,
+    adm_path,
+    pop_path,
+    date,
+    period,
+    adm1c,
+    adm2c,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    tile_size=None,
+):
     """
     Compute the population per IPC phase per adm2 region for the data defined in fews_path
     Args:
@@ -22,23 +62,45 @@ def merge_fewsnet_population(fews_path, adm_path, pop_path, date, period, adm1c,
         period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term projection)
         adm1c: column name of the admin1 level name, in adm_path data
         adm2c: column name of the admin2 level name, in adm_path data
+        simplify_tolerance: if given, tolerance in meters with which the FewsNet and admin shapes are simplified before the overlay
+        use_crosswalk: if True, compute the population from the cached admin x FewsNet crosswalk instead of an overlay
+        tile_size: if given, stream the raster in tiles of tile_size x tile_size cells instead of an overlay, see tiled_fewsnet_population
 
     Returns:
         df_gp: DataFrame with the population per IPC phase per Admin2
     """
-    df_fews = gpd.read_file(fews_path)
-    df_adm = gpd.read_file(adm_path)
+    with timed_stage("read", date=date, period=period) as stage:
+        df_fews = load_layer(fews_path, simplify_tolerance)
+        df_adm = load_layer(adm_path, simplify_tolerance)
+        stage.update(frame_counts(df_fews))
+    if tile_size:
+        with timed_stage("zonal", date=date, period=period) as stage:
+            df_gp = tiled_fewsnet_population(
+                df_fews, df_adm, pop_path, date, period, adm1c, adm2c, tile_size
+            )
+            stage.update(frame_counts(df_gp))
+        return df_gp
+    if use_crosswalk:
+        with timed_stage("overlay", date=date, period=period) as stage:
+            df_gp = crosswalk_population(
+                df_fews, df_adm, pop_path, date, period, adm1c, adm2c
+            )
+            stage.update(frame_counts(df_gp))
+        return df_gp
     # get fewsnet area (livelihood) per admin region in df_adm (generally admin2)
     # overlay takes really long to compute, but could not find a better method
-    df_fewsadm = gpd.overlay(df_adm, df_fews, how="intersection")
+    with timed_stage("overlay", date=date, period=period) as stage:
+        df_fewsadm = gpd.overlay(df_adm, df_fews, how="intersection")
+        stage.update(frame_counts(df_fewsadm))
 
     # calculate population per "geometry"
     # in pop_path, the value per cell is the population of that cell, so we want the sum of them
     # in the calculation a cell is considered to belong to an area if the center of that cell is inside the area.
     # see https://pythonhosted.org/rasterstats/manual.html#rasterization-strategy
-    df_fewsadm["pop"] = pd.DataFrame(
-        zonal_stats(vectors=df_fewsadm["geometry"], raster=pop_path, stats="sum")
-    )["sum"]
+    # the fragments are divided over multiple processes, which share the decoded raster
+    with timed_stage("zonal", date=date, period=period) as stage:
+        df_fewsadm["pop"] = parallel_zonal_sums(df_fewsadm["geometry"], pop_path)
+        stage.update(frame_counts(df_fewsadm))
 
     # convert the period values (1 to 5) to str
     df_fewsadm[period] = df_fewsadm[period].astype(int).astype(str)
@@ -54,6 +116,140 @@ def merge_fewsnet_population(fews_path, adm_path, pop_path, date, period, adm1c,
     return df_gp
 
 
+def crosswalk_population(df_fews, df_adm, pop_path, date, period, adm1c, adm2c):
+    """
+    Compute the population per IPC phase per adm2 region, with the same result as merge_fewsnet_population,
+    as the product of the cached admin x FewsNet population crosswalk and the phases of the FewsNet polygons
+    Args:
+        df_fews: GeoDataFrame with the FewsNet data
+        df_adm: GeoDataFrame with the admin2 boundaries
+        pop_path: path to the raster file with population data
+        date: date of the FewsNet data
+        period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term projection)
+        adm1c: column name of the admin1 level name, in df_adm
+        adm2c: column name of the admin2 level name, in df_adm
+
+    Returns:
+        df_gp: DataFrame with the population per IPC phase per Admin2
+    """
+    df_fews = df_fews.reset_index(drop=True)
+    df_adm = df_adm.reset_index(drop=True)
+    crosswalk = load_crosswalk(df_adm, df_fews, pop_path)
+    phases = df_fews[period].astype(int)
+    values, pop = phase_totals(crosswalk["pop"], phases)
+    _, area = phase_totals(crosswalk["area"], phases)
+    # only keep the admins and phases that occur in the intersection, as the overlay would return
+    adm_overlap = area.sum(axis=1) > 0
+    phase_overlap = area[adm_overlap].sum(axis=0) > 0
+    df_gp = pd.DataFrame(
+        pop[np.ix_(adm_overlap, phase_overlap)],
+        columns=[f"{period}_{v}" for v in values[phase_overlap]],
+    )
+    df_gp.insert(0, adm1c, df_adm.loc[adm_overlap, adm1c].to_numpy())
+    df_gp.insert(1, adm2c, df_adm.loc[adm_overlap, adm2c].to_numpy())
+    df_gp = df_gp.groupby([adm1c, adm2c], as_index=False).sum()
+    df_gp["date"] = pd.to_datetime(date, format="%Y%m")
+    return df_gp
+
+
+def tiled_fewsnet_population(
+    df_fews, df_adm, pop_path, date, period, adm1c, adm2c, tile_size=DEFAULT_TILE_SIZE
+):
+    """
+    Compute the population per IPC phase per adm2 region, with the same result as merge_fewsnet_population,
+    by rasterizing the admin and FewsNet shapes per tile of the population raster instead of an overlay
+    The memory use only depends on tile_size, which makes it possible to use the 100m WorldPop rasters
+    Args:
+        df_fews: GeoDataFrame with the FewsNet data
+        df_adm: GeoDataFrame with the admin2 boundaries
+        pop_path: path to the raster file with population data
+        date: date of the FewsNet data
+        period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term projection)
+        adm1c: column name of the admin1 level name, in df_adm
+        adm2c: column name of the admin2 level name, in df_adm
+        tile_size: number of rows and columns of a tile
+
+    Returns:
+        df_gp: DataFrame with the population per IPC phase per Admin2
+    """
+    df_adm = df_adm.reset_index(drop=True)
+    phases = df_fews[period].astype(int).to_numpy()
+    values = np.unique(phases)
+    # code 0 are the cells that are not covered by FewsNet
+    pop, cells = tiled_population(
+        pop_path,
+        df_adm,
+        df_fews,
+        np.searchsorted(values, phases) + 1,
+        len(values) + 1,
+        tile_size,
+    )
+    pop, cells = pop[:, 1:], cells[:, 1:]
+    # only keep the admins and phases that cover cells, as the overlay would return
+    adm_overlap = cells.sum(axis=1) > 0
+    phase_overlap = cells[adm_overlap].sum(axis=0) > 0
+    df_gp = pd.DataFrame(
+        pop[np.ix_(adm_overlap, phase_overlap)],
+        columns=[f"{period}_{v}" for v in values[phase_overlap]],
+    )
+    df_gp.insert(0, adm1c, df_adm.loc[adm_overlap, adm1c].to_numpy())
+    df_gp.insert(1, adm2c, df_adm.loc[adm_overlap, adm2c].to_numpy())
+    df_gp = df_gp.groupby([adm1c, adm2c], as_index=False).sum()
+    df_gp["date"] = pd.to_datetime(date, format="%Y%m")
+    return df_gp
+
+
+def checkpoint_folder(result_folder, suffix, settings):
+    """
+    Return the folder with the checkpoints of a run with the given settings
+    Runs with other settings, e.g. another simplification tolerance, have their own folder such that they never mix
+    """
+    key = hashlib.sha1(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()[:12]
+    return f"{result_folder}Checkpoints/{key}{suffix}/"
+
+
+def inputs_signature(paths):
+    """
+    Return a short hash of the size and modification time of the files in paths, and of all files of the shapefiles among them
+    A checkpoint is named with the signature of its inputs, such that a corrected FewsNet release or WorldPop raster is not
+    resumed from a checkpoint that was computed from the old file
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        files = (
+            sorted(glob.glob(f"{os.path.splitext(path)[0]}.*"))
+            if path.endswith(".shp")
+            else [path]
+        )
+        for f in files:
+            stat = os.stat(f)
+            h.update(f"{f}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return h.hexdigest()[:12]
+
+
+def unit_checkpoint(folder_checkpoint, date, unit, paths):
+    """
+    Return the path of the checkpoint of a date and unit (a period or TOTAL_UNIT) computed from the files in paths
+    """
+    return f"{folder_checkpoint}{date}_{unit}_{inputs_signature(paths)}.pkl"
+
+
+def save_checkpoint(df, path):
+    """
+    Save df to path as pickle, which keeps the dtypes. The file is first written to a temporary file that is then renamed,
+    such that a killed run never leaves a partly written checkpoint
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    # checkpoints of the same date and unit computed from older versions of the inputs are outdated
+    for old_path in glob.glob(f"{path.rsplit('_', 1)[0]}_*.pkl"):
+        if old_path != path:
+            os.remove(old_path)
+
+
 def combine_fewsnet_projections(
     country_iso3,
     dates,
@@ -67,10 +263,19 @@ def combine_fewsnet_projections(
     country_iso2,
     result_folder,
     suffix,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    resolution=DEFAULT_RESOLUTION,
+    tile_size=None,
+    resume=False,
 ):
     """
     Retrieve all FewsNet data, and calculate the population per IPC phase per date-admin combination
     The results are saved to a csv, one containing the admin2 calculations and one the admin1.
+    The result of every date-period combination is saved as a checkpoint as soon as it is computed. With resume, the combinations
+    of which a checkpoint exists are not computed again, such that a run that was killed or failed can continue where it stopped.
+    The checkpoints are named with the size and modification time of their input files, so changed inputs are computed again.
+    Combinations that fail or of which an input file is missing are skipped, and listed in a failures csv in result_folder.
     Args:
         country_iso3: string with iso3 code
         dates: list of dates for which FewsNet data should be included
@@ -84,9 +289,34 @@ def combine_fewsnet_projections(
         iso2_code: iso2 code of the country of interest
         result_folder: path to folder to which to save the output
         suffix: string to attach to the output files name
+        simplify_tolerance: if given, tolerance in meters with which the FewsNet and admin shapes are simplified before the overlay
+        use_crosswalk: if True, compute the population from the cached admin x FewsNet crosswalk instead of an overlay
+        resolution: resolution of the WorldPop rasters, "1km" or "100m"
+        tile_size: if given, stream the rasters in tiles of tile_size x tile_size cells instead of the overlay and zonal statistics
+        resume: if True, use the checkpoints of a previous run with the same settings
+
+    Returns:
+        df: DataFrame with the population per IPC phase per date-admin2 combination, None if no data was found
+        df_adm1: DataFrame with the population per IPC phase per date-admin1 combination, None if no data was found
     """
     # all periods in the FewsNet data
     period_list = ["CS", "ML1", "ML2"]
+    folder_checkpoint = checkpoint_folder(
+        result_folder,
+        suffix,
+        {
+            "admin_path": admin_path,
+            "folder_fews": folder_fews,
+            "folder_pop": folder_pop,
+            "simplify_tolerance": simplify_tolerance,
+            "use_crosswalk": use_crosswalk,
+            "resolution": resolution,
+            "tile_size": tile_size,
+        },
+    )
+    Path(folder_checkpoint).mkdir(parents=True, exist_ok=True)
+    failures = []
+    n_resumed = 0
     df = gpd.GeoDataFrame()
     # initialize progress bar
     pbar = tqdm(dates)
@@ -108,21 +338,63 @@ def combine_fewsnet_projections(
                 fews_path = fews_country_path
 
             # path to population data
-            pop_path = f"{folder_pop}/{country_iso3.lower()}_ppp_{d[:4]}_1km_Aggregated_UNadj.tif"
+            pop_path = (
+                f"{folder_pop}/{worldpop_filename(country_iso3, d[:4], resolution)}"
+            )
 
             if fews_path and os.path.exists(pop_path):
-                df_fews = merge_fewsnet_population(
-                    fews_path, admin_path, pop_path, d, period, shp_adm1c, shp_adm2c
+                checkpoint_path = unit_checkpoint(
+                    folder_checkpoint, d, period, [fews_path, pop_path, admin_path]
                 )
+                if resume and os.path.exists(checkpoint_path):
+                    df_fews_list.append(pd.read_pickle(checkpoint_path))
+                    n_resumed += 1
+                    continue
+                try:
+                    df_fews = merge_fewsnet_population(
+                        fews_path,
+                        admin_path,
+                        pop_path,
+                        d,
+                        period,
+                        shp_adm1c,
+                        shp_adm2c,
+                        simplify_tolerance,
+                        use_crosswalk,
+                        tile_size,
+                    )
+                except Exception as e:
+                    logger.error(
+                        f"Processing {d} and {period} failed: {e}. Skipping to next date and period."
+                    )
+                    failures.append(
+                        {
+                            "date": d,
+                            "period": period,
+                            "reason": f"{type(e).__name__}: {e}",
+                        }
+                    )
+                    continue
+                save_checkpoint(df_fews, checkpoint_path)
                 df_fews_list.append(df_fews)
             elif not fews_path:
                 logger.warning(
                     f"FewsNet file for {d} and {period} not found. Skipping to next date and period."
                 )
+                failures.append(
+                    {"date": d, "period": period, "reason": "FewsNet file not found"}
+                )
             elif not os.path.exists(pop_path):
                 logger.warning(
                     f"Worldpop file for {d} not found. Skipping to next date"
                 )
+                failures.append(
+                    {
+                        "date": d,
+                        "period": period,
+                        "reason": f"WorldPop file {pop_path} not found",
+                    }
+                )
 
         if df_fews_list:
             # concat the dfs of the different "periods", with an unique entry per date-adm1-adm2 combination
@@ -138,10 +410,41 @@ def combine_fewsnet_projections(
                     df_comb[i] = 0
 
             # calculate total population of every admin, to use for comparison of population given by intersection of admin shape and fewsnet
-            df_adm = gpd.read_file(admin_path)
-            df_adm["pop"] = pd.DataFrame(
-                zonal_stats(vectors=df_adm["geometry"], raster=pop_path, stats="sum")
-            )["sum"]
+            pop_path = (
+                f"{folder_pop}/{worldpop_filename(country_iso3, d[:4], resolution)}"
+            )
+            total_path = unit_checkpoint(
+                folder_checkpoint, d, TOTAL_UNIT, [pop_path, admin_path]
+            )
+            if resume and os.path.exists(total_path):
+                df_adm = pd.read_pickle(total_path)
+            else:
+                try:
+                    with timed_stage("zonal", date=d, period=TOTAL_UNIT) as stage:
+                        df_adm = load_layer(admin_path)
+                        if tile_size:
+                            df_adm["pop"] = tiled_population(
+                                pop_path, df_adm, tile_size=tile_size
+                            )[0][:, 0]
+                        else:
+                            df_adm["pop"] = parallel_zonal_sums(
+                                df_adm["geometry"], pop_path
+                            )
+                        stage.update(frame_counts(df_adm))
+                except Exception as e:
+                    logger.error(
+                        f"Computing the total population for {d} failed: {e}. Skipping to next date."
+                    )
+                    failures.append(
+                        {
+                            "date": d,
+                            "period": TOTAL_UNIT,
+                            "reason": f"{type(e).__name__}: {e}",
+                        }
+                    )
+                    continue
+                df_adm = pd.DataFrame(df_adm[[shp_adm1c, shp_adm2c, "pop"]])
+                save_checkpoint(df_adm, total_path)
 
             # calculate population per period over all IPC levels
             for period in period_list:
@@ -181,29 +484,68 @@ def combine_fewsnet_projections(
 
             df = df.append(df_comb, ignore_index=True)
 
+    if n_resumed:
+        logger.info(
+            f"Resumed {n_resumed} date-period combinations from the checkpoints in {folder_checkpoint}"
+        )
+    failures_path = (
+        f"{result_folder}{country_iso3.lower()}_fewsnet_worldpop_failures{suffix}.csv"
+    )
+    if failures:
+        pd.DataFrame(failures).to_csv(failures_path, index=False)
+        logger.warning(
+            f"{len(failures)} date-period combinations failed or had missing input, see {failures_path}"
+        )
+    elif os.path.exists(failures_path):
+        # the failures of a previous run are solved
+        os.remove(failures_path)
+
     if not df.empty:
         # set general admin names
         df.rename(columns={shp_adm1c: "ADMIN1", shp_adm2c: "ADMIN2"}, inplace=True)
+        pop_cols = population_columns(df)
+        df = apply_schema(df, admin_cols=["ADMIN1", "ADMIN2"], pop_cols=pop_cols)
         # TODO: decide what kind of filename we want to use for the output, i.e. do we always want to overwrite the output or not
-        df.to_csv(
-            f"{result_folder}{country_iso3.lower()}_admin2_fewsnet_worldpop{suffix}.csv"
-        )
+        with timed_stage("write", admin_level=2):
+            df.to_csv(
+                f"{result_folder}{country_iso3.lower()}_admin2_fewsnet_worldpop{suffix}.csv"
+            )
         # aggregate to admin1 by summing (and set to nan if no data for a date-adm1 combination
-        df_adm1 = (
-            df.drop("ADMIN2", axis=1)
-            .groupby(["date", "ADMIN1"])
-            .agg(lambda x: np.nan if x.isnull().all() else x.sum())
-            .reset_index()
-        )
+        with timed_stage("aggregate", admin_level=1) as stage:
+            df_adm1 = (
+                # sum in float64, since the admin1 totals can be too large for float32
+                df.drop("ADMIN2", axis=1)
+                .astype({c: "float64" for c in pop_cols})
+                .groupby(["date", "ADMIN1"], observed=True)
+                .agg(lambda x: np.nan if x.isnull().all() else x.sum())
+                .reset_index()
+            )
+            stage.update(frame_counts(df_adm1))
         df_adm1.rename(columns={"pop_ADMIN2": "pop_ADMIN1"}, inplace=True)
-        df_adm1.to_csv(
-            f"{result_folder}{country_iso3.lower()}_admin1_fewsnet_worldpop{suffix}.csv"
+        df_adm1 = apply_schema(
+            df_adm1, admin_cols=["ADMIN1"], pop_cols=population_columns(df_adm1)
         )
+        with timed_stage("write", admin_level=1):
+            df_adm1.to_csv(
+                f"{result_folder}{country_iso3.lower()}_admin1_fewsnet_worldpop{suffix}.csv"
+            )
+        return df, df_adm1
     else:
         logger.warning("No data found for the given dates")
+        return None, None
 
 
-def main(country_iso3, suffix, config_file="config.yml"):
+def main(
+    country_iso3,
+    suffix,
+    simplify_tolerance=None,
+    use_crosswalk=False,
+    tile_size=None,
+    resume=False,
+    config_file="config.yml",
+    results_db=None,
+    dates=None,
+):
     """
     This script computes the population per IPC phase per data - admin2 region combination.
     The IPC phase is retrieved from the FewsNet data, which publishes their data in shapefiles, of three periods namely current situation (CS), near-term projection (ML1) and mid-term projection (ML2)
@@ -211,7 +553,17 @@ def main(country_iso3, suffix, config_file="config.yml"):
     Args:
         country_iso3: string with iso3 code
         suffix: string to attach to the output files name
+        simplify_tolerance: if given, tolerance in meters with which the shapes are simplified before the overlay
+        use_crosswalk: if True, compute the population from the cached admin x FewsNet crosswalk
+        tile_size: if given, stream the WorldPop rasters in tiles of tile_size x tile_size cells.
+            The 100m rasters are always processed in tiles, by default of DEFAULT_TILE_SIZE cells
+        resume: if True, skip the date-period combinations of which a checkpoint exists from a previous run
         config_file: path to config file
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+        dates: list of FewsNet dates to process, by default fewsnet_dates in the config
+
+    Returns:
+        the admin2 and admin1 DataFrames that are saved to csv, see combine_fewsnet_projections
     """
     parameters = parse_yaml(config_file)[country_iso3]
 
@@ -219,10 +571,14 @@ def main(country_iso3, suffix, config_file="config.yml"):
     region = parameters["region"]
     regioncode = parameters["regioncode"]
     country_iso2 = parameters["iso2_code"]
-    dates = parameters["fewsnet_dates"]
+    dates = dates or parameters["fewsnet_dates"]
     admin2_shp = parameters["path_admin2_shp"]
     shp_adm1c = parameters["shp_adm1c"]
     shp_adm2c = parameters["shp_adm2c"]
+    resolution = parameters.get("worldpop_resolution", DEFAULT_RESOLUTION)
+    if tile_size is None and resolution != DEFAULT_RESOLUTION:
+        # the high resolution rasters do not fit in memory as a whole
+        tile_size = DEFAULT_TILE_SIZE
 
     # TODO: to make variables more generalizable with a config.py. Inspiration from pa-covid-model-parameterization
     # pop_dir = os.path.join(config.DIR_PATH, country, config.POP_DIR)
@@ -232,7 +588,7 @@ def main(country_iso3, suffix, config_file="config.yml"):
     RESULT_FOLDER = f"{country}/Data/FewsNetWorldPop/"
     # create output dir if it doesn't exist yet
     Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
-    combine_fewsnet_projections(
+    df, df_adm1 = combine_fewsnet_projections(
         country_iso3,
         dates,
         FOLDER_FEWSNET,
@@ -245,10 +601,59 @@ def main(country_iso3, suffix, config_file="config.yml"):
         country_iso2,
         RESULT_FOLDER,
         suffix,
+        simplify_tolerance,
+        use_crosswalk,
+        resolution,
+        tile_size,
+        resume,
     )
+    if results_db and df is not None:
+        with timed_stage("write", store="sqlite"):
+            save_results(
+                "process_fewsnet_worldpop",
+                country_iso3,
+                suffix,
+                {
+                    "simplify_tolerance": simplify_tolerance,
+                    "use_crosswalk": use_crosswalk,
+                    "resolution": resolution,
+                    "tile_size": tile_size,
+                },
+                populations=pd.concat(
+                    [
+                        population_rows(df, "FewsNetWorldPop", 2, "ADMIN1", "ADMIN2"),
+                        population_rows(df_adm1, "FewsNetWorldPop", 1, "ADMIN1"),
+                    ],
+                    ignore_index=True,
+                ),
+                db_path=results_db,
+            )
+    return df, df_adm1
+
+
+def worldpop_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    simplify_arguments(parser)
+    crosswalk_arguments(parser)
+    tile_size_arguments(parser)
+    resume_arguments(parser)
+    results_db_arguments(parser)
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    args = parse_args(worldpop_arguments)
     config_logger(level="warning")
-    main(args.country_iso3.upper(), args.suffix)
+    with run_report(
+        f"process_fewsnet_worldpop_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("process_fewsnet_worldpop", args.country_iso3.upper(), args.profile):
+        main(
+            args.country_iso3.upper(),
+            args.suffix,
+            args.simplify_tolerance,
+            args.crosswalk,
+            args.tile_size,
+            args.resume,
+            results_db=args.results_db,
+        )
@@ -4,11 +4,24 @@ import pandas as pd
 import geopandas as gpd
 from pathlib import Path
 
-from utils import parse_args, parse_yaml, config_logger
+from schema import apply_schema
+from results_store import save_results, population_rows
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    results_db_arguments,
+    parse_yaml,
+    config_logger,
+    timed,
+    timed_stage,
+    run_report,
+    profile_run,
+)
 
 logger = logging.getLogger(__name__)
 
 
+@timed("read", unit=("admin_level",))
 def read_ipcglobal(parameters, ipc_path, shp_path, admin_level):
     """
     Process ipc data and do some checks
@@ -56,6 +69,11 @@ def read_ipcglobal(parameters, ipc_path, shp_path, admin_level):
     df_ipc_agg = df_ipc_agg[["date"] + adm_cols + ipc_cols + pop_cols]
     # TODO: implement getting population per admin region, already implemented in proces_fewsnet.py
     df_ipc_agg[f"pop_ADMIN{admin_level}"] = np.nan
+    df_ipc_agg = apply_schema(
+        df_ipc_agg,
+        admin_cols=adm_cols,
+        pop_cols=ipc_cols + pop_cols + [f"pop_ADMIN{admin_level}"],
+    )
 
     shp_admc = parameters[f"shp_adm{admin_level}c"]
     boundaries = gpd.read_file(shp_path)
@@ -74,7 +92,7 @@ def read_ipcglobal(parameters, ipc_path, shp_path, admin_level):
     return df_ipc_agg
 
 
-def main(country_iso3, admin_level, suffix, config_file="config.yml"):
+def main(country_iso3, admin_level, suffix, config_file="config.yml", results_db=None):
     """
     Define variables and save output
     Args:
@@ -82,6 +100,10 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
         admin_level: integer indicating which admin level to aggregate to
         config_file: path to config file
         suffix: string to attach to the output files name
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+
+    Returns:
+        df_ipc: DataFrame with processed ipc data, as saved to csv
     """
     parameters = parse_yaml(config_file)[country_iso3]
     country = parameters["country_name"]
@@ -95,10 +117,47 @@ def main(country_iso3, admin_level, suffix, config_file="config.yml"):
     Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
 
     df_ipc = read_ipcglobal(parameters, IPC_PATH, SHP_PATH, admin_level)
-    df_ipc.to_csv(f"{RESULT_FOLDER}{country}_globalipc_admin{admin_level}{suffix}.csv")
+    with timed_stage("write", admin_level=admin_level):
+        df_ipc.to_csv(
+            f"{RESULT_FOLDER}{country}_globalipc_admin{admin_level}{suffix}.csv"
+        )
+    if results_db:
+        with timed_stage("write", store="sqlite"):
+            save_results(
+                "process_globalipc",
+                country_iso3,
+                suffix,
+                {"admin_level": admin_level},
+                populations=population_rows(
+                    df_ipc,
+                    "GlobalIPC",
+                    admin_level,
+                    "ADMIN1",
+                    "ADMIN2" if int(admin_level) >= 2 else None,
+                ),
+                db_path=results_db,
+            )
+    return df_ipc
+
+
+def globalipc_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    results_db_arguments(parser)
+    # GlobalIPC analyses are not done on admin3
+    admin_level_arguments(parser, levels=(1, 2))
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    args = parse_args(globalipc_arguments)
     config_logger(level="warning")
-    main(args.country_iso3.upper(), args.admin_level, args.suffix)
+    with run_report(
+        f"process_globalipc_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("process_globalipc", args.country_iso3.upper(), args.profile):
+        main(
+            args.country_iso3.upper(),
+            args.admin_level,
+            args.suffix,
+            results_db=args.results_db,
+        )
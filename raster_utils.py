@@ -0,0 +1,394 @@
+import numpy as np
+import rasterio
+from rasterio import features
+from rasterio.windows import Window
+import hashlib
+import math
+import os
+from geometries import geometry_key, raster_key
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# directory where the rasterized admin boundaries are saved
+LABEL_CACHE_DIR = "Data/PixelLabels/"
+# file names of the unconstrained, UN adjusted WorldPop population counts per resolution
+WORLDPOP_FILENAMES = {
+    "1km": "{iso3}_ppp_{year}_1km_Aggregated_UNadj.tif",
+    "100m": "{iso3}_ppp_{year}_UNadj.tif",
+}
+DEFAULT_RESOLUTION = "1km"
+# number of rows and columns of the tiles in which large rasters are processed
+# a tile of 2048 x 2048 cells takes about 60MB for the population, admin labels and phases
+DEFAULT_TILE_SIZE = 2048
+
+# directory where the decoded rasters are saved, which the workers of parallel_zonal_sums memory-map
+DECODED_CACHE_DIR = "Data/DecodedRasters/"
+
+# geometries and raster path of the tiled zonal statistics, set once per worker process by _init_tile_worker
+_tile_inputs = {}
+# memory-mapped raster and its transform of the parallel zonal statistics, set once per worker process by _init_zonal_worker
+_zonal_inputs = {}
+
+
+def worldpop_filename(country_iso3, year, resolution=DEFAULT_RESOLUTION):
+    """
+    Return the file name of the WorldPop raster of country_iso3 and year, for the resolution "1km" or "100m"
+    """
+    if resolution not in WORLDPOP_FILENAMES:
+        raise ValueError(
+            f"Unknown WorldPop resolution {resolution}, expected one of {', '.join(WORLDPOP_FILENAMES)}"
+        )
+    return WORLDPOP_FILENAMES[resolution].format(iso3=country_iso3.lower(), year=year)
+
+
+def grid_key(src):
+    """
+    Return a key of the grid (crs, transform and shape) of the opened raster src, which is the same for rasters of different years
+    """
+    return hashlib.sha1(
+        f"{src.crs}|{tuple(src.transform)}|{src.height}|{src.width}".encode()
+    ).hexdigest()[:12]
+
+
+def read_population(pop_path):
+    """
+    Read the population raster, with nodata and negative cells set to 0 such that they can be used as weights
+    Returns:
+        pop: 2D array with the population per cell
+        transform: affine transform of the raster
+        crs: crs of the raster
+    """
+    with rasterio.open(pop_path) as src:
+        pop = src.read(1, masked=True).astype("float64").filled(0)
+        transform = src.transform
+        crs = src.crs
+    pop[~np.isfinite(pop) | (pop < 0)] = 0
+    return pop, transform, crs
+
+
+def rasterize_labels(gdf, values, shape, transform, dtype="int32"):
+    """
+    Burn values of the geometries in gdf into a raster with the given shape and transform. Cells that are not covered get 0.
+    A cell is assigned to a geometry if the center of the cell is inside the geometry, which is the same rule as rasterstats uses.
+    """
+    return features.rasterize(
+        zip(gdf.geometry, values),
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        all_touched=False,
+        dtype=dtype,
+    )
+
+
+def admin_label_raster(df_adm, pop_path, cache_dir=LABEL_CACHE_DIR):
+    """
+    Return the raster of admin labels on the grid of pop_path, where a cell has the value of the position of the admin in df_adm plus one,
+    and 0 if it is not in any admin. The raster is computed once per admin layer and grid, and cached in cache_dir.
+    Args:
+        df_adm: GeoDataFrame with the admin boundaries
+        pop_path: path to the raster file with population data
+        cache_dir: directory where the label rasters are saved
+
+    Returns:
+        labels: 2D int32 array with the admin labels
+    """
+    with rasterio.open(pop_path) as src:
+        shape = (src.height, src.width)
+        transform = src.transform
+        cache_path = (
+            f"{cache_dir}{geometry_key(df_adm.to_crs(src.crs))}_{grid_key(src)}.npy"
+        )
+        crs = src.crs
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    labels = rasterize_labels(
+        df_adm.to_crs(crs), np.arange(1, len(df_adm) + 1), shape, transform
+    )
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    np.save(cache_path, labels)
+    return labels
+
+
+def label_phase_population(labels, phases, pop, n_labels, n_phases):
+    """
+    Sum the population, and count the cells, per admin label and phase with a bincount over all cells
+    Args:
+        labels: 2D array with the admin label per cell (1 to n_labels, 0 is outside the admins)
+        phases: 2D array with the phase per cell (0 to n_phases - 1)
+        pop: 2D array with the population per cell, or None to only count the cells
+        n_labels: number of admins
+        n_phases: number of phase values
+
+    Returns:
+        2D array (admin x phase) with the population, where row i corresponds to label i + 1
+        2D array (admin x phase) with the number of cells
+    """
+    inside = labels > 0
+    idx = (labels[inside].astype(np.int64) - 1) * n_phases + phases[inside]
+    shape = (n_labels, n_phases)
+    cells = np.bincount(idx, minlength=n_labels * n_phases).reshape(shape)
+    if pop is None:
+        return None, cells
+    pop_sum = np.bincount(
+        idx, weights=pop[inside], minlength=n_labels * n_phases
+    ).reshape(shape)
+    return pop_sum, cells
+
+
+def bounds_window(transform, shape, bounds):
+    """
+    Return the rows and columns (row_start, row_stop, col_start, col_stop) of the cells of a raster with the given transform and shape
+    that cover bounds (minx, miny, maxx, maxy), clipped to the raster
+    """
+    minx, miny, maxx, maxy = bounds
+    cols, rows = zip(*[~transform * (x, y) for x in (minx, maxx) for y in (miny, maxy)])
+    return (
+        max(0, math.floor(min(rows))),
+        min(shape[0], math.ceil(max(rows))),
+        max(0, math.floor(min(cols))),
+        min(shape[1], math.ceil(max(cols))),
+    )
+
+
+def tile_windows(src, bounds, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Return the windows of at most tile_size x tile_size cells of the opened raster src that cover bounds (minx, miny, maxx, maxy in the crs of src)
+    """
+    row_start, row_stop, col_start, col_stop = bounds_window(
+        src.transform, (src.height, src.width), bounds
+    )
+    return [
+        Window(col, row, min(tile_size, col_stop - col), min(tile_size, row_stop - row))
+        for row in range(row_start, row_stop, tile_size)
+        for col in range(col_start, col_stop, tile_size)
+    ]
+
+
+def _shapes(gdf, values):
+    """
+    Return the geometries of gdf with their values and their bounds, such that the shapes of a tile can be selected quickly
+    """
+    return list(gdf.geometry), np.asarray(values), gdf.geometry.bounds.to_numpy()
+
+
+def _shapes_in(shapes, bounds):
+    """
+    Return the (geometry, value) pairs of shapes of which the bounds intersect bounds
+    """
+    geoms, values, geom_bounds = shapes
+    minx, miny, maxx, maxy = bounds
+    inside = (
+        (geom_bounds[:, 0] <= maxx)
+        & (geom_bounds[:, 2] >= minx)
+        & (geom_bounds[:, 1] <= maxy)
+        & (geom_bounds[:, 3] >= miny)
+    )
+    return [(geoms[i], values[i]) for i in np.flatnonzero(inside)]
+
+
+def _init_tile_worker(pop_path, adm_shapes, phase_shapes):
+    _tile_inputs.update(
+        pop_path=pop_path, adm_shapes=adm_shapes, phase_shapes=phase_shapes
+    )
+
+
+def _tile_population(window, n_labels, n_phases):
+    """
+    Return the population and number of cells per admin and phase of one tile, see label_phase_population
+    Only the tile is read from the raster, and only the shapes that overlap the tile are rasterized
+    """
+    with rasterio.open(_tile_inputs["pop_path"]) as src:
+        pop = src.read(1, window=window, masked=True).astype("float64").filled(0)
+        transform = src.window_transform(window)
+        bounds = rasterio.windows.bounds(window, src.transform)
+    pop[~np.isfinite(pop) | (pop < 0)] = 0
+    adm_shapes = _shapes_in(_tile_inputs["adm_shapes"], bounds)
+    if not adm_shapes:
+        return np.zeros((n_labels, n_phases)), np.zeros(
+            (n_labels, n_phases), dtype=np.int64
+        )
+    labels = features.rasterize(
+        adm_shapes, out_shape=pop.shape, transform=transform, fill=0, dtype="int32"
+    )
+    phases = np.zeros(pop.shape, dtype="uint8")
+    if _tile_inputs["phase_shapes"] is not None:
+        phase_shapes = _shapes_in(_tile_inputs["phase_shapes"], bounds)
+        if phase_shapes:
+            phases = features.rasterize(
+                phase_shapes,
+                out_shape=pop.shape,
+                transform=transform,
+                fill=0,
+                dtype="uint8",
+            )
+    return label_phase_population(labels, phases, pop, n_labels, n_phases)
+
+
+def tiled_population(
+    pop_path,
+    df_adm,
+    df_phase=None,
+    phase_codes=None,
+    n_phases=1,
+    tile_size=DEFAULT_TILE_SIZE,
+    processes=None,
+):
+    """
+    Sum the population, and count the cells, per admin and phase while streaming the raster in tiles,
+    such that the memory use does not depend on the size of the raster, e.g. for the 100m WorldPop rasters.
+    Every tile adds its partial sums per (admin, phase) to the totals. The tiles are processed in parallel, and the cells
+    are assigned with the same rule as rasterstats (see rasterize_labels), so the totals equal the zonal statistics of the whole raster.
+    Args:
+        pop_path: path to the raster file with population data
+        df_adm: GeoDataFrame with the admin boundaries
+        df_phase: GeoDataFrame with the phase geometries, e.g. FewsNet, or None to only sum per admin
+        phase_codes: phase code per geometry in df_phase (1 to n_phases - 1, 0 is not covered)
+        n_phases: number of phase codes, including 0
+        tile_size: number of rows and columns of a tile
+        processes: maximum number of worker processes, defaults to the number of cpus. With 1 the tiles are processed in this process
+
+    Returns:
+        2D array (admin x phase) with the population, where row i corresponds to row i of df_adm
+        2D array (admin x phase) with the number of cells
+    """
+    with rasterio.open(pop_path) as src:
+        crs = src.crs
+        df_adm = df_adm.to_crs(crs)
+        windows = tile_windows(src, df_adm.total_bounds, tile_size)
+    adm_shapes = _shapes(df_adm, np.arange(1, len(df_adm) + 1))
+    phase_shapes = None
+    if df_phase is not None:
+        phase_shapes = _shapes(df_phase.to_crs(crs), phase_codes)
+    tile_func = partial(_tile_population, n_labels=len(df_adm), n_phases=n_phases)
+    initargs = (pop_path, adm_shapes, phase_shapes)
+
+    pop_sum = np.zeros((len(df_adm), n_phases))
+    cells = np.zeros((len(df_adm), n_phases), dtype=np.int64)
+    if processes == 1 or len(windows) <= 1:
+        _init_tile_worker(*initargs)
+        try:
+            for tile_pop, tile_cells in map(tile_func, windows):
+                pop_sum += tile_pop
+                cells += tile_cells
+        finally:
+            _tile_inputs.clear()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(processes or os.cpu_count(), len(windows)),
+            initializer=_init_tile_worker,
+            initargs=initargs,
+        ) as executor:
+            for tile_pop, tile_cells in executor.map(tile_func, windows):
+                pop_sum += tile_pop
+                cells += tile_cells
+    logger.debug(f"Summed the population of {pop_path} over {len(windows)} tiles")
+    return pop_sum, cells
+
+
+def decoded_raster(pop_path, cache_dir=DECODED_CACHE_DIR, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Return the path to the decoded first band of pop_path as a .npy file, which can be memory-mapped by multiple processes at once
+    instead of each process decompressing the GeoTIFF. Nodata cells are nan, as rasterstats masks them.
+    The file is written once per version of the raster in blocks of tile_size rows, such that the raster is never fully in memory.
+    """
+    with rasterio.open(pop_path) as src:
+        cache_path = f"{cache_dir}{raster_key(pop_path)}_{grid_key(src)}.npy"
+        if os.path.exists(cache_path):
+            return cache_path
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        dtype = np.result_type(src.dtypes[0], np.float32)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        decoded = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=dtype, shape=(src.height, src.width)
+        )
+        for row in range(0, src.height, tile_size):
+            window = Window(0, row, src.width, min(tile_size, src.height - row))
+            block = src.read(1, window=window, masked=True)
+            decoded[row : row + window.height] = block.astype(dtype).filled(np.nan)
+        decoded.flush()
+        del decoded
+    # rename, such that other processes never read a partly written file
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def _init_zonal_worker(decoded_path, transform):
+    _zonal_inputs.update(pop=np.load(decoded_path, mmap_mode="r"), transform=transform)
+
+
+def _zonal_sums(geometries):
+    """
+    Return the sum of the cells of the memory-mapped raster per geometry, nan if a geometry does not contain any cell with data
+    A cell belongs to a geometry if its center is inside the geometry, the same rule as rasterstats
+    """
+    pop = _zonal_inputs["pop"]
+    transform = _zonal_inputs["transform"]
+    sums = np.full(len(geometries), np.nan)
+    for i, geom in enumerate(geometries):
+        if geom is None or geom.is_empty:
+            continue
+        row_start, row_stop, col_start, col_stop = bounds_window(
+            transform, pop.shape, geom.bounds
+        )
+        if row_stop <= row_start or col_stop <= col_start:
+            continue
+        inside = features.rasterize(
+            [(geom, 1)],
+            out_shape=(row_stop - row_start, col_stop - col_start),
+            transform=transform * transform.translation(col_start, row_start),
+            fill=0,
+            all_touched=False,
+            dtype="uint8",
+        ).astype(bool)
+        values = pop[row_start:row_stop, col_start:col_stop][inside]
+        values = values[~np.isnan(values)]
+        if values.size:
+            sums[i] = values.sum(dtype=np.float64)
+    return sums
+
+
+def parallel_zonal_sums(geometries, pop_path, processes=None, chunk_size=None):
+    """
+    Sum the population per geometry, with the same cells as rasterstats.zonal_stats(geometries, pop_path, stats="sum")
+    The geometries are split in chunks that are spread over a pool of workers, which all memory-map the same decoded raster
+    (see decoded_raster), and every worker only reads the cells within the bounds of a geometry.
+    Args:
+        geometries: GeoSeries with the geometries, e.g. the fragments of an overlay
+        pop_path: path to the raster file with population data
+        processes: maximum number of worker processes, defaults to the number of cpus. With 1 the sums are computed in this process
+        chunk_size: number of geometries per task, by default such that every worker gets about four tasks
+
+    Returns:
+        sums: array with the population per geometry, nan where a geometry does not contain any cell with data, as rasterstats returns None
+    """
+    with rasterio.open(pop_path) as src:
+        crs = src.crs
+        transform = src.transform
+    if geometries.crs is not None and geometries.crs != crs:
+        geometries = geometries.to_crs(crs)
+    geometries = list(geometries)
+    decoded_path = decoded_raster(pop_path)
+    processes = min(processes or os.cpu_count(), max(1, len(geometries)))
+    chunk_size = chunk_size or max(1, math.ceil(len(geometries) / (4 * processes)))
+    chunks = [
+        geometries[i : i + chunk_size] for i in range(0, len(geometries), chunk_size)
+    ]
+    if processes == 1 or len(chunks) <= 1:
+        _init_zonal_worker(decoded_path, transform)
+        try:
+            sums = [_zonal_sums(chunk) for chunk in chunks]
+        finally:
+            _zonal_inputs.clear()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_zonal_worker,
+            initargs=(decoded_path, transform),
+        ) as executor:
+            sums = list(executor.map(_zonal_sums, chunks))
+    return np.concatenate(sums) if sums else np.zeros(0)
@@ -0,0 +1,326 @@
+import pandas as pd
+import json
+import os
+import re
+import sqlite3
+import uuid
+from datetime import datetime
+from pathlib import Path
+from utils import DEFAULT_DB_PATH
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+
+# the results are stored in long format, with one row per admin, date and value, such that the tables do not depend on
+# which phases or triggers are present. admin2 is NULL for results on admin1 level, admin3 for results on admin1 and admin2 level
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    script TEXT NOT NULL,
+    country TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    parameters TEXT,
+    n_rows INTEGER
+);
+CREATE TABLE IF NOT EXISTS admin_phases (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    country TEXT NOT NULL,
+    source TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    admin_level INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    admin1 TEXT,
+    admin2 TEXT,
+    admin3 TEXT,
+    period TEXT NOT NULL,
+    phase INTEGER
+);
+CREATE TABLE IF NOT EXISTS admin_populations (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    country TEXT NOT NULL,
+    source TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    admin_level INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    admin1 TEXT,
+    admin2 TEXT,
+    admin3 TEXT,
+    period TEXT NOT NULL,
+    phase INTEGER NOT NULL,
+    population REAL
+);
+CREATE TABLE IF NOT EXISTS triggers (
+    run_id TEXT NOT NULL REFERENCES runs(run_id),
+    country TEXT NOT NULL,
+    source TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    admin_level INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    admin1 TEXT,
+    admin2 TEXT,
+    admin3 TEXT,
+    trigger TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS admin_phases_date ON admin_phases (country, date, admin1, admin2);
+CREATE INDEX IF NOT EXISTS admin_phases_admin ON admin_phases (country, admin2, period, date);
+CREATE INDEX IF NOT EXISTS admin_populations_date ON admin_populations (country, date, admin1, admin2);
+CREATE INDEX IF NOT EXISTS admin_populations_admin ON admin_populations (country, admin2, period, date);
+CREATE INDEX IF NOT EXISTS triggers_date ON triggers (country, date, admin1, admin2);
+CREATE INDEX IF NOT EXISTS triggers_admin ON triggers (country, admin1, trigger, date);
+"""
+# columns of the tables with results, in the order of the tables
+TABLE_COLUMNS = {
+    "admin_phases": [
+        "source",
+        "admin_level",
+        "date",
+        "admin1",
+        "admin2",
+        "admin3",
+        "period",
+        "phase",
+    ],
+    "admin_populations": [
+        "source",
+        "admin_level",
+        "date",
+        "admin1",
+        "admin2",
+        "admin3",
+        "period",
+        "phase",
+        "population",
+    ],
+    "triggers": [
+        "source",
+        "admin_level",
+        "date",
+        "admin1",
+        "admin2",
+        "admin3",
+        "trigger",
+        "value",
+    ],
+}
+
+
+def connect(db_path=DEFAULT_DB_PATH):
+    """
+    Open the results database at db_path, and create the tables and indexes if they do not exist yet
+    """
+    Path(os.path.dirname(db_path) or ".").mkdir(parents=True, exist_ok=True)
+    # wait for the transactions of other processes, e.g. the countries that are processed in parallel
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.executescript(SCHEMA)
+    # databases created before admin3 was stored do not have the admin3 column yet
+    for table in TABLE_COLUMNS:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if "admin3" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN admin3 TEXT")
+    return conn
+
+
+def _admin_frame(df, source, admin_level, adm1c, adm2c, adm3c=None):
+    """
+    Return the date and admin columns of df with the names of the results tables
+    """
+    df_long = pd.DataFrame(
+        {
+            "source": source,
+            "admin_level": int(admin_level),
+            "date": pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d").to_numpy(),
+            "admin1": df[adm1c].astype(object).to_numpy(),
+            "admin2": df[adm2c].astype(object).to_numpy() if adm2c else None,
+            "admin3": df[adm3c].astype(object).to_numpy() if adm3c else None,
+        }
+    )
+    return df_long
+
+
+def phase_rows(df, source, admin_level, adm1c, adm2c=None, adm3c=None):
+    """
+    Return the assigned IPC phase per admin, date and period of df in the long format of the admin_phases table
+    Args:
+        df: DataFrame with the date, admin names and a column per period with the phase, e.g. the output of process_fewsnet
+        source: name of the data source, e.g. "FewsNet"
+        admin_level: admin level of the rows of df
+        adm1c: column name of the admin1 level name
+        adm2c: column name of the admin2 level name, None for admin1 results
+        adm3c: column name of the admin3 level name, None for admin1 and admin2 results
+    """
+    df_admin = _admin_frame(df, source, admin_level, adm1c, adm2c, adm3c)
+    df_list = []
+    for period in [p for p in PERIOD_LIST if p in df.columns]:
+        df_period = df_admin.copy()
+        df_period["period"] = period
+        df_period["phase"] = pd.to_numeric(df[period], errors="coerce").to_numpy()
+        df_list.append(df_period)
+    if not df_list:
+        return pd.DataFrame(columns=TABLE_COLUMNS["admin_phases"])
+    return pd.concat(df_list, ignore_index=True)
+
+
+def population_rows(df, source, admin_level, adm1c, adm2c=None, adm3c=None):
+    """
+    Return the population per admin, date, period and IPC phase of df in the long format of the admin_populations table
+    The populations are taken from the columns named period_phase, e.g. CS_3 or ML1_99
+    Args:
+        df: DataFrame with the date, admin names and population per period and phase
+        source: name of the data source, e.g. "GlobalIPC"
+        admin_level: admin level of the rows of df
+        adm1c: column name of the admin1 level name
+        adm2c: column name of the admin2 level name, None for admin1 results
+        adm3c: column name of the admin3 level name, None for admin1 and admin2 results
+    """
+    df_admin = _admin_frame(df, source, admin_level, adm1c, adm2c, adm3c)
+    df_list = []
+    for c in df.columns:
+        match = re.fullmatch(r"(CS|ML1|ML2)_(\d+)", str(c))
+        if match:
+            df_phase = df_admin.copy()
+            df_phase["period"] = match.group(1)
+            df_phase["phase"] = int(match.group(2))
+            df_phase["population"] = df[c].astype("float64").to_numpy()
+            df_list.append(df_phase)
+    if not df_list:
+        return pd.DataFrame(columns=TABLE_COLUMNS["admin_populations"])
+    return pd.concat(df_list, ignore_index=True)
+
+
+def trigger_rows(df, admin_level):
+    """
+    Return the thresholds and triggers per admin, date and source of the output of IPC_computetrigger in the long format of the triggers table
+    """
+    adm2c = "ADMIN2" if int(admin_level) >= 2 and "ADMIN2" in df.columns else None
+    adm3c = "ADMIN3" if int(admin_level) == 3 and "ADMIN3" in df.columns else None
+    df_admin = _admin_frame(df, None, admin_level, "ADMIN1", adm2c, adm3c)
+    df_admin["source"] = df["Source"].to_numpy()
+    df_list = []
+    for c in df.columns:
+        if c.startswith("threshold_") or c.startswith("trigger_"):
+            df_trigger = df_admin.copy()
+            df_trigger["trigger"] = c
+            df_trigger["value"] = df[c].astype("float64").to_numpy()
+            df_list.append(df_trigger)
+    if not df_list:
+        return pd.DataFrame(columns=TABLE_COLUMNS["triggers"])
+    return pd.concat(df_list, ignore_index=True)
+
+
+def save_results(
+    script,
+    country,
+    suffix,
+    parameters=None,
+    phases=None,
+    populations=None,
+    triggers=None,
+    db_path=DEFAULT_DB_PATH,
+):
+    """
+    Save the results of one run to the results database in a single transaction
+    The previous results of the same country, source, admin level and suffix are replaced, such that the database holds
+    the latest results, while the runs table keeps the metadata of all runs
+    Args:
+        script: name of the script that computed the results
+        country: iso3 code of the country
+        suffix: suffix of the output files of the run
+        parameters: dict with the parameters of the run, saved as json
+        phases: DataFrame in the format of phase_rows, or None
+        populations: DataFrame in the format of population_rows, or None
+        triggers: DataFrame in the format of trigger_rows, or None
+        db_path: path to the database
+
+    Returns:
+        run_id: id of the run in the runs table
+    """
+    run_id = uuid.uuid4().hex
+    tables = {
+        "admin_phases": phases,
+        "admin_populations": populations,
+        "triggers": triggers,
+    }
+    tables = {t: df for t, df in tables.items() if df is not None}
+    conn = connect(db_path)
+    try:
+        # the connection as context manager commits the transaction, or rolls it back if anything fails
+        with conn:
+            conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    script,
+                    country,
+                    suffix,
+                    datetime.now().isoformat(timespec="seconds"),
+                    json.dumps(parameters or {}, sort_keys=True, default=str),
+                    sum(len(df) for df in tables.values()),
+                ),
+            )
+            for table, df in tables.items():
+                df = df[TABLE_COLUMNS[table]]
+                for source, admin_level in (
+                    df[["source", "admin_level"]]
+                    .drop_duplicates()
+                    .itertuples(index=False)
+                ):
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE country = ? AND source = ? AND admin_level = ? AND suffix = ?",
+                        (country, source, int(admin_level), suffix),
+                    )
+                rows = df.astype(object).where(df.notnull(), None)
+                conn.executemany(
+                    f"INSERT INTO {table} (run_id, country, suffix, {', '.join(TABLE_COLUMNS[table])}) "
+                    f"VALUES ({', '.join(['?'] * (len(TABLE_COLUMNS[table]) + 3))})",
+                    (
+                        (run_id, country, suffix) + row
+                        for row in rows.itertuples(index=False, name=None)
+                    ),
+                )
+    finally:
+        conn.close()
+    logger.info(f"Saved the results of {script} for {country} to {db_path}")
+    return run_id
+
+
+def query(sql, params=(), db_path=DEFAULT_DB_PATH):
+    """
+    Return the result of the sql query on the results database as a DataFrame
+    """
+    conn = connect(db_path)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def phase_history(
+    country,
+    admin2,
+    period="ML1",
+    source="FewsNet",
+    suffix="",
+    db_path=DEFAULT_DB_PATH,
+    admin3=None,
+):
+    """
+    Return the IPC phase of period over time for one admin2 region, e.g. the ML1 phase history of one zone
+    If admin3 is given, the phase history of that admin3 region in admin2 is returned, e.g. of one woreda
+    """
+    if admin3 is None:
+        return query(
+            "SELECT date, phase FROM admin_phases WHERE country = ? AND admin_level = 2 AND admin2 = ? "
+            "AND period = ? AND source = ? AND suffix = ? ORDER BY date",
+            (country, admin2, period, source, suffix),
+            db_path,
+        )
+    return query(
+        "SELECT date, phase FROM admin_phases WHERE country = ? AND admin_level = 3 AND admin2 = ? AND admin3 = ? "
+        "AND period = ? AND source = ? AND suffix = ? ORDER BY date",
+        (country, admin2, admin3, period, source, suffix),
+        db_path,
+    )
@@ -0,0 +1,364 @@
+import hashlib
+import json
+import os
+import glob
+import inspect
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    results_db_arguments,
+    resume_arguments,
+    crosswalk_arguments,
+    parse_yaml,
+    config_logger,
+    collect_stages,
+    add_stage_records,
+    run_report,
+    profile_run,
+)
+import process_fewsnet
+import process_fewsnet_worldpop
+import process_globalipc
+import IPC_computetrigger
+import logging
+
+logger = logging.getLogger(__name__)
+
+# directory with the scripts of the project, of which a change in the source code makes the stages that use them outdated
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_fewsnet(
+    country_iso3,
+    admin_level,
+    suffix,
+    upstream,
+    results_db=None,
+    dates=None,
+    use_crosswalk=False,
+):
+    # admin1 triggers are computed from the admin2 results
+    return process_fewsnet.main(
+        country_iso3,
+        suffix,
+        use_crosswalk=use_crosswalk,
+        results_db=results_db,
+        admin_level=max(2, int(admin_level)),
+        dates=dates,
+    )
+
+
+def run_fewsnet_worldpop(
+    country_iso3,
+    admin_level,
+    suffix,
+    upstream,
+    results_db=None,
+    dates=None,
+    use_crosswalk=False,
+    resume=False,
+):
+    return process_fewsnet_worldpop.main(
+        country_iso3,
+        suffix,
+        use_crosswalk=use_crosswalk,
+        resume=resume,
+        results_db=results_db,
+        dates=dates,
+    )
+
+
+def run_globalipc(country_iso3, admin_level, suffix, upstream, results_db=None):
+    return process_globalipc.main(
+        country_iso3, admin_level, suffix, results_db=results_db
+    )
+
+
+def run_trigger(country_iso3, admin_level, suffix, upstream, results_db=None):
+    # process_fewsnet returns the admin2 (or admin3) and admin1 frames. If a stage was skipped its output is read from csv by the trigger script
+    df_fews = None
+    if upstream.get("fewsnet") is not None:
+        df_fews = upstream["fewsnet"][{3: 0, 2: 0, 1: 1}[int(admin_level)]]
+    return IPC_computetrigger.main(
+        country_iso3,
+        admin_level,
+        suffix,
+        df_fews=df_fews,
+        df_gipc=upstream.get("globalipc"),
+        results_db=results_db,
+    )
+
+
+def define_tasks(
+    country_iso3, admin_level, suffix, parameters, use_crosswalk=False, resume=False
+):
+    """
+    Define the stages of the pipeline as tasks with their dependencies, input and output files
+    Args:
+        country_iso3: string with iso3 code
+        admin_level: integer indicating which admin level the triggers are computed for
+        suffix: string to attach to the output files name
+        parameters: dict with the parameters of the country, parsed from the config
+        use_crosswalk: if True, the FewsNet stages use the cached admin x FewsNet crosswalk
+        resume: if True, the FewsNet-WorldPop stage continues from its checkpoints
+
+    Returns:
+        tasks: dict with per task name the function to run, the module of the stage, the names of the tasks it depends on,
+        its input and output paths, and the keyword arguments of the function
+    """
+    country = parameters["country_name"]
+    fews_level = max(2, int(admin_level))
+    admin2_path = f"{country}/Data/{parameters['path_admin2_shp']}"
+    fews_admin_path = f"{country}/Data/{parameters[f'path_admin{fews_level}_shp']}"
+    # all files of the admin shapefile, i.e. also the .dbf with the names
+    admin2_files = glob.glob(f"{os.path.splitext(admin2_path)[0]}.*")
+    fews_admin_files = glob.glob(f"{os.path.splitext(fews_admin_path)[0]}.*")
+    # the regional and the country release of every date, named as in process_fewsnet.shapefiles_to_df
+    fewsnet_files = [
+        f
+        for d in parameters["fewsnet_dates"]
+        for folder in [f"{parameters['region']}{d}", f"{parameters['iso2_code']}_{d}"]
+        for f in glob.glob(f"Data/FewsNetRaw/{folder}/*")
+    ]
+    fews_folder = f"{country}/Data/FewsNetProcessed/"
+    worldpop_folder = f"{country}/Data/FewsNetWorldPop/"
+    gipc_folder = f"{country}/Data/GlobalIPCProcessed/"
+    # the dates are passed explicitly, such that dates that are not in the config yet are processed as well, see watch_fewsnet
+    fews_kwargs = {
+        "dates": parameters["fewsnet_dates"],
+        "use_crosswalk": use_crosswalk,
+    }
+    tasks = {
+        "fewsnet": {
+            "func": run_fewsnet,
+            "module": process_fewsnet,
+            "deps": [],
+            "inputs": fews_admin_files
+            + fewsnet_files
+            + [
+                f"{country}/Data/{parameters['pop_filename']}",
+                "Data/Worldbank_TotalPopulation.csv",
+            ],
+            "outputs": [
+                f"{fews_folder}{country}_fewsnet_admin{level}{suffix}.csv"
+                for level in range(fews_level, 0, -1)
+            ],
+            "kwargs": fews_kwargs,
+        },
+        "fewsnet_worldpop": {
+            "func": run_fewsnet_worldpop,
+            "module": process_fewsnet_worldpop,
+            "deps": [],
+            "inputs": admin2_files
+            + fewsnet_files
+            + sorted(glob.glob(f"{country}/Data/WorldPop/*")),
+            "outputs": [
+                f"{worldpop_folder}{country_iso3.lower()}_admin2_fewsnet_worldpop{suffix}.csv",
+                f"{worldpop_folder}{country_iso3.lower()}_admin1_fewsnet_worldpop{suffix}.csv",
+            ],
+            "kwargs": {**fews_kwargs, "resume": resume},
+        },
+        "globalipc": {
+            "func": run_globalipc,
+            "module": process_globalipc,
+            "deps": [],
+            "inputs": admin2_files + [f"{country}/Data/{parameters['ipc_path']}"],
+            "outputs": [
+                f"{gipc_folder}{country}_globalipc_admin{admin_level}{suffix}.csv"
+            ],
+        },
+        "trigger": {
+            "func": run_trigger,
+            "module": IPC_computetrigger,
+            "deps": ["fewsnet", "globalipc"],
+            "inputs": [],
+            "outputs": [
+                f"{country}/Data/IPC_trigger/trigger_results_admin{admin_level}{suffix}.csv"
+            ],
+        },
+    }
+    if int(admin_level) == 3:
+        # GlobalIPC analyses are not done on admin3
+        del tasks["globalipc"]
+        tasks["trigger"]["deps"] = ["fewsnet"]
+    return tasks
+
+
+def project_modules(module):
+    """
+    Return the modules of the project that module uses, directly or via other project modules, including module itself
+    Both imported modules and modules from which functions or classes are imported are found
+    """
+    found = {}
+    todo = [module]
+    while todo:
+        m = todo.pop()
+        path = getattr(m, "__file__", None)
+        if path is None or m.__name__ in found:
+            continue
+        if os.path.dirname(os.path.abspath(path)) != PROJECT_DIR:
+            continue
+        found[m.__name__] = m
+        for value in vars(m).values():
+            todo.append(value if inspect.ismodule(value) else inspect.getmodule(value))
+    return [found[name] for name in sorted(found)]
+
+
+def task_fingerprint(name, task, parameters, admin_level, dep_fingerprints):
+    """
+    Return a hash of everything that determines the output of a task: the size and modification time of its input files,
+    the config of the country, the admin level, the keyword arguments of the task, the source code of the stage's script and
+    the project modules it uses, and the fingerprints of the tasks it depends on
+    """
+    h = hashlib.sha1(name.encode())
+    for path in sorted(task["inputs"]):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        else:
+            h.update(f"{path}|missing".encode())
+    h.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    h.update(str(admin_level).encode())
+    # resuming from the checkpoints gives the same output
+    kwargs = {k: v for k, v in task.get("kwargs", {}).items() if k != "resume"}
+    h.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    for module in project_modules(task["module"]):
+        h.update(inspect.getsource(module).encode())
+    for dep in sorted(dep_fingerprints):
+        h.update(dep_fingerprints[dep].encode())
+    return h.hexdigest()
+
+
+def run_pipeline(
+    country_iso3,
+    admin_level,
+    suffix,
+    force=False,
+    config_file="config.yml",
+    processes=None,
+    results_db=None,
+    dates=None,
+    use_crosswalk=False,
+    resume=False,
+):
+    """
+    Run all stages of the pipeline for a country, in dependency order
+    A task is skipped if its outputs exist and its inputs, config, code and upstream tasks did not change since the last run.
+    Independent tasks (FewsNet, FewsNet-WorldPop and GlobalIPC) run concurrently in separate processes, and the results of the
+    stages are handed to the trigger computation in memory instead of being read again from csv.
+    Args:
+        country_iso3: string with iso3 code
+        admin_level: integer indicating which admin level the triggers are computed for
+        suffix: string to attach to the output files name
+        force: if True, run all tasks even if they are up to date
+        config_file: path to config file
+        processes: maximum number of worker processes
+        results_db: if given, path to the SQLite database to which the tasks that run also save their results
+        dates: list of FewsNet dates to process, by default fewsnet_dates in the config
+        use_crosswalk: if True, the FewsNet stages use the cached admin x FewsNet crosswalk
+        resume: if True, the FewsNet-WorldPop stage only processes the dates and periods without a checkpoint
+
+    Returns:
+        results: dict with per task the returned DataFrames, None for skipped tasks
+    """
+    parameters = parse_yaml(config_file)[country_iso3]
+    if dates:
+        parameters = {**parameters, "fewsnet_dates": list(dates)}
+    country = parameters["country_name"]
+    tasks = define_tasks(
+        country_iso3, admin_level, suffix, parameters, use_crosswalk, resume
+    )
+    state_path = f"{country}/Data/pipeline_state_admin{admin_level}{suffix}.json"
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+
+    fingerprints = {}
+    results = {}
+    done = set()
+    running = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while len(done) < len(tasks):
+            ready = [
+                n
+                for n, t in tasks.items()
+                if n not in done and n not in running and set(t["deps"]) <= done
+            ]
+            for name in ready:
+                task = tasks[name]
+                fingerprints[name] = task_fingerprint(
+                    name,
+                    task,
+                    parameters,
+                    admin_level,
+                    {d: fingerprints[d] for d in task["deps"]},
+                )
+                up_to_date = state.get(name) == fingerprints[name] and all(
+                    os.path.exists(p) for p in task["outputs"]
+                )
+                if up_to_date and not force:
+                    logger.info(f"Skipping {name}, inputs and config did not change")
+                    results[name] = None
+                    done.add(name)
+                else:
+                    logger.info(f"Running {name}")
+                    upstream = {d: results[d] for d in task["deps"]}
+                    running[name] = executor.submit(
+                        collect_stages,
+                        task["func"],
+                        country_iso3,
+                        admin_level,
+                        suffix,
+                        upstream,
+                        results_db,
+                        **task.get("kwargs", {}),
+                    )
+            if not running:
+                continue
+            finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for name in [n for n, f in running.items() if f in finished]:
+                # raises the exception of the task, if any
+                results[name], records = running.pop(name).result()
+                for r in records:
+                    r["unit"]["task"] = name
+                add_stage_records(records)
+                state[name] = fingerprints[name]
+                done.add(name)
+                # save after every task, such that finished tasks are not redone if a later task fails
+                with open(state_path, "w") as f:
+                    json.dump(state, f, indent=2)
+    return results
+
+
+def pipeline_arguments(parser):
+    """
+    Add the options of the pipeline to parser, see utils.parse_args
+    """
+    crosswalk_arguments(parser)
+    resume_arguments(parser)
+    results_db_arguments(parser)
+    admin_level_arguments(parser)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run all pipeline stages, also the ones of which the inputs did not change",
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args(pipeline_arguments)
+    config_logger(level="info")
+    with run_report(
+        f"run_pipeline_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("run_pipeline", args.country_iso3.upper(), args.profile):
+        run_pipeline(
+            args.country_iso3.upper(),
+            args.admin_level,
+            args.suffix,
+            args.force,
+            results_db=args.results_db,
+            use_crosswalk=args.crosswalk,
+            resume=args.resume,
+        )
@@ -0,0 +1,91 @@
+import pandas as pd
+import numpy as np
+from pandas.api.types import CategoricalDtype, is_numeric_dtype
+import logging
+
+logger = logging.getLogger(__name__)
+
+# dtype of the IPC phase columns, a nullable integer such that missing phases stay missing instead of turning the column into floats
+PHASE_DTYPE = "Int8"
+# float32 holds all whole numbers up to 2**24 exactly, so populations below this are stored as float32
+FLOAT32_MAX_EXACT = 2**24
+
+
+def month_start(dates):
+    """
+    Return the dates as datetime64 at the first day of their month
+    pandas cannot hold datetime64[M] in a Series, so the month is stored as datetime64[ns] of the first day of the month
+    """
+    return pd.to_datetime(dates).dt.to_period("M").dt.to_timestamp()
+
+
+def to_phase(values):
+    """
+    Return the IPC phases as nullable int8, with values that are not a whole number (e.g. nan) as missing
+    """
+    values = pd.to_numeric(values, errors="coerce")
+    return values.where(values == values.round()).astype(PHASE_DTYPE)
+
+
+def downcast_population(values):
+    """
+    Return population values as float32 if all values are below 2**24 people, such that the rounding error is below one person.
+    Larger values, e.g. national totals, are kept as float64
+    """
+    values = values.astype("float64")
+    abs_values = np.abs(values.to_numpy())
+    if values.isnull().all() or np.nanmax(abs_values) < FLOAT32_MAX_EXACT:
+        return values.astype("float32")
+    return values
+
+
+def to_admin_dtype(values, dtype):
+    """
+    Return values with the categorical dtype, names that are not a category of dtype become missing
+    """
+    if isinstance(values.dtype, CategoricalDtype):
+        values = values.astype(object)
+    return values.astype(dtype)
+
+
+def apply_schema(df, admin_cols=(), phase_cols=(), pop_cols=(), date_col="date"):
+    """
+    Set compact dtypes on a processed frame: categorical admin names, dates at the start of the month,
+    nullable int8 IPC phases, and float32 populations where that keeps the precision (see downcast_population)
+    Columns that are not in df are skipped
+    Args:
+        df: DataFrame with processed IPC data
+        admin_cols: columns with admin names
+        phase_cols: columns with IPC phases
+        pop_cols: columns with population numbers
+        date_col: column with the dates, None if there is none
+
+    Returns:
+        df: copy of df with the compact dtypes
+    """
+    df = df.copy()
+    for c in admin_cols:
+        if c in df.columns and not isinstance(df[c].dtype, CategoricalDtype):
+            df[c] = df[c].astype("category")
+    if date_col is not None and date_col in df.columns:
+        df[date_col] = month_start(df[date_col])
+    for c in phase_cols:
+        if c in df.columns:
+            df[c] = to_phase(df[c])
+    for c in pop_cols:
+        if c in df.columns and is_numeric_dtype(df[c]):
+            df[c] = downcast_population(df[c])
+    return df
+
+
+def population_columns(df, periods=("CS", "ML1", "ML2")):
+    """
+    Return the columns of df that hold population numbers: the population per IPC phase and the total populations
+    """
+    return [
+        c
+        for c in df.columns
+        if c.startswith("pop_")
+        or c in ["Total", "adjusted_population"]
+        or any(c.startswith(f"{p}_") for p in periods)
+    ]
@@ -0,0 +1,418 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl
+import pandas as pd
+import aafi
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    multi_country_arguments,
+    parse_yaml,
+    config_logger,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# seconds between the checks whether the processed outputs changed
+RELOAD_INTERVAL = 5
+# number of responses that are kept, per version of the data
+RESPONSE_CACHE_SIZE = 1024
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+IPC_LEVELS = ["1", "2", "3", "4", "5", "3p", "2m"]
+
+
+def output_manifest(countries, admin_level, config_file=None):
+    """
+    Return the modification time and size of every processed output that is served, missing files are left out
+    The index is reloaded when this changes, i.e. when a processing script wrote new results
+    """
+    manifest = {}
+    for country_iso3 in countries:
+        for source, level in [("fewsnet", 2), ("triggers", admin_level)]:
+            path = aafi.processed_path(country_iso3, level, source, "", config_file)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                manifest[path] = (stat.st_mtime_ns, stat.st_size)
+    return manifest
+
+
+def _records(df):
+    """
+    Return the rows of df as a list of dicts that can be serialized to json, with nan as None
+    """
+    return json.loads(df.to_json(orient="records"))
+
+
+def _date_strings(dates):
+    return pd.to_datetime(dates).dt.strftime("%Y-%m-%d")
+
+
+def build_index(countries, admin_level, config_file=None):
+    """
+    Load the processed outputs of the countries, and index them on the keys of the queries
+    Args:
+        countries: list of iso3 codes
+        admin_level: admin level of the trigger outputs that are served
+        config_file: path to config file
+
+    Returns:
+        index: dict with per country the FewsNet phases per admin2 and the triggers sorted by date, and the version of the data
+    """
+    manifest = output_manifest(countries, admin_level, config_file)
+    index = {
+        "countries": {},
+        "admin_level": admin_level,
+        "version": hashlib.sha1(
+            json.dumps(sorted(manifest.items())).encode()
+        ).hexdigest()[:16],
+        "manifest": manifest,
+    }
+    for country_iso3 in countries:
+        parameters = aafi.country_parameters(country_iso3, config_file)
+        entry = {"phases": {}, "triggers": None}
+        try:
+            df_fews = aafi.load_fewsnet(
+                country_iso3, 2, "fewsnet", config_file=config_file
+            )
+            adm1c, adm2c = parameters["shp_adm1c"], parameters["shp_adm2c"]
+            df_fews = pd.DataFrame(
+                {
+                    "date": _date_strings(df_fews["date"]),
+                    "admin1": df_fews[adm1c].astype(object),
+                    "admin2": df_fews[adm2c].astype(object),
+                    **{p: df_fews[p].astype("float64") for p in PERIOD_LIST},
+                }
+            ).sort_values("date")
+            entry["phases"] = {
+                admin2: df.drop(columns="admin2").reset_index(drop=True)
+                for admin2, df in df_fews.groupby("admin2", sort=False)
+            }
+        except FileNotFoundError as e:
+            logger.warning(f"No FewsNet phases served for {country_iso3}: {e}")
+        try:
+            df_trig = aafi.load_triggers(
+                country_iso3, admin_level, config_file=config_file
+            )
+            df_trig["date"] = _date_strings(df_trig["date"])
+            df_trig = df_trig.sort_values("date").reset_index(drop=True)
+            for c in df_trig.columns:
+                if isinstance(df_trig[c].dtype, pd.CategoricalDtype):
+                    df_trig[c] = df_trig[c].astype(object)
+            entry["triggers"] = df_trig
+        except FileNotFoundError as e:
+            logger.warning(f"No triggers served for {country_iso3}: {e}")
+        index["countries"][country_iso3] = entry
+    return index
+
+
+def _date_range(df, params):
+    """
+    Select the rows of df with a date between the from and to parameters (YYYY, YYYY-MM or YYYY-MM-DD, both inclusive)
+    """
+    if "from" in params:
+        df = df[df["date"] >= params["from"]]
+    if "to" in params:
+        df = df[df["date"].str[: len(params["to"])] <= params["to"]]
+    if "date" in params:
+        df = df[df["date"].str.startswith(params["date"])]
+    return df
+
+
+def _countries(index, params):
+    if "country" not in params:
+        return list(index["countries"])
+    country_iso3 = params["country"].upper()
+    if country_iso3 not in index["countries"]:
+        raise LookupError(f"Country {params['country']} is not served")
+    return [country_iso3]
+
+
+def query_phase(index, params):
+    """
+    Return the FewsNet IPC phase per date of one admin2, e.g. /phase?country=ETH&admin2=Afder&from=2015-01&period=ML1
+    """
+    if "admin2" not in params:
+        raise ValueError("Give the admin2 region with the admin2 parameter")
+    periods = PERIOD_LIST
+    if "period" in params:
+        if params["period"] not in PERIOD_LIST:
+            raise ValueError(f"period should be one of {', '.join(PERIOD_LIST)}")
+        periods = [params["period"]]
+    results = []
+    for country_iso3 in _countries(index, params):
+        df = index["countries"][country_iso3]["phases"].get(params["admin2"])
+        if df is not None:
+            df = _date_range(df, params)[["date", "admin1"] + periods]
+            results.append(
+                {
+                    "country": country_iso3,
+                    "admin2": params["admin2"],
+                    "phases": _records(df),
+                }
+            )
+    if not results:
+        raise LookupError(f"Admin2 {params['admin2']} not found")
+    return results
+
+
+def query_triggers(index, params):
+    """
+    Return the thresholds and triggers per admin, e.g. /triggers?country=ETH&date=2020-06&source=FewsNet
+    """
+    results = []
+    for country_iso3 in _countries(index, params):
+        df = index["countries"][country_iso3]["triggers"]
+        if df is None:
+            continue
+        df = _date_range(df, params)
+        if "source" in params:
+            df = df[df["Source"] == params["source"]]
+        if "admin1" in params:
+            df = df[df["ADMIN1"] == params["admin1"]]
+        cols = ["date", "Source"] + [
+            c
+            for c in df.columns
+            if c.startswith("ADMIN")
+            or c.startswith("threshold_")
+            or c.startswith("trigger_")
+        ]
+        results.append({"country": country_iso3, "triggers": _records(df[cols])})
+    return results
+
+
+def query_population(index, params):
+    """
+    Return the population and percentage of the population in an IPC level per admin and date,
+    e.g. /population?country=ETH&period=ML1&level=3p for the population in IPC level 3 or higher in the near-term projection
+    """
+    period = params.get("period", "CS")
+    level = params.get("level", "3p")
+    if period not in PERIOD_LIST or level not in IPC_LEVELS:
+        raise ValueError(
+            f"period should be one of {', '.join(PERIOD_LIST)} and level one of {', '.join(IPC_LEVELS)}"
+        )
+    results = []
+    for country_iso3 in _countries(index, params):
+        df = index["countries"][country_iso3]["triggers"]
+        if df is None:
+            continue
+        df = _date_range(df, params)
+        if "source" in params:
+            df = df[df["Source"] == params["source"]]
+        if "admin1" in params:
+            df = df[df["ADMIN1"] == params["admin1"]]
+        admin_cols = [c for c in df.columns if c.startswith("ADMIN")]
+        df = df[["date", "Source"] + admin_cols].assign(
+            population=df[f"{period}_{level}"],
+            percentage=df[f"perc_{period}_{level}"],
+            total=df[f"pop_{period}"],
+        )
+        results.append(
+            {
+                "country": country_iso3,
+                "period": period,
+                "level": level,
+                "population": _records(df),
+            }
+        )
+    return results
+
+
+def query_status(index, params):
+    """
+    Return the served countries, the version of the data and the admin2 regions with phases
+    """
+    return {
+        "version": index["version"],
+        "admin_level": index["admin_level"],
+        "countries": {
+            c: {
+                "admin2": sorted(entry["phases"]),
+                "triggers": entry["triggers"] is not None,
+            }
+            for c, entry in index["countries"].items()
+        },
+    }
+
+
+ROUTES = {
+    "/": query_status,
+    "/phase": query_phase,
+    "/triggers": query_triggers,
+    "/population": query_population,
+}
+
+
+def respond(state, target, if_none_match=None):
+    """
+    Return the status, ETag and body of the response to the request target (path and query string)
+    Invalid parameters (ValueError) give a 400, and unknown paths or admins (LookupError) a 404
+    The responses are cached per version of the data, and the ETag is the hash of the version and the request,
+    such that a client that sends it back in If-None-Match gets a 304 as long as the data did not change
+    """
+    index = state["index"]
+    url = urlsplit(target)
+    params = dict(parse_qsl(url.query))
+    key = (index["version"], url.path, tuple(sorted(params.items())))
+    etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '"'
+    if if_none_match == etag:
+        return 304, etag, b""
+    cache = state["responses"]
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    if url.path not in ROUTES:
+        return 404, None, json.dumps({"error": f"Unknown path {url.path}"}).encode()
+    try:
+        body = json.dumps(ROUTES[url.path](index, params)).encode()
+        response = (200, etag, body)
+    except ValueError as e:
+        return 400, None, json.dumps({"error": str(e)}).encode()
+    except LookupError as e:
+        return 404, None, json.dumps({"error": str(e)}).encode()
+    cache[key] = response
+    if len(cache) > RESPONSE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return response
+
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+async def handle_client(reader, writer, state):
+    """
+    Answer the GET requests of one connection, which is kept open as long as the client wants (HTTP/1.1 keep-alive)
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            parts = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(parts) != 3 or parts[0] != "GET":
+                status, etag, body = 405, None, b'{"error": "Only GET is supported"}'
+            else:
+                status, etag, body = respond(
+                    state, parts[1], headers.get("if-none-match")
+                )
+            keep_alive = headers.get("connection", "").lower() != "close" and parts[
+                -1:
+            ] == ["HTTP/1.1"]
+            head = [
+                f"HTTP/1.1 {status} {REASONS[status]}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(body)}",
+                "Cache-Control: no-cache",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            ]
+            if etag:
+                head.append(f"ETag: {etag}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionResetError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def reload_on_change(
+    state, countries, admin_level, config_file, interval=RELOAD_INTERVAL
+):
+    """
+    Reload the index in a background thread when the manifest of the processed outputs changes
+    The old index keeps answering the requests until the new one is complete
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        manifest = await loop.run_in_executor(
+            None, output_manifest, countries, admin_level, config_file
+        )
+        if manifest != state["index"]["manifest"]:
+            logger.info("Processed outputs changed, reloading")
+            try:
+                state["index"] = await loop.run_in_executor(
+                    None, build_index, countries, admin_level, config_file
+                )
+                state["responses"].clear()
+            except Exception as e:
+                # keep serving the previous data, e.g. if a file was read while it was being written
+                logger.error(f"Reloading failed, serving the previous data: {e}")
+
+
+async def serve(
+    countries, admin_level=1, host="127.0.0.1", port=8000, config_file=None
+):
+    """
+    Serve the processed results of the countries over HTTP until the process is stopped
+    Args:
+        countries: list of iso3 codes
+        admin_level: admin level of the trigger outputs that are served
+        host: host to listen on
+        port: port to listen on
+        config_file: path to config file, by default config.yml of this repository
+    """
+    state = {
+        "index": build_index(countries, admin_level, config_file),
+        "responses": OrderedDict(),
+    }
+    server = await asyncio.start_server(
+        lambda r, w: handle_client(r, w, state), host, port
+    )
+    logger.info(f"Serving {', '.join(countries)} on http://{host}:{port}/")
+    reloader = asyncio.create_task(
+        reload_on_change(state, countries, admin_level, config_file)
+    )
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reloader.cancel()
+
+
+def server_arguments(parser):
+    """
+    Add the options of the service to parser, see utils.parse_args
+    """
+    multi_country_arguments(parser)
+    admin_level_arguments(parser)
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Host on which the service listens",
+    )
+    parser.add_argument(
+        "--port",
+        default=8000,
+        type=int,
+        help="Port on which the service listens",
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args(server_arguments)
+    config_logger(level="info")
+    if args.all_countries:
+        countries = list(parse_yaml("config.yml").keys())
+    else:
+        countries = [c.strip().upper() for c in args.country_iso3.split(",")]
+    asyncio.run(serve(countries, int(args.admin_level), args.host, args.port))
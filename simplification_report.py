@@ -0,0 +1,197 @@
+import pandas as pd
+import numpy as np
+import os
+from utils import (
+    parse_args,
+    simplify_arguments,
+    parse_yaml,
+    config_logger,
+    run_report,
+    profile_run,
+)
+from process_fewsnet import gen_csml1m2
+from process_fewsnet_worldpop import merge_fewsnet_population
+from raster_utils import worldpop_filename, DEFAULT_RESOLUTION
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def compare_phases(df_orig, df_simp, period, adm1c, adm2c):
+    """
+    Count per date the number of admin2 regions of which the assigned IPC phase changes due to the simplification
+    Args:
+        df_orig: output of gen_csml1m2 on the original shapes
+        df_simp: output of gen_csml1m2 on the simplified shapes
+        period: type of FewsNet prediction: CS (current), ML1 (near-term projection) or ML2 (medium-term)
+        adm1c: column name of the admin1 level name
+        adm2c: column name of the admin2 level name
+
+    Returns:
+        df_comp: DataFrame with per date the number of admin2 regions and the number with a changed phase
+    """
+    keys = ["date", adm1c, adm2c]
+    df_comp = df_orig.drop_duplicates(keys).merge(
+        df_simp.drop_duplicates(keys),
+        on=keys,
+        how="outer",
+        suffixes=("_orig", "_simp"),
+    )
+    orig = df_comp[f"{period}_orig"]
+    simp = df_comp[f"{period}_simp"]
+    # nan and nan is not a change, nan and a phase is
+    df_comp["changed"] = (orig != simp) & ~(orig.isnull() & simp.isnull())
+    df_comp = (
+        df_comp.groupby("date")
+        .agg(n_admin2=("changed", "size"), n_changed=("changed", "sum"))
+        .reset_index()
+    )
+    df_comp["period"] = period
+    return df_comp
+
+
+def compare_population(df_orig, df_simp, adm1c, adm2c):
+    """
+    Compute the difference in population per IPC phase per admin2 between the original and simplified shapes
+    Args:
+        df_orig: output of merge_fewsnet_population on the original shapes
+        df_simp: output of merge_fewsnet_population on the simplified shapes
+        adm1c: column name of the admin1 level name
+        adm2c: column name of the admin2 level name
+
+    Returns:
+        dict with the total population, and the net and absolute population difference over all admin-phase combinations
+    """
+    keys = [adm1c, adm2c, "date"]
+    orig = df_orig.set_index(keys)
+    simp = df_simp.set_index(keys)
+    orig, simp = orig.align(simp, join="outer", fill_value=0)
+    diff = simp - orig
+    return {
+        "pop_total": orig.to_numpy().sum(),
+        "pop_net_delta": diff.to_numpy().sum(),
+        "pop_abs_delta": np.abs(diff.to_numpy()).sum(),
+    }
+
+
+def main(country_iso3, tolerance, suffix, config_file="config.yml"):
+    """
+    Report the effect of simplifying the shapes with tolerance on the outputs of process_fewsnet.py and process_fewsnet_worldpop.py
+    For every date and period it gives the number of admin2 regions of which the IPC phase changed,
+    and the difference in the population per IPC phase
+    Args:
+        country_iso3: string with iso3 code
+        tolerance: tolerance in meters with which the shapes are simplified
+        suffix: string to attach to the output files name
+        config_file: path to config file
+    """
+    parameters = parse_yaml(config_file)[country_iso3]
+
+    country = parameters["country_name"]
+    iso2_code = parameters["iso2_code"]
+    region = parameters["region"]
+    regioncode = parameters["regioncode"]
+    admin2_shp = parameters["path_admin2_shp"]
+    shp_adm0c = parameters["shp_adm0c"]
+    shp_adm1c = parameters["shp_adm1c"]
+    shp_adm2c = parameters["shp_adm2c"]
+    fewsnet_dates = parameters["fewsnet_dates"]
+    resolution = parameters.get("worldpop_resolution", DEFAULT_RESOLUTION)
+
+    PATH_FEWSNET = "Data/FewsNetRaw/"
+    FOLDER_POP = f"{country}/Data/WorldPop"
+    ADMIN2_PATH = f"{country}/Data/{admin2_shp}"
+    PERIOD_LIST = ["CS", "ML1", "ML2"]
+    RESULT_FOLDER = f"{country}/Data/FewsNetProcessed/"
+    Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
+
+    df_phases = pd.DataFrame()
+    for period in PERIOD_LIST:
+        df_period = {}
+        for tol in [None, tolerance]:
+            df_period[tol] = gen_csml1m2(
+                PATH_FEWSNET,
+                ADMIN2_PATH,
+                period,
+                fewsnet_dates,
+                shp_adm0c,
+                shp_adm1c,
+                shp_adm2c,
+                region,
+                regioncode,
+                iso2_code,
+                tol,
+            )
+        df_phases = df_phases.append(
+            compare_phases(
+                df_period[None], df_period[tolerance], period, shp_adm1c, shp_adm2c
+            ),
+            ignore_index=True,
+        )
+
+    pop_rows = []
+    for d in fewsnet_dates:
+        pop_path = f"{FOLDER_POP}/{worldpop_filename(country_iso3, d[:4], resolution)}"
+        if not os.path.exists(pop_path):
+            logger.warning(
+                f"Worldpop file for {d} not found, no population delta computed"
+            )
+            continue
+        for period in PERIOD_LIST:
+            fews_path = f"{PATH_FEWSNET}{region}{d}/{regioncode}_{d}_{period}.shp"
+            if not os.path.exists(fews_path):
+                fews_path = (
+                    f"{PATH_FEWSNET}{iso2_code}_{d}/{iso2_code}_{d}_{period}.shp"
+                )
+            if not os.path.exists(fews_path):
+                continue
+            df_pop = {}
+            for tol in [None, tolerance]:
+                df_pop[tol] = merge_fewsnet_population(
+                    fews_path,
+                    ADMIN2_PATH,
+                    pop_path,
+                    d,
+                    period,
+                    shp_adm1c,
+                    shp_adm2c,
+                    tol,
+                )
+            pop_delta = compare_population(
+                df_pop[None], df_pop[tolerance], shp_adm1c, shp_adm2c
+            )
+            pop_delta.update(date=pd.to_datetime(d, format="%Y%m"), period=period)
+            pop_rows.append(pop_delta)
+
+    df_report = df_phases
+    if pop_rows:
+        df_report = df_report.merge(
+            pd.DataFrame(pop_rows), on=["date", "period"], how="left"
+        )
+    df_report = df_report.sort_values(["date", "period"])
+    logger.info(
+        f"Simplifying with {tolerance}m changes {df_report['n_changed'].sum()} admin2 phase assignments"
+    )
+    df_report.to_csv(
+        f"{RESULT_FOLDER}{country}_simplification_report_{tolerance:g}m{suffix}.csv",
+        index=False,
+    )
+
+
+def report_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    simplify_arguments(parser)
+
+
+if __name__ == "__main__":
+    args = parse_args(report_arguments)
+    config_logger(level="warning")
+    if args.simplify_tolerance is None:
+        raise ValueError("Give the tolerance to report on with --simplify-tolerance")
+    with run_report(
+        f"simplification_report_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("simplification_report", args.country_iso3.upper(), args.profile):
+        main(args.country_iso3.upper(), args.simplify_tolerance, args.suffix)
@@ -1,8 +1,13 @@
+import argparse
+import os
+from multiprocessing import Pool
+
 import numpy as np
 import pandas as pd
 import shapefile as shp
 import matplotlib.pyplot as plt
 import seaborn as sns
+from matplotlib.collections import PolyCollection
 
 sns.set_style('dark')
 sns.despine()
@@ -72,9 +77,10 @@ def fill_shape(shape_data, shape_id, axes, colour=None, name=True,
                f_col='black'):
     if not colour:
         colour = region_colours[shape_id]
-    x_vals, y_vals = shape_coor(shape_data, shape_id)
-    axes.fill(x_vals, y_vals, colour)
+    axes.add_collection(PolyCollection(shape_polygons(shape_data),
+                                       facecolors=colour, edgecolors='none'))
     if name:
+        x_vals, y_vals = shape_coor(shape_data, shape_id)
         add_shape_name(plt, x_vals, y_vals, region_name[shape_id],
                        bx_colour=colour, font_col=f_col, bx_alpha=0.85)
 
@@ -87,13 +93,24 @@ def add_shape_name(a_plot, x_vals, y_vals, name, font_col='black',
                 bbox=dict(facecolor=bx_colour, alpha=bx_alpha))
 
 
+def shape_vertices(shape_data):
+    """
+    Return all points of a shape as one (n, 2) array of x/y coordinates
+    """
+    return np.asarray(shape_data.points, dtype=float).reshape(-1, 2)
+
+
+def shape_polygons(shape_data):
+    """
+    Split the points of a shape into one (n, 2) array per part, such that
+    islands and other multi-part regions are not joined by a stray edge
+    """
+    return np.split(shape_vertices(shape_data), shape_data.parts[1:])
+
+
 def shape_coor(shape_data, loc_id):
-    x = np.zeros((len(shape_data.points), 1))
-    y = np.zeros((len(shape_data.points), 1))
-    for ip in range(len(shape_data.points)):
-        x[ip] = shape_data.points[ip][0]
-        y[ip] = shape_data.points[ip][1]
-    return x, y
+    xy = shape_vertices(shape_data)
+    return xy[:, :1], xy[:, 1:]
 
 
 def som_map_plot(shape_fl, ipc_show={}, names=False, fill=False,
@@ -101,47 +118,43 @@ def som_map_plot(shape_fl, ipc_show={}, names=False, fill=False,
                  line_col='#627aa5', x_lim=None, y_lim=None, figsize=(7.3, 6)):
     '''
     Plot the Somalia regional map
+    All regions are drawn with a single PolyCollection, of which the face
+    and edge colours are set per region
     '''
-    plt.figure(figsize=figsize)
-
     fig, ax = plt.subplots(figsize=figsize)
-    loc_id = 0
-    for shape in shape_fl.shapeRecords():
+    polygons = []
+    face_colours = []
+    edge_colours = []
+    for loc_id, shape in enumerate(shape_fl.shapes()):
         region_colour = region_colours[loc_id]
-        x_vals, y_vals = shape_coor(shape.shape, loc_id)
-        if fill:
-            ax.plot(x_vals, y_vals, 'k', color=line_col)
+        if loc_id in ipc_show:
+            face_colour = ipc_colours[ipc_show[loc_id]]
+        elif fill or loc_id in fill_region:
+            face_colour = region_colour
         else:
-            ax.plot(x_vals, y_vals, 'k', color=region_colour)
+            face_colour = 'none'
+        edge_colour = line_col if fill else region_colour
+
+        parts = shape_polygons(shape)
+        polygons.extend(parts)
+        face_colours.extend([face_colour] * len(parts))
+        edge_colours.extend([edge_colour] * len(parts))
 
         if names & (x_lim is None) & (y_lim is None):
+            x_vals, y_vals = shape_coor(shape, loc_id)
             add_shape_name(plt, x_vals, y_vals, region_name[loc_id],
                            bx_colour=region_colour)
-        loc_id += 1
-
-    # Add region colours to the map
-    if fill:
-        for ident in region_name.keys():
-            x_vals, y_vals = shape_coor(shape_fl.shape(ident), ident)
-            ax.fill(x_vals, y_vals, region_colours[ident])
-
-    # Show specific region colours
-    if fill_region and not fill:
-        for ident in fill_region:
-            colour = region_colours[ident]
-            fill_shape(shape_fl.shape(ident), ident, ax)
-
-    # Add IPC region colours
-    if ipc_show:
-        for ident in ipc_show.keys():
-            col_code = ipc_show[ident]
-            colour = ipc_colours[col_code]
-            if col_code == 5:
-                font_colour = 'white'
-            else:
-                font_colour = 'black'
-            fill_shape(shape_fl.shape(ident), ident, ax, colour=colour,
-                       f_col=font_colour)
+        elif (loc_id in ipc_show) or (loc_id in fill_region and not fill):
+            # regions that are filled separately are always named
+            x_vals, y_vals = shape_coor(shape, loc_id)
+            font_colour = 'white' if ipc_show.get(loc_id) == 5 else 'black'
+            add_shape_name(plt, x_vals, y_vals, region_name[loc_id],
+                           bx_colour=face_colour, font_col=font_colour,
+                           bx_alpha=0.85)
+
+    ax.add_collection(PolyCollection(polygons, facecolors=face_colours,
+                                     edgecolors=edge_colours))
+    ax.autoscale_view()
 
     plt.title(title, fontsize=20, fontweight='heavy', color="teal")
     plt.xticks([])
@@ -150,9 +163,88 @@ def som_map_plot(shape_fl, ipc_show={}, names=False, fill=False,
     if (x_lim is not None) & (y_lim is not None):
         plt.xlim(x_lim)
         plt.ylim(y_lim)
+    return fig, ax
+
+
+def dominant_region_phases(df, period, adm1c='ADMIN1'):
+    """
+    Return the IPC phase per region that holds the largest population, in
+    the format of som_map_plot's ipc_show ({region number: phase})
+    Args:
+        df: rows of the processed FewsNet admin1 data for one date
+        period: type of FewsNet prediction: CS, ML1 or ML2
+        adm1c: column name of the region names in df
+    """
+    phase_cols = [f'{period}_{i}' for i in range(1, 6)]
+    df = df[df[adm1c].isin(region_number.keys())]
+    df = df.dropna(subset=phase_cols, how='all')
+    phases = df[phase_cols].fillna(0).to_numpy().argmax(axis=1) + 1
+    return dict(zip(df[adm1c].map(region_number), phases.tolist()))
+
+
+def _init_worker(shape_path):
+    # every worker reads the shapefile once and renders without a GUI
+    global _worker_sf
+    plt.switch_backend('Agg')
+    _worker_sf = shp.Reader(shape_path)
+
+
+def _render_ipc_map(task):
+    date, period, ipc_show, out_path = task
+    fig, _ = som_map_plot(_worker_sf, ipc_show=ipc_show, fill=True,
+                          title=f'{period} {date}')
+    fig.savefig(out_path, bbox_inches='tight')
+    plt.close('all')
+    return out_path
+
+
+def render_ipc_maps(csv_path, output_dir, shape_path=shp_path,
+                    periods=('CS', 'ML1', 'ML2'), adm1c='ADMIN1',
+                    processes=None):
+    """
+    Render the IPC choropleth for every date and period in the processed
+    FewsNet (admin1) csv to PNG files, using a pool of worker processes
+    Args:
+        csv_path: path to the admin1 output of process_fewsnet.py
+        output_dir: directory to which the PNGs are written
+        shape_path: path to the regional shapefile of Somalia
+        periods: FewsNet periods to render
+        adm1c: column name of the region names in the csv
+        processes: number of worker processes, defaults to the cpu count
+
+    Returns:
+        list with the paths of the written PNGs
+    """
+    df = pd.read_csv(csv_path)
+    os.makedirs(output_dir, exist_ok=True)
+    periods = [p for p in periods if f'{p}_1' in df.columns]
+    tasks = []
+    for date, df_date in df.groupby('date'):
+        for period in periods:
+            ipc_show = dominant_region_phases(df_date, period, adm1c)
+            if ipc_show:
+                out_path = os.path.join(output_dir,
+                                        f'somalia_ipc_{period}_{date}.png')
+                tasks.append((date, period, ipc_show, out_path))
+    with Pool(processes, initializer=_init_worker,
+              initargs=(shape_path,)) as pool:
+        return pool.map(_render_ipc_map, tasks)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', help='Processed FewsNet admin1 csv to '
+                        'render a map per date and period for')
+    parser.add_argument('--output', default='maps_graphics_somalia/ipc',
+                        help='Output directory of the batch maps')
+    parser.add_argument('--adm1c', default='ADMIN1',
+                        help='Column name of the region names in the csv')
+    parser.add_argument('-p', '--processes', type=int, default=None)
+    args = parser.parse_args()
+    if args.batch:
+        render_ipc_maps(args.batch, args.output, adm1c=args.adm1c,
+                        processes=args.processes)
+        raise SystemExit
 
     print(sf.records())
 
@@ -0,0 +1,336 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import sys
+from geometries import load_layer
+from utils import parse_args, parse_yaml, config_logger
+from pathlib import Path
+import logging
+import shapely
+
+try:
+    from shapely import STRtree, points, prepare, intersects_xy
+
+    VECTORIZED = True
+except ImportError:
+    # the vectorized STRtree queries are only available from shapely 2.0, before that the points are looked up one by one
+    from shapely.strtree import STRtree
+    from shapely.geometry import Point
+    from shapely.prepared import prep
+
+    VECTORIZED = False
+
+logger = logging.getLogger(__name__)
+
+# directory where the spatial indexes are saved
+SPATIAL_INDEX_DIR = "Data/SpatialIndex/"
+PATH_FEWSNET = "Data/FewsNetRaw/"
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+# crs of the coordinates that are looked up
+LOOKUP_CRS = "EPSG:4326"
+
+
+def fewsnet_layer_paths(path, dates, region, regionabb, iso2_code):
+    """
+    Return the path to the FewsNet shapefile per date and period, with the same preference for the regional over the
+    country file as process_fewsnet.shapefiles_to_df. Dates and periods without a file are left out
+    """
+    paths = {}
+    for d in dates:
+        for period in PERIOD_LIST:
+            shape_region = f"{path}{region}{d}/{regionabb}_{d}_{period}.shp"
+            shape_country = f"{path}{iso2_code}_{d}/{iso2_code}_{d}_{period}.shp"
+            if os.path.exists(shape_region):
+                paths[(d, period)] = shape_region
+            elif os.path.exists(shape_country):
+                paths[(d, period)] = shape_country
+    return paths
+
+
+def _parts(gdf):
+    """
+    Return gdf in LOOKUP_CRS with one row per polygon of its multipolygons
+    FewsNet layers are dissolved per IPC phase, so a few multipolygons have bounding boxes that span the whole region.
+    As single polygons the bounding boxes in the tree select far fewer candidates per point
+    """
+    return gdf.to_crs(LOOKUP_CRS).explode().reset_index(drop=True)
+
+
+def prepare_layer(layer):
+    """
+    Build the STRtree over the polygons of layer and prepare them, which makes the point-in-polygon tests an order of
+    magnitude faster. Neither is pickled, so this is done again after an index is read
+    """
+    if VECTORIZED:
+        prepare(layer["geometries"])
+        layer["tree"] = STRtree(layer["geometries"])
+    else:
+        geoms = list(layer["geometries"])
+        layer["tree"] = STRtree(geoms)
+        # the shapely 1.x STRtree returns the geometries themselves instead of their positions
+        layer["positions"] = {id(g): i for i, g in enumerate(geoms)}
+        layer["prepared"] = [prep(g) for g in geoms]
+    return layer
+
+
+def prepare_index(index):
+    """
+    Build the trees of the admin and FewsNet layers of index, see prepare_layer
+    """
+    prepare_layer(index["admin"])
+    for layer in index["fewsnet"].values():
+        prepare_layer(layer)
+    return index
+
+
+def strip_index(index):
+    """
+    Return a copy of index without the trees and prepared geometries, which is the part that is saved
+    """
+    keep = ["geometries", "names", "phase"]
+    return {
+        "admin": {k: v for k, v in index["admin"].items() if k in keep},
+        "dates": index["dates"],
+        "fewsnet": {
+            key: {k: v for k, v in layer.items() if k in keep}
+            for key, layer in index["fewsnet"].items()
+        },
+    }
+
+
+def build_index(path_admin, admin_cols, fewsnet_paths):
+    """
+    Build an STRtree over the polygons of the admin boundaries and of the FewsNet layer of every date and period
+    FewsNet polygons outside the bounds of the admin layer are left out, since regional layers cover many countries
+    Args:
+        path_admin: path to the file with the lowest level admin boundaries
+        admin_cols: column names of the admin names in path_admin, e.g. [adm0c, adm1c, adm2c]
+        fewsnet_paths: dict with per (date, period) the path to the FewsNet shapefile, see fewsnet_layer_paths
+
+    Returns:
+        index: dict with the admin polygons, tree and names, the sorted FewsNet dates, and per date and period the polygons,
+            tree and IPC phases
+    """
+    df_adm = load_layer(path_admin)
+    df_adm = _parts(df_adm[~df_adm.geometry.isnull()])
+    minx, miny, maxx, maxy = df_adm.total_bounds
+    index = {
+        "admin": {
+            "geometries": np.array(list(df_adm.geometry), dtype=object),
+            "names": df_adm[list(admin_cols)],
+        },
+        "dates": sorted({d for d, _ in fewsnet_paths}),
+        "fewsnet": {},
+    }
+    for (d, period), path in sorted(fewsnet_paths.items()):
+        gdf = _parts(load_layer(path)).cx[minx:maxx, miny:maxy]
+        index["fewsnet"][(d, period)] = {
+            "geometries": np.array(list(gdf.geometry), dtype=object),
+            "phase": pd.to_numeric(gdf[period], errors="coerce").to_numpy(float),
+        }
+    prepare_index(index)
+    logger.info(
+        f"Built spatial index over {len(df_adm)} admin polygons and {len(fewsnet_paths)} FewsNet layers"
+    )
+    return index
+
+
+def index_cache_path(paths, cache_dir=SPATIAL_INDEX_DIR, name="index"):
+    """
+    Return the path to which the index over the files in paths is saved
+    The name contains a hash of the paths and their last modification, such that a changed or added file results in a new index
+    """
+    manifest = []
+    for p in sorted(paths):
+        stat = os.stat(p)
+        manifest.append((os.path.abspath(p), stat.st_mtime_ns, stat.st_size))
+    digest = hashlib.sha1(json.dumps(manifest).encode()).hexdigest()[:12]
+    return f"{cache_dir}{name}_{digest}.pkl"
+
+
+def load_index(country_iso3, config_file="config.yml", cache_dir=SPATIAL_INDEX_DIR):
+    """
+    Return the spatial index of country_iso3, which is built once and saved to cache_dir
+    Later calls read the saved index instead of reading and repairing the shapefiles again. Only the geometries are saved,
+    from which the trees are bulk loaded when the index is read, which takes milliseconds
+    Args:
+        country_iso3: string with iso3 code
+        config_file: path to config file
+        cache_dir: directory where the indexes are saved
+
+    Returns:
+        index: dict in the format of build_index
+    """
+    parameters = parse_yaml(config_file)[country_iso3]
+    path_admin = f"{parameters['country_name']}/Data/{parameters['path_admin2_shp']}"
+    admin_cols = [
+        parameters["shp_adm0c"],
+        parameters["shp_adm1c"],
+        parameters["shp_adm2c"],
+    ]
+    fewsnet_paths = fewsnet_layer_paths(
+        PATH_FEWSNET,
+        parameters["fewsnet_dates"],
+        parameters["region"],
+        parameters["regioncode"],
+        parameters["iso2_code"],
+    )
+    cache_path = index_cache_path(
+        [path_admin] + list(fewsnet_paths.values()),
+        cache_dir,
+        # pickled geometries of shapely 1.x and 2.x can not be read by the other
+        name=f"{country_iso3.lower()}_shapely{shapely.__version__.split('.')[0]}",
+    )
+    if os.path.exists(cache_path):
+        return prepare_index(pd.read_pickle(cache_path))
+    index = build_index(path_admin, admin_cols, fewsnet_paths)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, such that another process never reads a partly written index
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    pd.to_pickle(strip_index(index), tmp_path)
+    os.replace(tmp_path, cache_path)
+    logger.info(f"Saved spatial index of {country_iso3} to {cache_path}")
+    return index
+
+
+def _first_match(layer, x, y):
+    """
+    Return per point the position of the first polygon in layer that contains it, -1 if there is none
+    The tree only selects the polygons of which the bounding box contains the point, the exact test is done on the prepared
+    polygons, which is much faster than a query with a predicate
+    A point on the border of two polygons intersects both, then the polygon that comes first in the layer is returned
+    Args:
+        layer: dict with the tree and prepared polygons, see prepare_layer
+        x: array with the x coordinates of the points
+        y: array with the y coordinates of the points
+    """
+    if not VECTORIZED:
+        match = np.full(len(x), -1)
+        for i in range(len(x)):
+            point = Point(x[i], y[i])
+            candidates = sorted(
+                layer["positions"][id(g)] for g in layer["tree"].query(point)
+            )
+            for pos in candidates:
+                if layer["prepared"][pos].intersects(point):
+                    match[i] = pos
+                    break
+        return match
+    tree = layer["tree"]
+    geoms = points(x, y)
+    geom_idx, tree_idx = tree.query(geoms)
+    hit = intersects_xy(tree.geometries[tree_idx], x[geom_idx], y[geom_idx])
+    geom_idx, tree_idx = geom_idx[hit], tree_idx[hit]
+    match = np.full(len(geoms), -1)
+    # assign in reverse order, such that the lowest tree position of every point is written last
+    order = np.lexsort((-tree_idx, geom_idx))
+    match[geom_idx[order]] = tree_idx[order]
+    return match
+
+
+def lookup_points(index, lon, lat, dates=None):
+    """
+    Return the admin names and the FewsNet IPC phases at the given coordinates
+    The phases are the ones of the most recent FewsNet analysis at the date of the point, i.e. the last FewsNet date
+    on or before that date. Without dates the most recent analysis in the index is used
+    Args:
+        index: spatial index, see load_index
+        lon: array with longitudes in degrees
+        lat: array with latitudes in degrees
+        dates: array with per point a date as YYYYMM, YYYY-MM or YYYY-MM-DD, or None
+
+    Returns:
+        df: DataFrame with per point the coordinates, the date of the FewsNet analysis that applied, the admin names and
+            the CS, ML1 and ML2 phase. Points outside the admins or FewsNet polygons, or in polygons without a phase, have
+            missing values
+    """
+    x = np.asarray(lon, dtype=float)
+    y = np.asarray(lat, dtype=float)
+    names = index["admin"]["names"]
+    adm_idx = _first_match(index["admin"], x, y)
+    df = pd.DataFrame({"lon": lon, "lat": lat})
+    fewsnet_dates = np.array(index["dates"])
+    if dates is None:
+        date_pos = np.full(len(x), len(fewsnet_dates) - 1)
+    else:
+        # there are far fewer distinct dates than points, so only the distinct dates are parsed
+        codes, uniques = pd.factorize(pd.Series(dates).astype(str))
+        # YYYYMM, YYYY-MM and YYYY-MM-DD all start with the year and month once the dashes are removed
+        months = pd.Series(uniques).str.replace("-", "").str[:6]
+        months = months.to_numpy().astype(fewsnet_dates.dtype)
+        date_pos = np.searchsorted(fewsnet_dates, months, side="right")[codes] - 1
+    valid_date = date_pos >= 0
+    df["fewsnet_date"] = np.where(
+        valid_date, fewsnet_dates[np.maximum(date_pos, 0)], None
+    )
+    for c in names.columns:
+        df[c] = np.where(adm_idx >= 0, names[c].to_numpy()[adm_idx], None)
+    for period in PERIOD_LIST:
+        phases = np.full(len(x), np.nan)
+        for pos in np.unique(date_pos[valid_date]):
+            layer = index["fewsnet"].get((fewsnet_dates[pos], period))
+            if layer is None:
+                continue
+            selected = np.flatnonzero(date_pos == pos)
+            match = _first_match(layer, x[selected], y[selected])
+            phases[selected[match >= 0]] = layer["phase"][match[match >= 0]]
+        # values other than 1-5 (66, 88 and 99 for lakes, parks and no data, 0 for not analysed) are missing, as in
+        # process_fewsnet
+        df[period] = np.where((phases >= 1) & (phases <= 5), phases, np.nan)
+    return df
+
+
+def lookup_arguments(parser):
+    """
+    Add the options of the point lookup to parser, see utils.parse_args
+    """
+    parser.add_argument(
+        "--lon", default=None, type=float, help="Longitude of the point to look up"
+    )
+    parser.add_argument(
+        "--lat", default=None, type=float, help="Latitude of the point to look up"
+    )
+    parser.add_argument(
+        "--date",
+        default=None,
+        help="Date (YYYYMM or YYYY-MM) at which to look up the FewsNet phases, by default the most recent analysis",
+    )
+    parser.add_argument(
+        "--points",
+        default=None,
+        help="Csv with a lon, lat and optionally date column of the points to look up",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Csv to save the lookups to, instead of printing them",
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args(lookup_arguments)
+    config_logger(level="info")
+    index = load_index(args.country_iso3.upper())
+    if args.points:
+        df_points = pd.read_csv(args.points)
+        df = lookup_points(
+            index,
+            df_points["lon"].to_numpy(),
+            df_points["lat"].to_numpy(),
+            df_points["date"] if "date" in df_points.columns else None,
+        )
+    else:
+        if args.lon is None or args.lat is None:
+            raise ValueError(
+                "Give a point with --lon and --lat, or a csv with --points"
+            )
+        df = lookup_points(
+            index, [args.lon], [args.lat], [args.date] if args.date else None
+        )
+    if args.output:
+        df.to_csv(args.output, index=False)
+        logger.info(f"Saved {len(df)} lookups to {args.output}")
+    else:
+        df.to_csv(sys.stdout, index=False)
@@ -0,0 +1,373 @@
+import pandas as pd
+import numpy as np
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    parse_yaml,
+    config_logger,
+    timed,
+    timed_stage,
+    frame_counts,
+    run_report,
+    profile_run,
+)
+from pathlib import Path
+import itertools
+import warnings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# trigger columns of IPC_computetrigger.py that are evaluated next to the variants
+OPERATIONAL_TRIGGERS = ["trigger_ML1", "trigger_ML2"]
+# an admin has a CS outcome if at least OUTCOME_PERC percent of its population is in IPC level OUTCOME_LEVEL or higher
+OUTCOME_LEVEL = 3
+OUTCOME_PERC = 20
+# number of months after an activation in which an outcome counts as anticipated
+MAX_LEAD_MONTHS = 12
+# number of months after a FewsNet analysis in which a GlobalIPC analysis is compared with it for the overlap
+OVERLAP_TOLERANCE_MONTHS = 4
+
+
+def variant_grid(
+    periods=("ML1", "ML2"),
+    levels=(3, 4),
+    percs=range(5, 55, 5),
+    increases=(None, 0, 5, 10),
+):
+    """
+    Return all combinations of the trigger parameters as variants
+    A variant activates if at least perc percent of the population is projected in IPC level or higher in period, and if
+    increase is given, that percentage is also at least increase percentage points higher than in the CS. These are the
+    conditions of get_trigger and get_trigger_increase in IPC_computetrigger.py
+
+    Returns:
+        df_variants: DataFrame with per variant the name, period, level, perc and increase (nan if not used)
+    """
+    rows = []
+    for period, level, perc, increase in itertools.product(
+        periods, levels, percs, increases
+    ):
+        rows.append(
+            {
+                "name": f"{period}_{level}_{perc}"
+                + (f"_{increase}i" if increase is not None else ""),
+                "period": period,
+                "level": level,
+                "perc": perc,
+                "increase": np.nan if increase is None else increase,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def _level_perc(df, period, level):
+    """
+    Return the percentage of the population in IPC level or higher in period, nan if the population is missing
+    """
+    return df[[f"perc_{period}_{l}" for l in range(level, 6)]].sum(axis=1, min_count=1)
+
+
+@timed("activations")
+def activations(df, df_variants):
+    """
+    Return per row of df whether each variant activated, as a boolean matrix computed in one broadcast over all variants
+    Args:
+        df: output of IPC_computetrigger.py, with the perc_ columns per period and level
+        df_variants: variants in the format of variant_grid
+
+    Returns:
+        active: (rows x variants) boolean array
+    """
+    pairs = list(
+        dict.fromkeys(
+            df_variants[["period", "level"]].itertuples(index=False, name=None)
+        )
+    )
+    perc = np.column_stack([_level_perc(df, p, l).to_numpy() for p, l in pairs])
+    increase = np.column_stack(
+        [
+            (_level_perc(df, p, l) - _level_perc(df, "CS", l)).to_numpy()
+            for p, l in pairs
+        ]
+    )
+    cols = [
+        pairs.index(pair)
+        for pair in df_variants[["period", "level"]].itertuples(index=False, name=None)
+    ]
+    inc_threshold = df_variants["increase"].to_numpy(float)
+    # rounded as in IPC_computetrigger.get_trigger, rows with a missing population never activate
+    with np.errstate(invalid="ignore"):
+        active = np.round(perc[:, cols]) >= df_variants["perc"].to_numpy(float)
+        active &= np.isnan(inc_threshold) | (
+            np.round(increase[:, cols]) >= np.nan_to_num(inc_threshold)
+        )
+    return active
+
+
+def _months(dates):
+    return dates.dt.year.to_numpy() * 12 + dates.dt.month.to_numpy() - 1
+
+
+def _shift_in_group(values, groups, fill, periods):
+    """
+    Shift the rows of values by periods within their group, the rows that are shifted in from outside the group are fill
+    """
+    shifted = np.full_like(values, fill)
+    if periods > 0:
+        same_group = groups[periods:] == groups[:-periods]
+        shifted[periods:][same_group] = values[:-periods][same_group]
+    else:
+        same_group = groups[:periods] == groups[-periods:]
+        shifted[:periods][same_group] = values[-periods:][same_group]
+    return shifted
+
+
+def backtest(
+    df,
+    df_variants,
+    admin_cols,
+    outcome_level=OUTCOME_LEVEL,
+    outcome_perc=OUTCOME_PERC,
+    max_lead=MAX_LEAD_MONTHS,
+):
+    """
+    Evaluate the trigger variants, and the operational triggers in df, over the full history of every source and admin
+    The rows are sorted by source, admin and date, such that the first outcome after every row and the last activation before
+    every row are found for all variants at once with cumulative minima and maxima within the admins
+    Args:
+        df: output of IPC_computetrigger.py
+        df_variants: variants in the format of variant_grid
+        admin_cols: admin columns of df, e.g. ["ADMIN1"] or ["ADMIN1", "ADMIN2"]
+        outcome_level: IPC level of the outcome
+        outcome_perc: percentage of the population in outcome_level or higher in the CS from which there is an outcome
+        max_lead: number of months after an activation in which an outcome counts as anticipated
+
+    Returns:
+        df_stats: DataFrame with per source and variant:
+            n_analyses: number of admin x date analyses
+            activation_rate: share of the analyses in which the variant activated
+            n_activations: number of activations, i.e. analyses in which the variant activated and did not in the previous
+                analysis of the admin
+            n_years, n_activation_years: number of years with analyses, and of years in which the variant activated in any admin
+            return_period: n_years / n_activation_years, the average number of years between years with an activation
+            precision: share of the activations that were followed by an outcome within max_lead months
+            detection_rate: share of the outcome onsets that were preceded by an activation within max_lead months
+            mean_lead_months, median_lead_months: months from the activations to the first later outcome, over the
+                activations followed by an outcome within max_lead months
+        active: (rows x variants) boolean activation matrix of the rows of df_sorted, with the operational triggers as last columns
+        df_sorted: df sorted by source, admin and date
+    """
+    admin_cols = list(admin_cols)
+    df = df.copy()
+    df["date"] = pd.to_datetime(df["date"])
+    df = df.sort_values(["Source"] + admin_cols + ["date"]).reset_index(drop=True)
+    operational = [c for c in OPERATIONAL_TRIGGERS if c in df.columns]
+    names = list(df_variants["name"]) + operational
+    with timed_stage("backtest") as stage:
+        active = np.hstack(
+            [
+                activations(df, df_variants),
+                df[operational].fillna(False).to_numpy(bool),
+            ]
+        )
+        groups = df.groupby(["Source"] + admin_cols, sort=False).ngroup().to_numpy()
+        months = _months(df["date"])
+
+        outcome = (
+            np.round(_level_perc(df, "CS", outcome_level).to_numpy()) >= outcome_perc
+        )
+        outcome_onset = outcome & ~_shift_in_group(outcome, groups, False, 1)
+        onset = active & ~_shift_in_group(active, groups, False, 1)
+
+        # months far outside any date, used for rows without a later outcome or earlier activation
+        never = 10**9
+        # the month of the first outcome after every row, with a cummin from the end of every admin
+        outcome_months = pd.Series(np.where(outcome, months, never)[::-1])
+        next_outcome = outcome_months.groupby(groups[::-1]).cummin().to_numpy()[::-1]
+        next_outcome = _shift_in_group(next_outcome, groups, never, -1)
+        lead = np.where(next_outcome == never, np.nan, next_outcome - months)
+        anticipated = onset & (lead <= max_lead)[:, None]
+        # the month of the last activation before every row, with a cummax from the start of every admin
+        active_months = pd.DataFrame(np.where(active, months[:, None], -never))
+        last_active = active_months.groupby(groups).cummax().to_numpy()
+        last_active = _shift_in_group(last_active, groups, -never, 1)
+        detected = outcome_onset[:, None] & (months[:, None] - last_active <= max_lead)
+
+        lead_anticipated = np.where(anticipated, lead[:, None], np.nan)
+        years = df["date"].dt.year.to_numpy()
+        df_stats = []
+        for source in df["Source"].unique():
+            rows = (df["Source"] == source).to_numpy()
+            activation_years = (
+                pd.DataFrame(active[rows]).groupby(years[rows]).any().sum().to_numpy()
+            )
+            n_years = len(np.unique(years[rows]))
+            n_onsets = onset[rows].sum(axis=0)
+            n_outcomes = outcome_onset[rows].sum()
+            with np.errstate(
+                invalid="ignore", divide="ignore"
+            ), warnings.catch_warnings():
+                # variants without anticipated activations have no lead time
+                warnings.simplefilter("ignore", RuntimeWarning)
+                df_stats.append(
+                    pd.DataFrame(
+                        {
+                            "Source": source,
+                            "variant": names,
+                            "n_analyses": rows.sum(),
+                            "activation_rate": active[rows].mean(axis=0),
+                            "n_activations": n_onsets,
+                            "n_years": n_years,
+                            "n_activation_years": activation_years,
+                            "return_period": np.where(
+                                activation_years > 0, n_years / activation_years, np.nan
+                            ),
+                            "precision": np.where(
+                                n_onsets > 0,
+                                anticipated[rows].sum(axis=0) / n_onsets,
+                                np.nan,
+                            ),
+                            "detection_rate": detected[rows].sum(axis=0) / n_outcomes
+                            if n_outcomes
+                            else np.nan,
+                            "mean_lead_months": np.nanmean(
+                                lead_anticipated[rows], axis=0
+                            ),
+                            "median_lead_months": np.nanmedian(
+                                lead_anticipated[rows], axis=0
+                            ),
+                        }
+                    )
+                )
+        df_stats = pd.concat(df_stats, ignore_index=True)
+        stage.update(frame_counts(df_stats))
+    return df_stats, active, df
+
+
+def source_overlap(
+    df_sorted,
+    active,
+    names,
+    admin_cols,
+    tolerance=OVERLAP_TOLERANCE_MONTHS,
+):
+    """
+    Return per variant how often FewsNet and GlobalIPC agreed on activating in the same admin
+    Every GlobalIPC analysis is compared with the last FewsNet analysis of the admin on or before it, within tolerance months
+    Args:
+        df_sorted: rows as returned by backtest
+        active: activation matrix as returned by backtest
+        names: names of the columns of active
+        admin_cols: admin columns of df_sorted
+        tolerance: maximum number of months between the FewsNet and GlobalIPC analysis
+
+    Returns:
+        df_overlap: DataFrame with per variant the number of compared analyses, in how many both, only FewsNet or only
+            GlobalIPC activated, the share of agreement and the Jaccard index (both / either) of the activations
+    """
+    admin_cols = list(admin_cols)
+    df_pos = df_sorted[["Source", "date"] + admin_cols].assign(
+        pos=np.arange(len(df_sorted))
+    )
+    for c in admin_cols:
+        df_pos[c] = df_pos[c].astype(object)
+    df_pairs = pd.merge_asof(
+        df_pos[df_pos["Source"] == "GlobalIPC"].sort_values("date"),
+        df_pos[df_pos["Source"] == "FewsNet"].sort_values("date"),
+        on="date",
+        by=admin_cols,
+        direction="backward",
+        tolerance=pd.Timedelta(days=31 * tolerance),
+        suffixes=("_gipc", "_fews"),
+    )
+    df_pairs = df_pairs[df_pairs["pos_fews"].notnull()]
+    fews = active[df_pairs["pos_fews"].to_numpy(int)]
+    gipc = active[df_pairs["pos_gipc"].to_numpy(int)]
+    both = (fews & gipc).sum(axis=0)
+    fews_only = (fews & ~gipc).sum(axis=0)
+    gipc_only = (~fews & gipc).sum(axis=0)
+    n_pairs = len(df_pairs)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame(
+            {
+                "variant": names,
+                "n_compared": n_pairs,
+                "both": both,
+                "fewsnet_only": fews_only,
+                "globalipc_only": gipc_only,
+                "agreement": (n_pairs - fews_only - gipc_only) / n_pairs
+                if n_pairs
+                else np.nan,
+                "jaccard": np.where(
+                    both + fews_only + gipc_only > 0,
+                    both / (both + fews_only + gipc_only),
+                    np.nan,
+                ),
+            }
+        )
+
+
+def main(
+    country_iso3, admin_level, suffix="", config_file="config.yml", df_variants=None
+):
+    """
+    Backtest the trigger variants on the output of IPC_computetrigger.py for country_iso3 and admin_level
+    Saves the statistics per source and variant and the FewsNet - GlobalIPC overlap per variant to country_name/Data/TriggerBacktest/
+    Args:
+        country_iso3: string with iso3 code
+        admin_level: admin level of the trigger output
+        suffix: string that is attached to the input file name and will be attached to the output file names
+        config_file: path to config file
+        df_variants: variants in the format of variant_grid, by default the full variant_grid
+
+    Returns:
+        df_stats: statistics per source and variant, see backtest
+        df_overlap: overlap per variant, see source_overlap
+    """
+    parameters = parse_yaml(config_file)[country_iso3]
+    country = parameters["country_name"]
+    trigger_path = (
+        f"{country}/Data/IPC_trigger/trigger_results_admin{admin_level}{suffix}.csv"
+    )
+    RESULT_FOLDER = f"{country}/Data/TriggerBacktest/"
+    Path(RESULT_FOLDER).mkdir(parents=True, exist_ok=True)
+    if df_variants is None:
+        df_variants = variant_grid()
+    admin_cols = [f"ADMIN{a}" for a in range(1, int(admin_level) + 1)]
+
+    with timed_stage("read") as stage:
+        df = pd.read_csv(trigger_path)
+        stage.update(frame_counts(df))
+    df_stats, active, df_sorted = backtest(df, df_variants, admin_cols)
+    names = list(df_stats["variant"].drop_duplicates())
+    df_overlap = source_overlap(df_sorted, active, names, admin_cols)
+    with timed_stage("write"):
+        df_stats.to_csv(
+            f"{RESULT_FOLDER}{country}_trigger_backtest_admin{admin_level}{suffix}.csv",
+            index=False,
+        )
+        df_overlap.to_csv(
+            f"{RESULT_FOLDER}{country}_trigger_overlap_admin{admin_level}{suffix}.csv",
+            index=False,
+        )
+    logger.info(
+        f"Backtested {len(names)} triggers on {len(df_sorted)} analyses of {country_iso3}"
+    )
+    return df_stats, df_overlap
+
+
+def backtest_arguments(parser):
+    """
+    Add the options of this script to parser, see utils.parse_args
+    """
+    admin_level_arguments(parser)
+
+
+if __name__ == "__main__":
+    args = parse_args(backtest_arguments)
+    config_logger(level="info")
+    with run_report(
+        f"trigger_backtest_{args.country_iso3.upper()}", args.trace_memory
+    ), profile_run("trigger_backtest", args.country_iso3.upper(), args.profile):
+        main(args.country_iso3.upper(), args.admin_level, args.suffix)
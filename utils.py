@@ -1,12 +1,50 @@
 import yaml
 import argparse
 import coloredlogs
+import cProfile
+import functools
+import glob
+import inspect
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import logging
 
+try:
+    import resource
+except ImportError:
+    # resource is not available on windows, there the peak RSS is not reported
+    resource = None
 
-def parse_args():
+logger = logging.getLogger(__name__)
+
+# directory where the reports of the runs are saved
+RUN_REPORT_DIR = "Data/RunReports/"
+# directory where the profiles of the runs are saved, per country and run id
+PROFILE_DIR = "Data/Profiles/"
+# SQLite database of results_store, one database for all countries next to the other shared data
+DEFAULT_DB_PATH = "Data/results.sqlite"
+# records of the stages that are timed in this process, see timed_stage
+_stage_records = []
+# peak traced memory of the stages that are currently running, the innermost last
+_open_peaks = []
+# tracemalloc snapshot at the end of the stage after which most memory was held, taken when profiling memory
+_memory_snapshot = {"active": False, "size": 0, "snapshot": None, "stage": None}
+
+
+def parse_args(extra_args=None):
+    """
+    Parse the command line options that the scripts share
+    Args:
+        extra_args: function that adds the options of a single script to the parser, e.g. serve_results.server_arguments
+    """
     parser = argparse.ArgumentParser()
-    parser.add_argument("country_iso3", help="Country ISO3")
-    parser.add_argument("-a", "--admin_level", default=1)
     # Prefix for filenames
     parser.add_argument(
         "-s",
@@ -15,7 +53,124 @@ def parse_args():
         type=str,
         help="Suffix for output files, and if applicable input files",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Trace the peak Python memory per stage with tracemalloc, which makes the run slower",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        choices=["cpu", "mem", "both"],
+        help="Profile the run with cProfile (cpu) and/or tracemalloc snapshots (mem), saved to Data/Profiles/",
+    )
+    if extra_args:
+        extra_args(parser)
+    # scripts that run for several countries add country_iso3 themselves, see multi_country_arguments
+    multi_country = parser.get_default("all_countries") is not None
+    if not multi_country:
+        parser.add_argument("country_iso3", help="Country ISO3")
+    args = parser.parse_args()
+    if multi_country and args.country_iso3 is None and not args.all_countries:
+        parser.error("give a country_iso3 or --all-countries")
+    if not multi_country and "," in args.country_iso3:
+        parser.error("this script runs for one country, give a single country_iso3")
+    return args
+
+
+def multi_country_arguments(parser):
+    """
+    Let a script run for several countries, given as a comma-separated list of ISO3 codes or with --all-countries
+    Call from the extra_args function of the script, see parse_args
+    """
+    parser.add_argument(
+        "country_iso3",
+        nargs="?",
+        help="Country ISO3, or a comma-separated list of ISO3 codes",
+    )
+    parser.add_argument(
+        "--all-countries",
+        action="store_true",
+        help="Run for all countries in the config file",
+    )
+
+
+def simplify_arguments(parser):
+    """
+    Add --simplify-tolerance to parser, for the scripts that overlay the admin and FewsNet shapes, see parse_args
+    """
+    parser.add_argument(
+        "--simplify-tolerance",
+        default=None,
+        type=float,
+        help="Tolerance in meters to simplify the admin and FewsNet shapes with before the overlay",
+    )
+
+
+def crosswalk_arguments(parser):
+    """
+    Add --crosswalk to parser, for the scripts that can use the cached admin x FewsNet crosswalk, see parse_args
+    """
+    parser.add_argument(
+        "--crosswalk",
+        action="store_true",
+        help="Compute the results from the cached admin x FewsNet crosswalk instead of an overlay per date",
+    )
+
+
+def tile_size_arguments(parser):
+    """
+    Add --tile-size to parser, for the scripts that aggregate the WorldPop rasters, see parse_args
+    """
+    parser.add_argument(
+        "--tile-size",
+        default=None,
+        type=int,
+        help="Stream the WorldPop rasters in tiles of this many rows and columns, which bounds the memory use for the 100m rasters",
+    )
+
+
+def resume_arguments(parser):
+    """
+    Add --resume to parser, for the scripts that checkpoint the FewsNet-WorldPop stage, see parse_args
+    """
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a previous run from its checkpoints, skipping the dates and periods that were already processed",
+    )
+
+
+def results_db_arguments(parser):
+    """
+    Add --results-db to parser, for the scripts that can save their results to the SQLite database, see parse_args
+    """
+    parser.add_argument(
+        "--results-db",
+        nargs="?",
+        const=DEFAULT_DB_PATH,
+        default=None,
+        help=f"Also save the results to this SQLite database, {DEFAULT_DB_PATH} if no path is given",
+    )
+
+
+def admin_level_arguments(parser, levels=(1, 2, 3), default=1):
+    """
+    Add --admin-level to parser, for the scripts that compute or read the results of one admin level, see parse_args
+    Args:
+        parser: the parser of parse_args
+        levels: the admin levels that the script supports
+        default: the admin level if none is given
+    """
+    parser.add_argument(
+        "-a",
+        "--admin_level",
+        "--admin-level",
+        type=int,
+        choices=list(levels),
+        default=default,
+        help="Admin level of the output. Admin3 is only computed from FewsNet data",
+    )
 
 
 def parse_yaml(filename):
@@ -37,3 +192,332 @@ def config_logger(level="INFO"):
             "levelname": {"color": 8, "bold": True},
         },
     )
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the process so far in MB, None if it cannot be determined
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macos and in kilobytes on linux
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+def frame_counts(df):
+    """
+    Return the number of rows and, for a GeoDataFrame, the number of geometries in df. Empty if df is not a DataFrame
+    """
+    if not hasattr(df, "shape") or len(df.shape) != 2:
+        return {}
+    counts = {"rows": len(df)}
+    if hasattr(df, "geometry"):
+        counts["geometries"] = int(df.geometry.notnull().sum())
+    return counts
+
+
+@contextmanager
+def timed_stage(stage, **unit):
+    """
+    Time a stage of the pipeline, and record it in the report of the run
+    The record contains the wall and cpu time, the peak RSS of the process, and if tracemalloc is tracing the peak Python memory
+    during the stage. Rows and geometries can be added to the yielded record, e.g. with record.update(frame_counts(df))
+    Args:
+        stage: name of the stage, e.g. "read", "overlay", "zonal", "aggregate", "trigger" or "write"
+        **unit: the unit the stage is run for, e.g. date and period
+
+    Yields:
+        record: dict with the record of the stage
+    """
+    record = {"stage": stage, "unit": {k: str(v) for k, v in unit.items()}}
+    record["depth"] = len(_open_peaks)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # the peak is reset for this stage, so first hand the peak so far to the enclosing stage
+        if _open_peaks:
+            _open_peaks[-1] = max(_open_peaks[-1], tracemalloc.get_traced_memory()[1])
+        # reset_peak is only available from python 3.9, before that the peak since the start of tracing is reported
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+    _open_peaks.append(0)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    except BaseException as err:
+        record["error"] = type(err).__name__
+        raise
+    finally:
+        record["wall_s"] = time.perf_counter() - wall_start
+        record["cpu_s"] = time.process_time() - cpu_start
+        peak = _open_peaks.pop()
+        if tracing:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record["peak_traced_mb"] = peak / 1024**2
+            if _open_peaks:
+                _open_peaks[-1] = max(_open_peaks[-1], peak)
+        record["peak_rss_mb"] = peak_rss_mb()
+        _stage_records.append(record)
+        if _memory_snapshot["active"] and tracemalloc.is_tracing():
+            size = tracemalloc.get_traced_memory()[0]
+            if size > _memory_snapshot["size"]:
+                _memory_snapshot.update(
+                    size=size,
+                    snapshot=tracemalloc.take_snapshot(),
+                    stage=f"{stage} {record['unit']}",
+                )
+
+
+def timed(stage, unit=()):
+    """
+    Decorator that runs the function in a timed_stage, with the arguments named in unit as unit of the stage
+    If the function returns a DataFrame its rows and geometries are recorded
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            with timed_stage(
+                stage, **{u: arguments[u] for u in unit if u in arguments}
+            ) as record:
+                result = func(*args, **kwargs)
+                record.update(frame_counts(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def collect_stages(func, *args, **kwargs):
+    """
+    Run func and return its result together with the records of the stages timed during the run
+    Used to get the records of functions that run in a worker process back to the main process
+    """
+    del _stage_records[:]
+    result = func(*args, **kwargs)
+    return result, list(_stage_records)
+
+
+def add_stage_records(records):
+    """
+    Add records of stages that were timed in another process, see collect_stages
+    """
+    _stage_records.extend(records)
+
+
+def print_slowest_stages(records, top_n=10):
+    """
+    Print a table with the top_n stages with the largest wall time
+    """
+    slowest = sorted(
+        [r for r in records if r["stage"] != "run"],
+        key=lambda r: r["wall_s"],
+        reverse=True,
+    )[:top_n]
+    print(
+        f"{'stage':<12}{'unit':<32}{'wall (s)':>10}{'cpu (s)':>10}{'rss (MB)':>10}{'rows':>10}"
+    )
+    for r in slowest:
+        unit = ", ".join(f"{k}={v}" for k, v in r["unit"].items())
+        rss = f"{r['peak_rss_mb']:.0f}" if r["peak_rss_mb"] is not None else "-"
+        print(
+            f"{r['stage']:<12}{unit[:31]:<32}{r['wall_s']:>10.2f}{r['cpu_s']:>10.2f}{rss:>10}{r.get('rows', ''):>10}"
+        )
+
+
+def summarize_stages(records):
+    """
+    Return per stage the number of records and the total wall and cpu time
+    """
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r["stage"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        s["count"] += 1
+        s["wall_s"] += r["wall_s"]
+        s["cpu_s"] += r["cpu_s"]
+    return summary
+
+
+@contextmanager
+def run_report(
+    name, trace_memory=False, report_dir=RUN_REPORT_DIR, top_n=10, keep=None
+):
+    """
+    Time the stages of a run, and at the end save a json report to report_dir and print the top_n slowest stages
+    The report is also written if the run fails, such that it shows up to which stage the run got
+    Args:
+        name: name of the run, used in the filename of the report, e.g. the script and country
+        trace_memory: if True, trace the peak Python memory per stage with tracemalloc
+        report_dir: directory where the report is saved
+        top_n: number of stages in the printed table
+        keep: if given, only the keep most recent reports of name are kept, such that repeated runs do not fill report_dir
+    """
+    del _stage_records[:]
+    started = datetime.now()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with timed_stage("run"):
+            yield
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        records = list(_stage_records)
+        Path(report_dir).mkdir(parents=True, exist_ok=True)
+        report_path = f"{report_dir}{name}_{started.strftime('%Y%m%dT%H%M%S')}.json"
+        with open(report_path, "w") as f:
+            json.dump(
+                {
+                    "name": name,
+                    "started": started.isoformat(),
+                    "argv": sys.argv,
+                    "trace_memory": trace_memory,
+                    "summary": summarize_stages(records),
+                    "stages": records,
+                },
+                f,
+                indent=2,
+            )
+        if keep:
+            # the timestamps sort chronologically
+            reports = sorted(glob.glob(f"{report_dir}{name}_????????T??????.json"))
+            for path in reports[:-keep]:
+                os.remove(path)
+        print_slowest_stages(records, top_n)
+        logger.info(f"Saved run report to {report_path}")
+
+
+def collapsed_stacks(stats, min_time=1e-4, max_depth=64):
+    """
+    Convert cProfile stats to collapsed stacks ("f1;f2;f3 microseconds" per line), the input format of flame graph tools
+    cProfile only records caller-callee pairs, not full stacks. The time of a function is therefore divided over its callees
+    in proportion to the cumulative time of each caller-callee pair, starting from the functions without caller.
+    Args:
+        stats: pstats.Stats of the profiled run
+        min_time: stacks with less time in seconds are left out
+        max_depth: maximum depth of the stacks
+
+    Returns:
+        lines: list of strings with the collapsed stacks
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, ct) in callers.items():
+            callees.setdefault(caller, []).append((func, ct))
+
+    def label(func):
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    totals = {}
+
+    def walk(func, stack, time_path):
+        _, _, tt, ct, _ = stats.stats[func]
+        stack = stack + [label(func)]
+        if ct > 0:
+            totals[";".join(stack)] = (
+                totals.get(";".join(stack), 0) + time_path * tt / ct
+            )
+        if len(stack) >= max_depth or ct <= 0:
+            return
+        for callee, edge_ct in callees.get(func, []):
+            child_time = time_path * edge_ct / ct
+            # recursive calls are not followed, their time is part of the caller
+            if child_time >= min_time and label(callee) not in stack:
+                walk(callee, stack, child_time)
+
+    for func, (_, _, _, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, [], ct)
+    return [
+        f"{stack} {int(round(t * 1e6))}"
+        for stack, t in sorted(totals.items())
+        if t >= min_time
+    ]
+
+
+def write_memory_profile(snapshot, start_snapshot, path_prefix, moment, top_n=30):
+    """
+    Save the tracemalloc snapshot, and a text file with the lines that allocated most of the memory that was held at the moment
+    of the snapshot compared to the start of the run, with the traceback of the largest ones
+    """
+    snapshot.dump(f"{path_prefix}.tracemalloc")
+    with open(f"{path_prefix}_memory.txt", "w") as f:
+        f.write(
+            f"Top {top_n} lines by memory held at the end of {moment}, compared to the start of the run\n"
+        )
+        for stat in snapshot.compare_to(start_snapshot, "lineno")[:top_n]:
+            f.write(f"{stat}\n")
+        f.write(f"\nTracebacks of the {min(top_n, 10)} largest allocations\n")
+        for stat in snapshot.statistics("traceback")[: min(top_n, 10)]:
+            f.write(f"\n{stat.count} blocks, {stat.size / 1024 ** 2:.1f} MB\n")
+            for line in stat.traceback.format():
+                f.write(f"{line}\n")
+
+
+@contextmanager
+def profile_run(name, country_iso3, mode=None, profile_dir=PROFILE_DIR):
+    """
+    Profile the code that runs within the context, if mode is given
+    With "cpu" the run is profiled with cProfile, and saved as .pstats file and as collapsed stacks that can be turned into a
+    flame graph, e.g. with flamegraph.pl or speedscope. With "mem" a tracemalloc snapshot is taken at the start and end of
+    the run and at the end of every timed stage. The snapshot at the moment most memory is held is saved, together with a text
+    file with the lines that allocated that memory, e.g. DataFrames that accumulate over a loop. With "both" both are done.
+    The profiles are saved to profile_dir/country_iso3/run_id/. Only the main process is profiled, not worker processes.
+    Args:
+        name: name of the script, used in the filenames
+        country_iso3: iso3 code of the country, or another name of the set of countries that is run
+        mode: None, "cpu", "mem" or "both"
+        profile_dir: directory where the profiles are saved
+    """
+    if mode is None:
+        yield
+        return
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+    folder = f"{profile_dir}{country_iso3}/{run_id}/"
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    path_prefix = f"{folder}{name}"
+
+    trace_mem = mode in ["mem", "both"]
+    # tracemalloc might already be tracing for the run report, then it is left running
+    started_tracing = trace_mem and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(25)
+    start_snapshot = tracemalloc.take_snapshot() if trace_mem else None
+    _memory_snapshot.update(active=trace_mem, size=0, snapshot=None, stage=None)
+    profiler = cProfile.Profile() if mode in ["cpu", "both"] else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        if trace_mem:
+            # the snapshot is taken before the cpu profile is processed, such that it only contains the memory of the run
+            snapshot = _memory_snapshot["snapshot"]
+            moment = f"stage {_memory_snapshot['stage']}"
+            if snapshot is None:
+                # no stages were timed during the run
+                snapshot = tracemalloc.take_snapshot()
+                moment = "the run"
+            _memory_snapshot.update(active=False, snapshot=None)
+            if started_tracing:
+                tracemalloc.stop()
+            snapshot = snapshot.filter_traces(
+                [
+                    tracemalloc.Filter(False, cProfile.__file__),
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                ]
+            )
+            write_memory_profile(snapshot, start_snapshot, path_prefix, moment)
+        if profiler:
+            profiler.dump_stats(f"{path_prefix}.pstats")
+            with open(f"{path_prefix}.collapsed", "w") as f:
+                f.write("\n".join(collapsed_stacks(pstats.Stats(profiler))))
+        logger.info(f"Saved {mode} profile to {folder}")
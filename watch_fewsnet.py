@@ -0,0 +1,373 @@
+import gc
+import hashlib
+import json
+import os
+import re
+import time
+from utils import (
+    parse_args,
+    admin_level_arguments,
+    results_db_arguments,
+    crosswalk_arguments,
+    multi_country_arguments,
+    parse_yaml,
+    config_logger,
+    run_report,
+)
+from process_fewsnet import find_pop_paths
+from raster_utils import DEFAULT_RESOLUTION
+from run_pipeline import run_pipeline
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+PATH_FEWSNET = "Data/FewsNetRaw/"
+PERIOD_LIST = ["CS", "ML1", "ML2"]
+# files of a shapefile that have to be present before it can be read
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf"]
+# signatures of the releases and rasters that were processed, such that a restarted watcher does not process them again
+WATCH_STATE_PATH = "Data/Watch/watch_state.json"
+# number of run reports kept per country, as every processing run of the watcher writes one
+WATCH_REPORTS_KEEP = 10
+# seconds after which a failed run is tried again, doubling after every failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 300
+MAX_RETRY_DELAY = 6 * 3600
+
+
+def release_folders(names, parameters):
+    """
+    Return per date the folder and file prefix of the FewsNet release of a country, from the folder names in names
+    FewsNet publishes per region (e.g. east-africa202010/EA_202010_CS.shp) or per country (ET_202010/ET_202010_CS.shp).
+    As in process_fewsnet, the regional release is used if both exist
+    """
+    patterns = [
+        (
+            re.compile(rf"{re.escape(parameters['iso2_code'])}_(\d{{6}})$"),
+            parameters["iso2_code"],
+        ),
+        (
+            re.compile(rf"{re.escape(parameters['region'])}(\d{{6}})$"),
+            parameters["regioncode"],
+        ),
+    ]
+    releases = {}
+    # the regional pattern comes last, such that it replaces the country release of the same date
+    for pattern, prefix in patterns:
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                releases[match.group(1)] = (name, prefix)
+    return releases
+
+
+def files_signature(paths):
+    """
+    Return a hash of the size and modification time of the files in paths, and the most recent modification time in seconds
+    Returns None, None if one of the files does not exist
+    """
+    h = hashlib.sha1()
+    newest = 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        h.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+        newest = max(newest, stat.st_mtime)
+    return h.hexdigest(), newest
+
+
+def release_signature(folder_fews, name, prefix, date):
+    """
+    Return the signature of the FewsNet release in folder name, see files_signature
+    A release is only complete if the shapefiles of all periods are present, otherwise None, None is returned
+    """
+    return files_signature(
+        [
+            f"{folder_fews}{name}/{prefix}_{date}_{period}{ext}"
+            for period in PERIOD_LIST
+            for ext in SHAPEFILE_EXTENSIONS
+        ]
+    )
+
+
+def settled(pending, key, signature, newest, now, settle):
+    """
+    Return whether the files of key are no longer being copied
+    A copy in progress changes the size or modification time of the files, so the files are settled once their signature
+    did not change for settle seconds. Files that are seen for the first time and were last modified more than settle
+    seconds ago, e.g. when the watcher starts, are settled right away. pending keeps per key the last signature and the
+    moment it was first seen, and is updated in place
+    """
+    last = pending.get(key)
+    if last is None or last[0] != signature:
+        pending[key] = (signature, now)
+        return last is None and now - newest >= settle
+    return now - last[1] >= settle or now - newest >= settle
+
+
+def poll_country(
+    country_iso3, parameters, names, known, pending, seen, now, settle, folder_fews
+):
+    """
+    Find the FewsNet releases and WorldPop rasters of a country that are complete and that changed since they were processed
+    Besides the dates in fewsnet_dates of the config, releases of dates after the last configured date are picked up, such
+    that new releases do not have to be added to the config. Older releases that are not in the config are left out on purpose
+    Args:
+        country_iso3: string with iso3 code
+        parameters: dict with the parameters of the country, parsed from the config
+        names: list with the names of the folders in folder_fews
+        known: dict with the signatures per date ("releases") and year ("worldpop") that were already processed
+        pending: dict with the files that are not settled yet, see settled
+        seen: set to which the keys of pending that were polled are added
+        now: time of the poll in seconds
+        settle: seconds that the files of a release or raster should stay unchanged before they are processed
+        folder_fews: path to the folder with the FewsNet releases
+
+    Returns:
+        found: dict with the signatures of the new or changed releases per date and WorldPop rasters per year
+    """
+    configured = sorted(parameters["fewsnet_dates"])
+    last_configured = configured[-1] if configured else ""
+    found = {"releases": {}, "worldpop": {}}
+    for d, (name, prefix) in sorted(release_folders(names, parameters).items()):
+        if d not in configured and d < last_configured:
+            continue
+        signature, newest = release_signature(folder_fews, name, prefix, d)
+        if signature is None:
+            logger.debug(f"Release {name} is not complete yet")
+            continue
+        key = (country_iso3, "releases", d)
+        seen.add(key)
+        if (
+            settled(pending, key, signature, newest, now, settle)
+            and known["releases"].get(d) != signature
+        ):
+            found["releases"][d] = signature
+    resolution = parameters.get("worldpop_resolution", DEFAULT_RESOLUTION)
+    pop_paths = find_pop_paths(
+        f"{parameters['country_name']}/Data/WorldPop", country_iso3, resolution
+    )
+    for year, path in sorted(pop_paths.items()):
+        signature, newest = files_signature([path])
+        if signature is None:
+            continue
+        key = (country_iso3, "worldpop", str(year))
+        seen.add(key)
+        if (
+            settled(pending, key, signature, newest, now, settle)
+            and known["worldpop"].get(str(year)) != signature
+        ):
+            found["worldpop"][str(year)] = signature
+    return found
+
+
+def load_state(state_path=WATCH_STATE_PATH):
+    """
+    Return the signatures per country of the releases and rasters that were processed, empty if the watcher never ran
+    """
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, state_path=WATCH_STATE_PATH):
+    """
+    Save state to state_path, via a temporary file such that a killed watcher never leaves a partly written state
+    """
+    Path(state_path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def watch(
+    countries,
+    admin_level,
+    suffix,
+    interval=60,
+    settle=300,
+    once=False,
+    config_file="config.yml",
+    results_db=None,
+    use_crosswalk=False,
+    folder_fews=PATH_FEWSNET,
+    state_path=WATCH_STATE_PATH,
+    retry_delay=RETRY_DELAY,
+):
+    """
+    Watch the FewsNet and WorldPop folders, and run the pipeline for every country with a new or changed release or raster
+    The folders are polled every interval seconds. A release is processed once the shapefiles of all periods are present and
+    did not change for settle seconds, such that a release that is still being copied is not processed. The pipeline then runs
+    with the new dates added to the dates of the config, only redoing the stages of which the inputs changed, and the
+    FewsNet-WorldPop stage resumes from its checkpoints such that only the new dates and periods are computed. The triggers are
+    refreshed by the trigger stage of the pipeline.
+    If the processing of a country fails, it is tried again after retry_delay seconds, and the delay doubles after every
+    failure up to MAX_RETRY_DELAY. A change in the files of the country is tried right away.
+    The processing runs in worker processes that exit after every run, and the watcher itself only keeps the signatures of
+    the files, so its memory stays flat however long it runs.
+    Args:
+        countries: list of iso3 codes
+        admin_level: integer indicating which admin level the triggers are computed for
+        suffix: string to attach to the output files name
+        interval: seconds between two polls
+        settle: seconds that the files of a release or raster should stay unchanged before they are processed
+        once: if True, poll once and return instead of watching until interrupted
+        config_file: path to config file, which is read again at every poll
+        results_db: if given, path to the SQLite database to which the results are also saved, see results_store
+        use_crosswalk: if True, the FewsNet stages use the cached admin x FewsNet crosswalk
+        folder_fews: path to the folder with the FewsNet releases
+        state_path: path to the file with the signatures of the processed releases and rasters
+        retry_delay: seconds after which the processing of a country that failed is tried again the first time
+    """
+    state = load_state(state_path)
+    # per country the signatures of the releases and rasters of which the processing failed, the delay and the time of the
+    # next try. The failed signatures count as processed until then, unless the files change again
+    failed = {}
+    pending = {}
+    logger.info(
+        f"Watching {folder_fews} and the WorldPop folders of {', '.join(countries)}"
+    )
+    while True:
+        now = time.time()
+        config = parse_yaml(config_file)
+        names = (
+            sorted(e.name for e in os.scandir(folder_fews) if e.is_dir())
+            if os.path.isdir(folder_fews)
+            else []
+        )
+        seen = set()
+        for country_iso3 in countries:
+            parameters = config[country_iso3]
+            country_state = state.setdefault(
+                country_iso3, {"releases": {}, "worldpop": {}}
+            )
+            country_failed = failed.get(country_iso3)
+            known = {
+                kind: {
+                    **country_state[kind],
+                    **(
+                        country_failed["found"][kind]
+                        if country_failed and now < country_failed["retry_at"]
+                        else {}
+                    ),
+                }
+                for kind in country_state
+            }
+            found = poll_country(
+                country_iso3,
+                parameters,
+                names,
+                known,
+                pending,
+                seen,
+                now,
+                settle,
+                folder_fews,
+            )
+            if not found["releases"] and not found["worldpop"]:
+                continue
+            dates = sorted(
+                set(parameters["fewsnet_dates"])
+                | set(country_state["releases"])
+                | set(found["releases"])
+            )
+            logger.info(
+                f"Processing {country_iso3}: releases {', '.join(found['releases']) or '-'}, "
+                f"WorldPop {', '.join(found['worldpop']) or '-'}"
+            )
+            try:
+                with run_report(
+                    f"watch_fewsnet_{country_iso3}", keep=WATCH_REPORTS_KEEP
+                ):
+                    run_pipeline(
+                        country_iso3,
+                        admin_level,
+                        suffix,
+                        config_file=config_file,
+                        results_db=results_db,
+                        dates=dates,
+                        use_crosswalk=use_crosswalk,
+                        resume=True,
+                    )
+            except Exception:
+                delay = (
+                    min(2 * country_failed["delay"], MAX_RETRY_DELAY)
+                    if country_failed
+                    else retry_delay
+                )
+                logger.exception(
+                    f"Processing {country_iso3} failed, it is tried again in {delay:.0f} seconds or once its files change"
+                )
+                previous = country_failed["found"] if country_failed else found
+                failed[country_iso3] = {
+                    "found": {
+                        kind: {**previous[kind], **found[kind]} for kind in found
+                    },
+                    "delay": delay,
+                    "retry_at": time.time() + delay,
+                }
+                continue
+            for kind in found:
+                country_state[kind].update(found[kind])
+            failed.pop(country_iso3, None)
+            save_state(state, state_path)
+        # forget files that disappeared, such that pending does not grow over time
+        for key in set(pending) - seen:
+            del pending[key]
+        gc.collect()
+        if once:
+            return state
+        time.sleep(interval)
+
+
+def watch_arguments(parser):
+    """
+    Add the options of the watcher to parser, see utils.parse_args
+    """
+    multi_country_arguments(parser)
+    crosswalk_arguments(parser)
+    results_db_arguments(parser)
+    admin_level_arguments(parser)
+    parser.add_argument(
+        "--interval",
+        default=60,
+        type=float,
+        help="Seconds between two polls of the FewsNet and WorldPop folders",
+    )
+    parser.add_argument(
+        "--settle",
+        default=300,
+        type=float,
+        help="Seconds that the files of a new release should stay unchanged before it is processed",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Poll once and process the new releases, instead of watching until interrupted",
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args(watch_arguments)
+    config_logger(level="info")
+    if args.all_countries:
+        countries = list(parse_yaml("config.yml").keys())
+    else:
+        countries = [c.strip().upper() for c in args.country_iso3.split(",")]
+    try:
+        watch(
+            countries,
+            args.admin_level,
+            args.suffix,
+            args.interval,
+            args.settle,
+            args.once,
+            results_db=args.results_db,
+            use_crosswalk=args.crosswalk,
+        )
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")